@@ -3,8 +3,16 @@
 import argparse
 import os
 import sys
-import gzip
 import math
+import numpy as np
+
+try:
+    import Barcodes
+    import FastqIO
+    import DellingrExceptions as pe
+except ImportError:
+    from Dellingr import Barcodes, FastqIO
+    from Dellingr import DellingrExceptions as pe
 
 
 # Which nucleotides each IUPAC base represents, and their distribution
@@ -74,6 +82,82 @@ parser = argparse.ArgumentParser(description="Estimates the degenerate barcode s
 parser.add_argument("-i", "--input", metavar="FASTQ", nargs=2, required=True, type=lambda x: isValidFile(x, parser),
                         help="A set of paired-end FASTQ files")
 parser.add_argument("-m", "--max_barcode_length", metavar="INT", default=16, type=int, help="Maximum barcode length to predict [Default: %(default)s]")
+parser.add_argument("-n", "--max_reads", metavar="INT", type=int,
+                    help="Maximum number of read pairs to examine [Default: All read pairs]")
+parser.add_argument("--no_early_stop", action="store_true",
+                    help="Examine all read pairs (up to -n/--max_reads), even if the predicted barcode has stabilized")
+
+# How often (in read pairs) to check if the predicted barcode has stabilized, and how many consecutive checks
+# must predict the same barcode before we stop reading
+CONVERGENCE_INTERVAL = 100000
+CONVERGENCE_CHECKS = 3
+
+
+# Converts the ASCII value of each base into an index in the base count matrix
+# A:0, C:1, G:2, T:3, N:4. Anything else is not a nucleotide
+NUC_TO_INDEX = np.full(256, 5, dtype=np.uint8)
+for index, nuc in enumerate("ACGTN"):
+    NUC_TO_INDEX[ord(nuc)] = index
+del index, nuc
+
+
+def countBases(forwardSeqs, reverseSeqs, barcodeLength):
+    """
+    Counts the number of A, C, G, T, and N bases at each barcode position in a batch of read pairs
+
+    Only the leading bases of each read pair are examined. If one read is shorter than the barcode, we stop examining
+    this read pair at that position
+
+    :param forwardSeqs: A list of read 1 sequences (as bytes)
+    :param reverseSeqs: A list of the corresponding read 2 sequences
+    :param barcodeLength: An int specifying the number of positions to examine
+    :return: A numpy.ndarray of shape (barcodeLength, 5) listing the number of A, C, G, T, and N bases at each position
+    :raises InvalidInputException: If a non-nucleotide character is found within the barcode
+    """
+
+    forwardBases = NUC_TO_INDEX[Barcodes.windowMatrix(forwardSeqs, barcodeLength)]
+    reverseBases = NUC_TO_INDEX[Barcodes.windowMatrix(reverseSeqs, barcodeLength)]
+
+    # Which positions in each read are examined?
+    # Read 1 is examined up to (and including) the position where read 2 ends, while read 2 is examined until either
+    # read ends
+    forwardLengths = np.fromiter(map(len, forwardSeqs), dtype=np.intp, count=len(forwardSeqs)).reshape(-1, 1)
+    reverseLengths = np.fromiter(map(len, reverseSeqs), dtype=np.intp, count=len(reverseSeqs)).reshape(-1, 1)
+    positions = np.arange(barcodeLength).reshape(1, -1)
+    forwardExamined = positions < np.minimum(forwardLengths, reverseLengths + 1)
+    reverseExamined = positions < np.minimum(forwardLengths, reverseLengths)
+
+    # Check for any non-nucleotide characters
+    invalid = ((forwardBases == 5) & forwardExamined) | ((reverseBases == 5) & reverseExamined)
+    if np.any(invalid):
+        row, col = np.argwhere(invalid)[0]
+        raise pe.InvalidInputException("\'%s\' or \'%s\' do not appear to be nucleotides"
+                                       % (forwardSeqs[row][col:col + 1].decode(), reverseSeqs[row][col:col + 1].decode()))
+
+    # Count the number of times each base occurs at each position
+    # Each (position, base) combination is assigned a unique bin
+    forwardBins = (positions * 5 + forwardBases)[forwardExamined]
+    reverseBins = (positions * 5 + reverseBases)[reverseExamined]
+    counts = np.bincount(forwardBins, minlength=barcodeLength * 5) + np.bincount(reverseBins, minlength=barcodeLength * 5)
+    return counts.reshape(barcodeLength, 5)
+
+
+def predictBarcode(baseCounts):
+    """
+    Identifies the most likely (degenerate) base at each position of the barcode
+
+    :param baseCounts: A matrix (or list) containing the number of A, C, G, T, and N bases observed at each barcode position
+    :return: A string containing the predicted barcode sequence
+    """
+    barcode = ""
+    for pos in baseCounts:
+
+        newBase = getLikelyBase(pos[:4])
+        if newBase:
+            barcode += newBase
+        else:
+            break
+    return barcode
 
 
 def main(args=None, sysStdin=None, supressOutput=False):
@@ -88,6 +172,9 @@ def main(args=None, sysStdin=None, supressOutput=False):
     if args.max_barcode_length <= 0:
         raise parser.error("-m/--max_adapter_length must be greater than 0")
 
+    if args.max_reads is not None and args.max_reads <= 0:
+        raise parser.error("-n/--max_reads must be greater than 0")
+
     # Sanity check: Are the input FASTQ files the same?
     if os.path.samefile(args.input[0], args.input[1]):
         raise parser.error("\'%s\' and \'%s\' are the same file" % (args.input[0], args.input[1]))
@@ -97,56 +184,51 @@ def main(args=None, sysStdin=None, supressOutput=False):
         sys.stderr.write("WARNING: m/--max_adapter_length was set to %s, which is kind of insane.\n" % args.max_barcode_length)
         sys.stderr.write("We'll continue anyways, but you should really check that this is correct.\n")
 
-    # Generate a tuple which will store the bases at each position in the adapter sequence
-    baseCounts = []
-    for i in range(0, args.max_barcode_length):
-        baseCounts.append([0, 0, 0, 0, 0])
-    baseCounts = tuple(baseCounts)
+    # Generate a matrix which will store the bases at each position in the adapter sequence
+    # (one row per position, with columns A, C, G, T, N)
+    baseCounts = np.zeros((args.max_barcode_length, 5), dtype=np.int64)
 
     # Open the input files for reading
-    # Determine if they are gzipped based upon file extension
+    # The reader determines if they are gzipped based upon file extension
     # I have tried examining the magic number before, but that does not work
-    if args.input[0].split(".")[-1] == "gz":  # Aka get the file extension
-        f1in = gzip.open(args.input[0], "rt")
-    else:
-        f1in = open(args.input[0], "r")
-
-    if args.input[1].split(".")[-1] == "gz":  # Aka get the file extension
-        f2in = gzip.open(args.input[1], "rt")
-    else:
-        f2in = open(args.input[1], "r")
-
-    lineNum = 0
-    nucToIndex = {"A": 0, "C": 1, "G": 2, "T": 3, "N": 4}
-
-    for forwardRead, reverseRead in zip(f1in, f2in):
-        lineNum += 1
-        # Since the nucleotide sequence of each FASTQ record is only on line 2, ignore the other 3 lines
-        if (lineNum - 2) % 4 != 0:
-            continue
-
-        # Cycle through the bases of this sequence which correspond to the barcode
-        for i in range(0, args.max_barcode_length):
-            try:
-                baseCounts[i][nucToIndex[forwardRead[i]]] += 1  # aka obtain the base at the i'th position of the sequence, and add that
-                baseCounts[i][nucToIndex[reverseRead[i]]] += 1  # count to the base count dictionary for both reads
-
-            except KeyError:  # It looks like there are non-nucleotide sequences in one of the input files, or we have reached the end of the read
-                if forwardRead[i] == os.linesep or reverseRead[i] == os.linesep:  # Aka, we have reached the end of this read pair. It is truncated
+    reader = FastqIO.PairedFastqReader(args.input[0], args.input[1])
+
+    # The base frequencies at each position converge long before the end of the file is reached. Thus, periodically
+    # check the predicted barcode, and stop once it is no longer changing
+    readCount = 0
+    previousBarcode = None
+    stableChecks = 0
+    while args.max_reads is None or readCount < args.max_reads:
+        batchSize = CONVERGENCE_INTERVAL
+        if args.max_reads is not None:
+            batchSize = min(batchSize, args.max_reads - readCount)
+        # Since only the nucleotide sequence of each FASTQ record is examined, the sequences are left as bytes
+        forwardSeqs, reverseSeqs = reader.readSequences(batchSize)
+        if not forwardSeqs:  # We have reached the end of the input files
+            break
+        readCount += len(forwardSeqs)
+
+        # Count the bases at each barcode position in this batch
+        try:
+            baseCounts += countBases(forwardSeqs, reverseSeqs, args.max_barcode_length)
+        except pe.InvalidInputException as e:  # It looks like there are non-nucleotide sequences in one of the input files
+            sys.stderr.write("ERROR: %s\n" % e)
+            exit(1)
+
+        # Has the predicted barcode stabilized?
+        if not args.no_early_stop:
+            barcode = predictBarcode(baseCounts)
+            if barcode == previousBarcode:
+                stableChecks += 1
+                if stableChecks >= CONVERGENCE_CHECKS:
                     break
-                else:
-                    sys.stderr.write("ERROR: \'%s\' or \'%s\' do not appear to be nucleotides" % (forwardRead[i], reverseRead[i]))
-                    exit(1)
+            else:
+                stableChecks = 1
+            previousBarcode = barcode
+    reader.close()
 
     # Identify the base used at each position in the barcode
-    barcode = ""
-    for pos in baseCounts:
-
-        newBase = getLikelyBase(pos[:4])
-        if newBase:
-            barcode += newBase
-        else:
-            break
+    barcode = predictBarcode(baseCounts)
 
     if not supressOutput:
         sys.stdout.write(barcode + "\n")
@@ -0,0 +1,515 @@
+#! /usr/bin/env python
+
+"""
+Shared routines for comparing degenerate barcodes against the barcode sequences observed in reads
+
+Barcodes are compared in batches. The barcode window of each read is loaded into a row of a uint8 matrix, and each
+base is converted into a one-hot bitmask (A=1, C=2, G=4, T=8). Each position of the expected (IUPAC) barcode is also
+represented as a bitmask (ex. W = A|T = 9), so a base matches the expected barcode if the bitwise AND of the two is
+non-zero
+"""
+
+import numpy as np
+
+# Which nucleotides each IUPAC base represents, as a bitmask
+# A:1, C:2, G:4, T:8, gap:16
+IUPAC_BITS = {
+    'A': 1,  # Adenine
+    'C': 2,  # Cytosine
+    'G': 4,  # Guanine
+    'T': 8,  # Thymine
+    'U': 8,  # Uracil
+    'R': 1 | 4,  # A or G
+    'Y': 2 | 8,  # C or T
+    'S': 4 | 2,  # G or C
+    'W': 1 | 8,  # A or T
+    'K': 4 | 8,  # G or T
+    'M': 1 | 2,  # A or C
+    'B': 2 | 4 | 8,  # C or G or T
+    'D': 1 | 4 | 8,  # A or G or T
+    'H': 1 | 2 | 8,  # A or C or T
+    'V': 1 | 2 | 4,  # A or C or G
+    'N': 1 | 2 | 4 | 8,  # any base
+    '.': 16,  # gap
+    '-': 16  # gap
+}
+
+COMPLIMENT = {
+    'A': 'T',
+    'T': 'A',
+    'C': 'G',
+    'G': 'C',
+    'U': 'A',
+    'R': 'Y',
+    'Y': 'R',
+    'S': 'S',
+    'W': 'W',
+    'K': 'M',
+    'M': 'K',
+    'B': 'V',
+    'D': 'H',
+    'H': 'D',
+    'V': 'B',
+    'N': 'N',
+    '.': '.',
+    '-': '-'
+}
+
+# Lookup table converting the ASCII value of a sequenced base into a bitmask
+# Anything that is not an (uppercase) nucleotide or gap is assigned 0, and will thus never match the expected barcode
+# Note that an "N" in the read itself is not a nucleotide, and will therefore always count as a mismatch
+BASE_BITS = np.zeros(256, dtype=np.uint8)
+for base in ("A", "C", "G", "T", "U", ".", "-"):
+    BASE_BITS[ord(base)] = IUPAC_BITS[base]
+del base
+
+# Used to pad reads which are shorter than the barcode window. This is never a valid base
+PAD_BYTE = b"\0"
+
+# A more compact representation of BASE_BITS, used when building cache keys. Each base is converted into a 3-bit code
+# (0 = invalid, 1-5 = A, C, G, T and gap), so up to 21 barcode positions can be packed into a single 64-bit integer
+BASE_CODE = np.zeros(256, dtype=np.uint8)
+CODE_BITS = np.array([0, 1, 2, 4, 8, 16], dtype=np.uint8)  # Converts each code back into a bitmask
+for base in ("A", "C", "G", "T", "U", ".", "-"):
+    BASE_CODE[ord(base)] = np.flatnonzero(CODE_BITS == IUPAC_BITS[base])[0]
+del base
+MAX_CACHED_POSITIONS = 21
+
+
+def reverseCompliment(barcodeSequence):
+    """
+    Generates the reverse compliment of a (possibly degenerate) barcode sequence
+
+    :param barcodeSequence: A string containing IUPAC bases
+    :return: A string containing the reverse compliment of barcodeSequence
+    """
+    return "".join(COMPLIMENT[x] for x in reversed(barcodeSequence))
+
+
+def windowMatrix(sequences, windowLength, fromEnd=False):
+    """
+    Loads the leading (or trailing) bases of each sequence into a uint8 matrix
+
+    Sequences shorter than the window are padded with PAD_BYTE, which never matches a barcode base
+
+    :param sequences: A list of sequences (either strings or bytes)
+    :param windowLength: An int specifying the number of bases to extract from each sequence
+    :param fromEnd: A boolean. If True, examine the last bases of each sequence, instead of the first
+    :return: A numpy.ndarray of shape (len(sequences), windowLength)
+    """
+
+    if windowLength == 0 or len(sequences) == 0:
+        return np.zeros((len(sequences), windowLength), dtype=np.uint8)
+    if isinstance(sequences[0], str):
+        pad = PAD_BYTE.decode("latin-1")
+    else:
+        pad = PAD_BYTE
+    # Since every window is padded to the same width, the windows can simply be concatenated and reshaped into a matrix
+    if fromEnd:
+        windows = pad[:0].join(x[-windowLength:].rjust(windowLength, pad) for x in sequences)
+    else:
+        windows = pad[:0].join(x[:windowLength].ljust(windowLength, pad) for x in sequences)
+    if isinstance(windows, str):
+        windows = windows.encode("latin-1")
+    return np.frombuffer(windows, dtype=np.uint8).reshape(len(sequences), windowLength)
+
+
+class BarcodeCache:
+    """
+    A bounded cache storing the number of mismatches of each barcode window that has been examined
+
+    Since the number of distinct barcodes in a library is much smaller than the number of reads, most barcode windows
+    will have been seen before. The cache is stored as a sorted array of keys, which allows an entire batch of barcodes
+    to be looked up at once. Once the cache is full, the least frequently used barcodes are evicted
+    """
+
+    def __init__(self, maxSize):
+        """
+        :param maxSize: An int specifying the maximum number of barcodes to store in the cache
+        """
+        self.maxSize = maxSize
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.values = np.zeros(0, dtype=np.intp)
+        self.uses = np.zeros(0, dtype=np.int64)
+        # Statistics
+        self.hits = 0
+        self.lookups = 0
+
+    def lookup(self, keys):
+        """
+        Finds the specified (unique) keys in the cache
+
+        :param keys: A sorted numpy.ndarray of unique uint64 keys
+        :return: A numpy.ndarray listing the index of each key in the cache, and a boolean numpy.ndarray indicating
+                which keys were found
+        """
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=np.intp), np.zeros(len(keys), dtype=bool)
+        indexes = np.searchsorted(self.keys, keys)
+        indexes[indexes == len(self.keys)] = 0
+        return indexes, self.keys[indexes] == keys
+
+    def add(self, keys, values, uses):
+        """
+        Adds the specified keys to the cache, evicting the least frequently used keys if the cache is full
+
+        :param keys: A numpy.ndarray of uint64 keys, none of which are currently in the cache
+        :param values: A numpy.ndarray containing the number of mismatches of each key
+        :param uses: A numpy.ndarray containing the number of times each key has been observed
+        """
+        keys = np.concatenate((self.keys, keys))
+        values = np.concatenate((self.values, values))
+        uses = np.concatenate((self.uses, uses))
+        if len(keys) > self.maxSize:
+            keep = np.argpartition(-uses, self.maxSize - 1)[:self.maxSize]
+            keys = keys[keep]
+            values = values[keep]
+            uses = uses[keep]
+        order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        self.values = values[order]
+        self.uses = uses[order]
+
+
+class BarcodeMatcher:
+    """
+    Counts the number of mismatches between an expected degenerate barcode and the barcodes of many reads at once
+    """
+
+    def __init__(self, barcodeSequence, barcodePosition, fromEnd=False, cacheSize=0):
+        """
+        :param barcodeSequence: A string containing the expected barcode, in IUPAC bases
+        :param barcodePosition: A string of 1s and 0s, indicating which positions in the barcode are to be compared
+        :param fromEnd: A boolean. If True, the reverse compliment of the barcode is expected at the end of the read
+        :param cacheSize: An int specifying the maximum number of barcodes to store in the mismatch cache (0 = No cache)
+                        The cache is only used if at most MAX_CACHED_POSITIONS barcode positions are compared
+        """
+
+        if len(barcodeSequence) != len(barcodePosition):
+            raise ValueError("The barcode sequence and barcode mask must be the same length")
+
+        self.barcodeLength = len(barcodePosition)
+        self.fromEnd = fromEnd
+        if fromEnd:
+            barcodeSequence = reverseCompliment(barcodeSequence)
+            barcodePosition = barcodePosition[::-1]
+
+        self.barcodeIndexes = np.array(list(i for i in range(0, self.barcodeLength) if barcodePosition[i] == "1"),
+                                       dtype=np.intp)
+        self.barcodeBits = np.array(list(IUPAC_BITS[barcodeSequence[i]] for i in self.barcodeIndexes), dtype=np.uint8)
+
+        if cacheSize > 0 and 0 < len(self.barcodeIndexes) <= MAX_CACHED_POSITIONS:
+            self.cache = BarcodeCache(cacheSize)
+            # Where is each base code stored in the cache key?
+            self.keyShifts = np.arange(len(self.barcodeIndexes), dtype=np.uint64) * np.uint64(3)
+        else:
+            self.cache = None
+
+    def windows(self, sequences):
+        """
+        Obtains the barcode window of each sequence, as a uint8 matrix
+
+        :param sequences: A list of sequences (strings or bytes)
+        :return: A numpy.ndarray of shape (len(sequences), barcodeLength)
+        """
+        return windowMatrix(sequences, self.barcodeLength, self.fromEnd)
+
+    def windowMismatches(self, windows):
+        """
+        Counts the number of mismatches between each barcode window and the expected barcode
+
+        :param windows: A uint8 matrix, as generated by windows()
+        :return: A numpy.ndarray listing the number of mismatches in each row
+        """
+        if self.cache is not None:
+            return self._cachedMismatches(windows)
+        observed = BASE_BITS[windows[:, self.barcodeIndexes]]
+        return np.count_nonzero((observed & self.barcodeBits) == 0, axis=1)
+
+    def _cachedMismatches(self, windows):
+        """
+        Counts the number of mismatches in each barcode window, using cached results for barcodes seen previously
+
+        :param windows: A uint8 matrix, as generated by windows()
+        :return: A numpy.ndarray listing the number of mismatches in each row
+        """
+
+        # Pack the compared positions of each barcode into a single integer
+        codes = BASE_CODE[windows[:, self.barcodeIndexes]]
+        keys = np.bitwise_or.reduce(codes.astype(np.uint64) << self.keyShifts, axis=1)
+        uniqueKeys, firstIndexes, inverse, keyCounts = np.unique(keys, return_index=True, return_inverse=True,
+                                                                 return_counts=True)
+
+        # Which of these barcodes have been examined previously?
+        mismatches = np.empty(len(uniqueKeys), dtype=np.intp)
+        cacheIndexes, found = self.cache.lookup(uniqueKeys)
+        foundIndexes = cacheIndexes[found]
+        mismatches[found] = self.cache.values[foundIndexes]
+        self.cache.uses[foundIndexes] += keyCounts[found]
+
+        # Compare the remaining barcodes, and add them to the cache
+        missing = ~found
+        if np.any(missing):
+            observed = CODE_BITS[codes[firstIndexes[missing]]]
+            mismatches[missing] = np.count_nonzero((observed & self.barcodeBits) == 0, axis=1)
+            self.cache.add(uniqueKeys[missing], mismatches[missing], keyCounts[missing])
+
+        self.cache.lookups += len(keys)
+        self.cache.hits += int(keyCounts[found].sum())
+        return mismatches[inverse.reshape(-1)]
+
+    def cacheStats(self):
+        """
+        Obtains the number of barcodes which were found in the mismatch cache
+
+        :return: A tuple containing the number of cache hits and the number of lookups
+        """
+        if self.cache is None:
+            return 0, 0
+        return self.cache.hits, self.cache.lookups
+
+    def mismatches(self, sequences):
+        """
+        Counts the number of mismatches between the barcode window of each sequence and the expected barcode
+
+        :param sequences: A list of sequences (strings or bytes)
+        :return: A numpy.ndarray listing the number of mismatches of each sequence
+        """
+        return self.windowMismatches(self.windows(sequences))
+
+
+class _PackTable(dict):
+    """
+    A str.translate() table which converts each base into a hexadecimal digit (see packBarcode())
+    """
+
+    def __missing__(self, key):
+        # Only "A", "C", "G", "T" and "N" can be packed. Treating anything else as an "N" would merge barcodes which
+        # are actually different (ex. "ACGa" and "ACG."), so reject them instead
+        raise ValueError("Unable to pack the barcode base \'%s\'. Only \'A\', \'C\', \'G\', \'T\' and \'N\' are supported" % chr(key))
+
+
+# Converts each base of a barcode into its 4-bit one-hot code, as a hexadecimal digit
+PACK_TABLE = _PackTable((ord(base), "%x" % IUPAC_BITS[base]) for base in ("A", "C", "G", "T", "N"))
+# Converts each hexadecimal digit back into a base
+UNPACK_TABLE = dict((ord("%x" % IUPAC_BITS[base]), base) for base in ("A", "C", "G", "T", "N"))
+
+
+def packBarcode(barcode):
+    """
+    Packs a barcode sequence into an int, using 4 bits per base
+
+    Each base is stored as a one-hot bitmask (A=1, C=2, G=4, T=8, N=15), with the first base in the lowest 4 bits. Since
+    every base is non-zero, barcodes of different lengths are never packed into the same int. Two barcodes can then be
+    compared using a single XOR (or AND), instead of comparing each base
+
+    :param barcode: A string containing a barcode sequence
+    :return: An int
+    :raises ValueError: If the barcode contains anything other than "A", "C", "G", "T" or "N" (including lowercase bases)
+    """
+    if not barcode:
+        return 0
+    return int(barcode.translate(PACK_TABLE)[::-1], 16)
+
+
+def unpackBarcode(packedBarcode):
+    """
+    Converts a barcode packed using packBarcode() back into a string
+
+    :param packedBarcode: An int
+    :return: A string containing the barcode sequence
+    """
+    if packedBarcode == 0:
+        return ""
+    return ("%x" % packedBarcode)[::-1].translate(UNPACK_TABLE)
+
+
+def rotateBarcode(packedBarcode, length):
+    """
+    Swaps the two halves of a packed barcode (i.e. barcode[length / 2:] + barcode[:length / 2])
+
+    :param packedBarcode: An int, generated by packBarcode()
+    :param length: An int specifying the number of bases in the barcode
+    :return: An int
+    """
+    half = 4 * (length // 2)
+    return (packedBarcode >> half) | ((packedBarcode & ((1 << half) - 1)) << (4 * length - half))
+
+
+def barcodeLength(packedBarcode):
+    """
+    :param packedBarcode: An int, generated by packBarcode()
+    :return: An int specifying the number of bases in the barcode
+    """
+    return (packedBarcode.bit_length() + 3) // 4
+
+
+def _nonzeroBases(packedBarcode, lowBits):
+    """
+    Identifies which bases of a packed barcode are non-zero
+
+    :param packedBarcode: An int
+    :param lowBits: An int with the lowest bit of every base to be examined set
+    :return: An int, in which only the lowest bit of each non-zero base is set
+    """
+    packedBarcode |= packedBarcode >> 1
+    packedBarcode |= packedBarcode >> 2
+    return packedBarcode & lowBits
+
+
+def _popcount(x):
+    return bin(x).count("1")
+
+
+class BarcodeIndex:
+    """
+    Finds the closest (previously added) barcode within a maximum number of mismatches, without comparing against
+    every barcode
+
+    Barcodes are packed into ints (see packBarcode()), and the positions which are not compared are masked out. Two
+    barcodes can then be compared by XOR-ing them, and counting the number of non-zero bases
+
+    The compared positions of each barcode are split into maxMismatches + 1 partitions. If two barcodes differ by at
+    most maxMismatches positions, at least one partition must be identical in both (pigeonhole principle), so only
+    barcodes which share a partition exactly need to be compared. If "N"s are treated as wildcards, barcodes containing
+    an "N" can not be found this way, and are always compared
+
+    Barcodes can also be removed (ex. once a family has been paired with its duplex partner)
+    """
+
+    def __init__(self, indices, maxMismatches, wildcard=False):
+        """
+        :param indices: A list of ints, specifying which positions in each barcode are compared
+        :param maxMismatches: An int specifying the maximum distance between matching barcodes
+        :param wildcard: A boolean. If True, an "N" matches any base, and thus is never counted as a mismatch
+                        Otherwise, all bases which differ are counted as mismatches
+        """
+        self.indices = sorted(set(indices))
+        self.maxMismatches = maxMismatches
+        self.wildcard = wildcard
+        self.names = []  # The name of each barcode, in the order they were added
+        self.keys = []  # The compared positions of each barcode
+        self.sizes = []  # Used to break ties between equally close barcodes
+        self._ids = {}  # {name: barcode ID}
+        self._removed = set()  # The IDs of barcodes which have been removed
+        self._wildcardIDs = []  # Barcodes containing a wildcard, which must always be compared
+
+        # Precompute the masks used to select the compared positions
+        self.mask = sum(0xF << (4 * x) for x in self.indices)
+        self._lowBits = sum(0x1 << (4 * x) for x in self.indices)
+
+        # Which positions are in each partition?
+        if 0 <= maxMismatches < len(self.indices):
+            partitions = maxMismatches + 1
+            bounds = list(len(self.indices) * i // partitions for i in range(0, partitions + 1))
+            self._partitions = list(sum(0xF << (4 * x) for x in self.indices[start:end])
+                                    for start, end in zip(bounds[:-1], bounds[1:]))
+        else:
+            # Barcodes which differ at every position are still within the threshold, so every barcode must be compared
+            self._partitions = None
+        self._buckets = list({} for x in (self._partitions or ()))  # {partition: [barcode IDs]}
+
+    def __len__(self):
+        return len(self.names) - len(self._removed)
+
+    def key(self, barcode):
+        """
+        :param barcode: An int containing a packed barcode sequence (see packBarcode())
+        :return: An int containing only the compared positions of the barcode
+        """
+        return barcode & self.mask
+
+    def _hasWildcard(self, key):
+        """
+        :return: A boolean indicating if any compared position of the specified key is an "N" (i.e. all bits are set)
+        """
+        return self.wildcard and (key & (key >> 1) & (key >> 2) & (key >> 3) & self._lowBits) != 0
+
+    def distance(self, key1, key2):
+        """
+        Counts the number of mismatches between two barcode keys (as generated by key())
+
+        :return: An int
+        """
+        if self.wildcard:
+            # Since each base is one-hot encoded (and an "N" has every bit set), two bases match if they share a bit
+            return len(self.indices) - _popcount(_nonzeroBases(key1 & key2, self._lowBits))
+        return _popcount(_nonzeroBases(key1 ^ key2, self._lowBits))
+
+    def add(self, name, barcode=None, size=0):
+        """
+        Adds a barcode to the index
+
+        :param name: A unique identifier for this barcode (ex. the family name)
+        :param barcode: An int containing a packed barcode sequence. Defaults to the name
+        :param size: A number (ex. the family size). If several barcodes are equally close, the largest is chosen
+        :return: An int specifying the ID assigned to this barcode (i.e. the order it was added)
+        """
+        key = self.key(name if barcode is None else barcode)
+        barcodeID = len(self.names)
+        self.names.append(name)
+        self.keys.append(key)
+        self.sizes.append(size)
+        self._ids[name] = barcodeID
+        if self._hasWildcard(key):
+            self._wildcardIDs.append(barcodeID)
+        elif self._partitions is not None:
+            for partitionMask, bucket in zip(self._partitions, self._buckets):
+                partition = key & partitionMask
+                if partition in bucket:
+                    bucket[partition].append(barcodeID)
+                else:
+                    bucket[partition] = [barcodeID]
+        return barcodeID
+
+    def remove(self, name):
+        """
+        Removes a barcode from the index, so it is no longer returned by nearest()
+
+        :param name: The name of a barcode which was previously added
+        """
+        self._removed.add(self._ids.pop(name))
+
+    def candidates(self, key):
+        """
+        Identifies all barcodes which could be within maxMismatches of the specified barcode key
+
+        :param key: An int, as generated by key()
+        :return: A sorted list of barcode IDs
+        """
+        if self._partitions is None or self._hasWildcard(key):
+            return list(x for x in range(0, len(self.names)) if x not in self._removed)
+        candidates = set(self._wildcardIDs)
+        for partitionMask, bucket in zip(self._partitions, self._buckets):
+            candidates.update(bucket.get(key & partitionMask, ()))
+        return sorted(candidates - self._removed)
+
+    def nearest(self, barcode):
+        """
+        Finds the closest barcode within maxMismatches of the specified barcode
+
+        If several barcodes are equally close, the largest barcode (see add()) is returned. If that is also a tie, the
+        barcode which was added first is returned
+
+        :param barcode: An int containing a packed barcode sequence
+        :return: A tuple containing the name of the closest barcode and its distance, or (None, None) if no barcodes
+                are within maxMismatches
+        """
+        if self.maxMismatches < 0:
+            return None, None
+        key = self.key(barcode)
+        minID = None
+        minDistance = None
+        minSize = None
+        for barcodeID in self.candidates(key):
+            distance = self.distance(key, self.keys[barcodeID])
+            # Barcodes which share a partition can still differ by more than maxMismatches
+            if distance > self.maxMismatches:
+                continue
+            if minID is None or distance < minDistance or (distance == minDistance and self.sizes[barcodeID] > minSize):
+                minDistance = distance
+                minID = barcodeID
+                minSize = self.sizes[barcodeID]
+        if minID is None:
+            return None, None
+        return self.names[minID], minDistance
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
 import argparse
+import array
 import pysam
 import os
 import sys
+import shutil
+import tempfile
+import multiprocessing
 import sortedcontainers
 import collections
 import time
 import bisect
+import itertools
+import numpy as np
 from packaging import version
 from skbio.alignment import StripedSmithWaterman
 from pyfaidx import Fasta
@@ -18,10 +24,235 @@ matplotlib.use('Agg')
 import seaborn
 
 try:
+    import Barcodes
     import DellingrExceptions as pe
 except ImportError:  # Check if Dellingr is installed
+    from Dellingr import Barcodes
     from Dellingr import DellingrExceptions as pe
 
+# The bases considered when generating a consensus, in the order they are considered (so ties are broken identically)
+CONSENSUS_BASES = "ACTG-N"
+DELETION_CODE = CONSENSUS_BASES.index("-")
+SOFT_CLIPPED_CODES = tuple(i for i, x in enumerate(CONSENSUS_BASES) if x != "-")
+# Converts the ASCII value of each base into its index in CONSENSUS_BASES. Any other character is invalid
+INVALID_CODE = len(CONSENSUS_BASES)
+CONSENSUS_CODES = np.full(256, INVALID_CODE, dtype=np.int8)
+for i, base in enumerate(CONSENSUS_BASES):
+    CONSENSUS_CODES[ord(base)] = i
+del i, base
+# Smaller families are faster to process one base at a time, as building the matrix has a fixed cost
+MIN_MATRIX_READS = 8
+# When collapsing in parallel, shards are only split at least this many bases away from each target, so the read pairs
+# of a family (which all start at the same position) are collapsed by the same shard
+SHARD_MARGIN = 1000
+# The number of shards created for each thread when collapsing in parallel. More shards than threads are created, so
+# a thread which finishes a small shard can start another
+SHARDS_PER_THREAD = 4
+
+
+class ReadMatrix:
+    """
+    The reads of a family, expanded (using their cigars) into a (reads x columns) matrix
+
+    Each column contains the bases (or deletions) of each read which line up when generating a consensus (see
+    Family._consensusByRead()). Insertions are not stored in the matrix. Instead, the column following an insertion is
+    flagged, so it can be processed one base at a time. Reads which have ended are marked with a cigar operator of -1
+    """
+
+    def __init__(self, sequences, qualities, cigars):
+        """
+        :param sequences: A list of strings containing the sequence of each read
+        :param qualities: A list containing the quality scores of each read
+        :param cigars: A list containing the cigar list of each read
+        """
+        self.cigars = cigars
+        seqNumber = len(cigars)
+        self.cigarLengths = np.asarray(list(len(x) for x in cigars), dtype=np.int64)
+
+        # Convert the bases and quality scores of all reads into (concatenated) arrays
+        self.readCodes = CONSENSUS_CODES[np.frombuffer("".join(sequences).encode("latin-1"), dtype=np.uint8)]
+        readQuals = list(self._qualArray(x) for x in qualities)
+        self.readQuals = np.concatenate(readQuals + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        seqLengths = np.asarray(list(len(x) for x in sequences), dtype=np.int64)
+        qualLengths = np.asarray(list(len(x) for x in readQuals), dtype=np.int64)
+        self.codeStarts = np.cumsum(seqLengths) - seqLengths
+        self.qualStarts = np.cumsum(qualLengths) - qualLengths
+        self.available = np.minimum(seqLengths, qualLengths)  # The number of bases with a quality score in each read
+
+        self.width = 0
+        self.ops = np.zeros((seqNumber, 0), dtype=np.int16)  # The cigar operator of each base
+        self.codes = np.zeros((seqNumber, 0), dtype=np.int8)  # The index of each base in CONSENSUS_BASES
+        self.quals = np.zeros((seqNumber, 0), dtype=np.int64)  # The quality score of each base
+        self.stop = np.zeros((seqNumber, 0), dtype=bool)  # Columns which must be processed one base at a time
+        self.startCigar = np.zeros((seqNumber, 0), dtype=np.int64)  # The cigar index of each read at each column
+        self.startBase = np.zeros((seqNumber, 0), dtype=np.int64)  # The sequence index of each read at each column
+        self.endCigar = [0] * seqNumber  # The cigar and sequence index of each read once it has ended
+        self.endBase = [0] * seqNumber
+        self._expandAll()
+
+    @staticmethod
+    def _qualArray(qualities):
+        """
+        :param qualities: The quality scores of a read (pysam stores these as an array.array)
+        :return: A one-dimensional numpy.ndarray
+        """
+        if isinstance(qualities, array.array) and qualities.typecode == "B":
+            return np.frombuffer(qualities, dtype=np.uint8)  # No need to copy
+        qualities = np.asarray(qualities, dtype=np.int64)
+        if qualities.ndim != 1:
+            raise TypeError("Quality scores must be a sequence")
+        return qualities
+
+    def _expandAll(self):
+        """
+        Expands every read into the matrix, starting from the first column
+
+        Equivalent to calling expand() on each read, but all reads are processed at once
+        """
+        seqNumber = len(self.cigars)
+        # Concatenate the cigars of all reads, and keep track of where each read starts
+        ops = np.fromiter(itertools.chain.from_iterable(self.cigars), dtype=np.int16, count=int(self.cigarLengths.sum()))
+        readOf = np.repeat(np.arange(seqNumber), self.cigarLengths)
+        readStarts = np.cumsum(self.cigarLengths) - self.cigarLengths
+
+        insertion = ops == 1
+        consumesBase = ops != 2  # Insertions consume bases, but deletions do not
+        consumed = np.cumsum(consumesBase)
+        readEnds = consumed[readStarts + self.cigarLengths - 1] if len(ops) > 0 else np.zeros(seqNumber, dtype=np.int64)
+        readBases = np.diff(np.concatenate(([0], np.maximum.accumulate(np.where(self.cigarLengths > 0, readEnds, 0)))))
+        baseAt = consumed - consumesBase - np.repeat(np.cumsum(readBases) - readBases, self.cigarLengths)
+
+        # Each column contains one operator which is not an insertion, preceded by any insertions
+        opPositions = np.flatnonzero(~insertion)
+        opReads = readOf[opPositions]
+        readColumns = np.bincount(opReads, minlength=seqNumber)
+        columnOf = np.arange(len(opPositions)) - np.repeat(np.cumsum(readColumns) - readColumns, readColumns)
+        columnStarts = np.empty(len(opPositions), dtype=np.int64)
+        columnStarts[1:] = opPositions[:-1] + 1
+        firstColumn = columnOf == 0
+        columnStarts[firstColumn] = readStarts[opReads[firstColumn]]
+
+        # Obtain the base and quality score of each column
+        columnOps = ops[opPositions]
+        hasBase = consumesBase[opPositions]
+        positions = baseAt[opPositions]
+        inRead = hasBase & (positions < self.available[opReads])
+        codes = np.full(len(opPositions), INVALID_CODE, dtype=np.int8)
+        quals = np.zeros(len(opPositions), dtype=np.int64)
+        codes[inRead] = self.readCodes[(self.codeStarts[opReads] + positions)[inRead]]
+        quals[inRead] = self.readQuals[(self.qualStarts[opReads] + positions)[inRead]]
+        # Columns following an insertion, and bases which are missing or can not be counted, are left to
+        # Family._consensusByRead()
+        stop = (columnStarts != opPositions) | (hasBase & (codes == INVALID_CODE))
+        stop |= (columnOps == 4) & (codes == DELETION_CODE)
+
+        self.endCigar = self.cigarLengths.tolist()
+        self.endBase = readBases.tolist()
+        self._resize(int(readColumns.max(initial=0)) + 2)
+        cells = opReads * self.width + columnOf
+        self.ops.ravel()[cells] = columnOps
+        self.codes.ravel()[cells] = codes
+        self.quals.ravel()[cells] = quals
+        self.stop.ravel()[cells] = stop
+        self.startCigar.ravel()[cells] = columnStarts - readStarts[opReads]
+        self.startBase.ravel()[cells] = baseAt[columnStarts]
+        # If a read ends with an insertion (which is not a valid cigar), process it one base at a time
+        for i in range(0, seqNumber):
+            if self.cigarLengths[i] > 0 and self.cigars[i][-1] == 1:
+                self.stop[i, readColumns[i]] = True
+
+    def _resize(self, width):
+        """
+        Adds columns to the end of the matrix. The reads have ended in these columns
+
+        :param width: An int specifying the new number of columns
+        """
+        extra = width - self.width
+        if extra <= 0:
+            return
+        seqNumber = self.ops.shape[0]
+        self.ops = np.concatenate((self.ops, np.full((seqNumber, extra), -1, dtype=self.ops.dtype)), axis=1)
+        self.codes = np.concatenate((self.codes, np.full((seqNumber, extra), INVALID_CODE, dtype=self.codes.dtype)), axis=1)
+        self.quals = np.concatenate((self.quals, np.zeros((seqNumber, extra), dtype=self.quals.dtype)), axis=1)
+        self.stop = np.concatenate((self.stop, np.zeros((seqNumber, extra), dtype=bool)), axis=1)
+        endCigar = np.repeat(np.asarray(self.endCigar, dtype=np.int64).reshape(-1, 1), extra, axis=1)
+        endBase = np.repeat(np.asarray(self.endBase, dtype=np.int64).reshape(-1, 1), extra, axis=1)
+        self.startCigar = np.concatenate((self.startCigar, endCigar), axis=1)
+        self.startBase = np.concatenate((self.startBase, endBase), axis=1)
+        self.width = width
+
+    def expand(self, read, column, cigarIndex, baseIndex):
+        """
+        Expands a read into the matrix, starting at the specified column
+
+        :param read: An int specifying the index of the read
+        :param column: An int specifying the first column to fill
+        :param cigarIndex: An int specifying the position in the cigar of this read at that column
+        :param baseIndex: An int specifying the position in the sequence of this read at that column
+        """
+        ops = np.asarray(self.cigars[read][cigarIndex:], dtype=np.int16)
+        insertion = ops == 1
+        consumesBase = ops != 2  # Insertions consume bases, but deletions do not
+        baseAt = baseIndex + np.cumsum(consumesBase) - consumesBase  # The sequence index of each cigar operator
+        # Each column contains one operator which is not an insertion, preceded by any insertions
+        opPositions = np.flatnonzero(~insertion)
+        columnStarts = np.zeros(len(opPositions), dtype=np.intp)
+        columnStarts[1:] = opPositions[:-1] + 1
+        columns = len(opPositions)
+        # If the read ends with an insertion (which is not a valid cigar), process it one base at a time
+        trailingInsertion = len(ops) > 0 and insertion[-1]
+        self.endCigar[read] = cigarIndex + len(ops)
+        self.endBase[read] = baseIndex + int(np.count_nonzero(consumesBase))
+        self._resize(column + columns + 2)
+
+        # Obtain the base and quality score of each column
+        columnOps = ops[opPositions]
+        hasBase = consumesBase[opPositions]
+        positions = baseAt[opPositions]
+        inRead = hasBase & (positions < self.available[read])
+        codes = np.full(columns, INVALID_CODE, dtype=np.int8)
+        quals = np.zeros(columns, dtype=np.int64)
+        codes[inRead] = self.readCodes[self.codeStarts[read] + positions[inRead]]
+        quals[inRead] = self.readQuals[self.qualStarts[read] + positions[inRead]]
+        # Columns following an insertion, and bases which are missing or can not be counted, are left to
+        # Family._consensusByRead()
+        stop = (columnStarts != opPositions) | (hasBase & (codes == INVALID_CODE))
+        stop |= (columnOps == 4) & (codes == DELETION_CODE)
+
+        end = column + columns
+        self.ops[read, column:end] = columnOps
+        self.ops[read, end:] = -1
+        self.codes[read, column:end] = codes
+        self.codes[read, end:] = INVALID_CODE
+        self.quals[read, column:end] = quals
+        self.quals[read, end:] = 0
+        self.stop[read, column:end] = stop
+        self.stop[read, end:] = False
+        self.stop[read, end] = trailingInsertion
+        self.startCigar[read, column:end] = cigarIndex + columnStarts
+        self.startCigar[read, end:] = self.endCigar[read]
+        self.startBase[read, column:end] = baseAt[columnStarts]
+        self.startBase[read, end:] = self.endBase[read]
+
+    def sync(self, column, cigarIndex, baseIndex):
+        """
+        Re-expands any reads whose position does not match the matrix (ex. because an invalid insertion was converted
+        into soft-clipping)
+
+        :param column: An int specifying the index of the current column
+        :param cigarIndex: A list containing the current cigar position of each read
+        :param baseIndex: A list containing the current sequence position of each read
+        """
+        self._resize(column + 2)
+        cigarIndex = np.asarray(cigarIndex)
+        baseIndex = np.asarray(baseIndex)
+        present = self.ops[:, column] != -1
+        inSync = np.where(present, (cigarIndex == self.startCigar[:, column]) & (baseIndex == self.startBase[:, column]),
+                          cigarIndex >= self.cigarLengths)
+        for i in np.flatnonzero(~inSync).tolist():
+            self.expand(i, column, int(cigarIndex[i]), int(baseIndex[i]))
+
+
 class Family:
     """
     Stores various statistics relating to a given read pair
@@ -55,6 +286,7 @@ class Family:
 
         # Obtain the family name for this read pair
         self.invalidBarcode = False
+        self.unsupportedBarcode = False
         try:
             if readSeqBarcode:
                 # We need to use the sequence of each read as the barcode
@@ -62,14 +294,22 @@ class Family:
                 # We need to divide the barcode length in half, since we are obtaining half of the barcode from each read
                 r1Barcode = R1.query_sequence[:barcodeLength]
                 r2Barcode = R2.query_sequence[-1 * barcodeLength:]
-                self.familyName = r1Barcode + r2Barcode
+                familyName = r1Barcode + r2Barcode
             else:
-                self.familyName = R1.get_tag("OX")
-                if len(self.familyName) != barcodeLength:
-                    raise TypeError("The read pair barcode \'%s\' for pair \'%s\' is not compatible with the specified mask" % (self.familyName, R1.query_name))
+                familyName = R1.get_tag("OX")
+                if len(familyName) != barcodeLength:
+                    raise TypeError("The read pair barcode \'%s\' for pair \'%s\' is not compatible with the specified mask" % (familyName, R1.query_name))
+            # Store the barcode as a packed int, which uses less memory than a string, and is much faster to compare
+            self.familyName = Barcodes.packBarcode(familyName)
         except KeyError:
             self.familyName = None
             self.invalidBarcode = True
+        except ValueError:
+            # The barcode contains something other than A, C, G, T or N, which can't be packed. Since it can't be
+            # compared to other barcodes, don't process this read pair
+            self.familyName = None
+            self.invalidBarcode = True
+            self.unsupportedBarcode = True
 
         # Do these families map to different chromosomes?
         self.isSplit = R1.reference_name != R2.reference_name
@@ -347,8 +587,25 @@ class Family:
         startOffset = 0
         refLength = 0  # The change in the number of reference positions consumed by this read relative to read1
 
+        # Columns which do not contain insertions can be processed all at once, using arrays
+        readMatrix = None
+        if len(cigars) >= MIN_MATRIX_READS:
+            try:
+                readMatrix = ReadMatrix(sequences, qualities, cigars)
+            except (AttributeError, TypeError, ValueError):
+                readMatrix = None
+        column = 0
+
         # Lets start processing the sequence
         while True:
+            if readMatrix is not None:
+                finished, softClippedStart, softClippedEnd, startOffset, refLength, column = self._consensusColumns(
+                    readMatrix, column, cigarIndex, baseIndex, consensusSeq, consensusQual, consensusCigar,
+                    softClippedStart, softClippedEnd, startOffset, refLength, reverseClip)
+                if finished:
+                    break
+                # Otherwise, the next column contains an insertion (or something unusual), so process it one base at
+                # a time
             qualSum = {"A": 0, "C": 0, "T": 0, "G": 0, "-": 0, "N": 0}
             qualMax = {"A": 0, "C": 0, "T": 0, "G": 0, "-": 0, "N": 0}
             insertion = []  # This data structure will store {Base: (count, maxqual, qualSum)}
@@ -525,6 +782,7 @@ class Family:
             else:
                 consensusCigar.append(2)
             refLength += 1
+            column += 1
 
         # To handle the extremely rare cases which may cause a consensus read to start or end with a indel
         # Remove such events from the start or end of the read
@@ -572,6 +830,134 @@ class Family:
 
         return "".join(consensusSeq), consensusQual, consensusCigar, startOffset
 
+    @staticmethod
+    def _majorityBase(baseCounts, qualSum, bases):
+        """
+        Identifies the most frequent base in each column. In the case of a tie, the base with the highest aggregate
+        quality score is used (and if that is a tie, the first base considered)
+
+        :param baseCounts: A numpy.ndarray of shape (len(CONSENSUS_BASES), columns) listing the count of each base
+        :param qualSum: A numpy.ndarray of the same shape listing the aggregate quality score of each base
+        :param bases: A list of base indexes to consider
+        :return: A numpy.ndarray listing the index of the consensus base in each column (-1 = No base was chosen)
+        """
+        maxBase = np.full(baseCounts.shape[1], -1, dtype=np.intp)
+        maxBaseCount = np.zeros(baseCounts.shape[1], dtype=baseCounts.dtype)
+        maxQual = np.zeros(baseCounts.shape[1], dtype=qualSum.dtype)
+        for base in bases:
+            better = (baseCounts[base] > maxBaseCount) | ((baseCounts[base] == maxBaseCount) & (maxQual < qualSum[base]))
+            maxBase[better] = base
+            maxBaseCount[better] = baseCounts[base][better]
+            maxQual[better] = qualSum[base][better]
+        return maxBase
+
+    def _consensusColumns(self, readMatrix, column, cigarIndex, baseIndex, consensusSeq, consensusQual, consensusCigar,
+                          softClippedStart, softClippedEnd, startOffset, refLength, reverseClip):
+        """
+        Generates the consensus of all columns up to the next column which contains an insertion
+
+        The consensus of each column is calculated using array reductions over the read matrix. The result is identical
+        to processing each column one at a time in _consensusByRead(). Columns which can not be processed this way (i.e.
+        they contain an insertion, or a base or quality score is missing) are left to _consensusByRead()
+
+        :param readMatrix: A ReadMatrix containing the reads of this family
+        :param column: An int specifying the index of the next column
+        :param cigarIndex: A list containing the current cigar position of each read. Updated in place
+        :param baseIndex: A list containing the current sequence position of each read. Updated in place
+        :param consensusSeq: A list of consensus bases. Updated in place
+        :param consensusQual: A list of consensus quality scores. Updated in place
+        :param consensusCigar: A list of consensus cigar operators. Updated in place
+        :param softClippedStart: A boolean indicating if the consensus is within leading soft-clipping
+        :param softClippedEnd: A boolean indicating if the consensus is within trailing soft-clipping
+        :param startOffset: An int containing the change in the start position of the consensus
+        :param refLength: An int containing the number of reference positions consumed by the consensus
+        :param reverseClip: A boolean indicating if the read is mapped to the reverse strand
+        :return: A tuple containing a boolean indicating if the end of the consensus was reached, the updated
+                softClippedStart, softClippedEnd, startOffset and refLength, and the index of the next column
+        """
+
+        # If a read was modified while processing the previous column, re-expand it
+        readMatrix.sync(column, cigarIndex, baseIndex)
+
+        # How many columns can be processed before a column which contains an insertion?
+        stops = np.flatnonzero(readMatrix.stop[:, column:].any(axis=0))
+        end = column + stops[0] if len(stops) > 0 else readMatrix.width
+        if end == column:
+            return False, softClippedStart, softClippedEnd, startOffset, refLength, column
+        columns = end - column
+        ops = readMatrix.ops[:, column:end]
+        codes = readMatrix.codes[:, column:end]
+        present = ops != -1
+        deletion = ops == 2
+        softClipped = ops == 4
+        hasBase = present & ~deletion
+        normal = hasBase & ~softClipped
+
+        # Count each base in each column
+        normBaseCount = np.zeros((len(CONSENSUS_BASES), columns), dtype=np.int64)
+        softClippedBaseCount = np.zeros((len(CONSENSUS_BASES), columns), dtype=np.int64)
+        qualSum = np.zeros((len(CONSENSUS_BASES), columns), dtype=np.int64)
+        qualMax = np.zeros((len(CONSENSUS_BASES), columns), dtype=np.int64)
+        for base in range(0, len(CONSENSUS_BASES)):
+            isBase = codes == base
+            normBaseCount[base] = np.count_nonzero(isBase & normal, axis=0)
+            softClippedBaseCount[base] = np.count_nonzero(isBase & softClipped, axis=0)
+            baseQuals = np.where(isBase & hasBase, readMatrix.quals[:, column:end], 0)
+            qualSum[base] = baseQuals.sum(axis=0)
+            qualMax[base] = baseQuals.max(axis=0)
+        normBaseCount[DELETION_CODE] += np.count_nonzero(deletion, axis=0)
+        normBase = self._majorityBase(normBaseCount, qualSum, range(0, len(CONSENSUS_BASES))).tolist()
+        softClippedBase = self._majorityBase(softClippedBaseCount, qualSum, SOFT_CLIPPED_CODES).tolist()
+        seqCollapsed = np.count_nonzero(present, axis=0).tolist()
+        softClippedNum = np.count_nonzero(softClipped, axis=0).tolist()
+        qualMax = qualMax.tolist()
+
+        # Whether a column is soft-clipped depends upon the previous columns, so this is done one column at a time
+        seqNumber = readMatrix.ops.shape[0]
+        finished = False
+        processed = 0
+        for i in range(0, columns):
+            if seqCollapsed[i] / seqNumber < 0.5:
+                finished = True
+                break
+            clippedStart = softClippedStart
+            clippedEnd = softClippedEnd
+            if clippedStart and softClippedNum[i] / seqCollapsed[i] <= 0.5:
+                clippedStart = False
+            elif not clippedStart and not clippedEnd and softClippedNum[i] / seqCollapsed[i] > 0.5:
+                clippedEnd = True
+
+            if clippedStart or clippedEnd:
+                maxBase = softClippedBase[i]
+                maxCigOp = 4
+            else:
+                maxBase = normBase[i]
+                maxCigOp = 2 if maxBase == DELETION_CODE else 0
+            if maxBase == -1:  # No consensus base could be chosen. Leave this column to _consensusByRead()
+                break
+
+            softClippedStart = clippedStart
+            softClippedEnd = clippedEnd
+            if maxCigOp == 4 and ((softClippedStart and not reverseClip) or (softClippedEnd and reverseClip)):
+                startOffset += 1
+            if maxCigOp != 2:
+                consensusSeq.append(CONSENSUS_BASES[maxBase])
+                consensusQual.append(qualMax[maxBase][i])
+                consensusCigar.append(maxCigOp)
+            else:
+                consensusCigar.append(2)
+            refLength += 1
+            processed += 1
+
+        # Move each read past the processed columns
+        if processed > 0 and not finished:
+            column += processed
+            for i in np.flatnonzero(present[:, 0]).tolist():
+                cigarIndex[i] = int(readMatrix.startCigar[i, column])
+                baseIndex[i] = int(readMatrix.startBase[i, column])
+
+        return finished, softClippedStart, softClippedEnd, startOffset, refLength, column
+
     def listToCigar(self, cigar):
         """
         Converts a list of cigar operators into a pysam-style cigar sequence
@@ -719,110 +1105,55 @@ class Position:
         # time to do what we all came here to do
 
         # Lets, collapse the (+) strand families first
-        # Obtain a list of all adapter sequences which occur at this position, along with how frequently that
-        # barcode occurs
-
-        barcodesInFamilies = collections.OrderedDict()  # Store the base barcode of the family, as well as all barcodes which should be collapsed into that family
-        barcodesByFrequency = sortedcontainers.SortedListWithKey(list(self.plusFamilies.keys()),
-                                                                 key=lambda x: self.plusFamilies[x].size)
-        for barcode in reversed(barcodesByFrequency):
-
-            # If adaptersInFamily is empty, then no barcodes have been processed as of yet
-            # Since the first barcode returned is the largest, we'll consider that the name of the first family
-            # Since it almost certain that it would end up as the family name anyways
-            if len(barcodesInFamilies) == 0:
-                barcodesInFamilies[barcode] = [barcode]
-                continue
-
-            # Consider only the specified indexes
-            cBarcode = list(barcode[x] for x in collapseIndices)
-            # Next, calculate the distance between the current barcode and any existing barcode family
-            minBarcode = None
-            minDistance = 10000
-            for familyName in barcodesInFamilies.keys():
-                distance = 0
-                cFamilyName = list(familyName[x] for x in collapseIndices)
-                for b1, b2 in zip(cFamilyName, cBarcode):
-                    # Don't count bases which are "N"s as distance between barcodes
-                    if b1 != b2 and b1 != "N" and b2 != "N":
-                        distance += 1
-                if distance < minDistance:
-                    # In the case of a tie, the largest family will be taken
-                    minDistance = distance
-                    minBarcode = familyName
-
-            # Next, check if the distance between this barcode and the nearest barcode is within threshold
-            # If so, we can consider them as derrived from the same parental molecule, and group them
-            if minDistance <= collapseThreshold:
-                barcodesInFamilies[minBarcode].append(barcode)
-            # Otherwise, a new family needs to be constructed for this barcode, as it is too distant from any existing
-            # barcodes
-            else:
-                barcodesInFamilies[barcode] = [barcode]
-
-        # Now that each barcode has been assigned to a family, we need to actually
-        # do the deed, and collapse all read pairs in a given family
-        tmpPlusFamilies = {}
-        for familyName, members in barcodesInFamilies.items():
-            # Choose the first read pair encounter as the "template", to which all
-            # other read pairs that need to be collapsed will be added
-            consensusPair = None
-            for member in members:
+        # Don't count bases which are "N"s as distance between (+) strand barcodes
+        self.plusFamilies = self._collapseFamilies(self.plusFamilies, collapseIndices, collapseThreshold, wildcard=True)
+        # Now repeat everything for (-) strand families
+        self.negFamilies = self._collapseFamilies(self.negFamilies, collapseIndices, collapseThreshold)
 
-                if consensusPair is None:
-                    consensusPair = self.plusFamilies[member]
-                    continue
-                consensusPair.add(self.plusFamilies[member])
+    @staticmethod
+    def _collapseFamilies(families, collapseIndices, collapseThreshold, wildcard=False):
+        """
+        Groups the families from one parental strand whose barcodes are within the specified distance, and merges each
+        group into a consensus
 
-            # Finally, collapse the consensus read into an actual consensus
-            consensusPair.consensus()
-            tmpPlusFamilies[familyName] = consensusPair
+        Barcodes are processed from the largest family to the smallest. Each barcode is added to the closest existing
+        family (or the largest, in the case of a tie). If no family is within collapseThreshold, it becomes a new family
 
-        # Finally, to save memory, delete families which were collapsed into the consensus families
-        self.plusFamilies = tmpPlusFamilies
+        :param families: A dictionary listing {packed barcode: Family}
+        :param collapseIndices: A list of ints specifying which barcode positions are compared
+        :param collapseThreshold: An int specifying the maximum number of mismatches between barcodes in the same family
+        :param wildcard: A boolean. If True, "N"s are not counted as mismatches
+        :return: A dictionary listing {packed family name: consensus Family}
+        """
 
-        # Now repeat everything for (-) strand families
         # Obtain a list of all adapter sequences which occur at this position, along with how frequently that
         # barcode occurs
         barcodesInFamilies = collections.OrderedDict()  # Store the base barcode of the family, as well as all barcodes which should be collapsed into that family
-        barcodesByFrequency = sortedcontainers.SortedListWithKey(list(self.negFamilies.keys()),
-                                                                 key=lambda x: self.negFamilies[x].size)
+        barcodesByFrequency = sortedcontainers.SortedListWithKey(list(families.keys()),
+                                                                 key=lambda x: families[x].size)
+        # Only compare each barcode against families which could be within the threshold, instead of every family
+        familyIndex = Barcodes.BarcodeIndex(collapseIndices, collapseThreshold, wildcard)
         for barcode in reversed(barcodesByFrequency):
 
-            # If adaptersInFamily is empty, then no barcodes have been processed as of yet
-            # Since the first barcode returned is the largest, we'll consider thta the name of the first family
-            # Since it almost certain that it would end up as the family name anyways
-            if len(barcodesInFamilies) == 0:
-                barcodesInFamilies[barcode] = [barcode]
-                continue
-
-            cBarcode = list(barcode[x] for x in collapseIndices)
-            # Next, calculate the distance between the current barcode and any existing barcode family
-            minBarcode = None
-            minDistance = 10000
-            for familyName in barcodesInFamilies.keys():
-                distance = 0
-                cFamilyName = list(familyName[x] for x in collapseIndices)
-                for b1, b2 in zip(cFamilyName, cBarcode):
-                    if b1 != b2:
-                        distance += 1
-                if distance < minDistance:
-                    # In the case of a tie, the most largest family will be taken
-                    minDistance = distance
-                    minBarcode = familyName
+            # Calculate the distance between the current barcode and the nearest existing barcode family
+            # Since families are added from largest to smallest, in the case of a tie, the largest family will be taken
+            # If no barcodes have been processed as of yet, this is the largest barcode. We'll consider that the name of
+            # the first family, since it almost certain that it would end up as the family name anyways
+            familyName, distance = familyIndex.nearest(barcode)
 
             # Next, check if the distance between this barcode and the nearest barcode is within threshold
             # If so, we can consider them as derrived from the same parental molecule, and group them
-            if minDistance <= collapseThreshold:
-                barcodesInFamilies[minBarcode].append(barcode)
+            if familyName is not None:
+                barcodesInFamilies[familyName].append(barcode)
             # Otherwise, a new family needs to be constructed for this barcode, as it is too distant from any existing
             # barcodes
             else:
                 barcodesInFamilies[barcode] = [barcode]
+                familyIndex.add(barcode)
 
         # Now that each barcode has been assigned to a family, we need to actually
         # do the deed, and collapse all read pairs in a given family
-        tmpNegFamilies = {}
+        collapsedFamilies = {}
         for familyName, members in barcodesInFamilies.items():
             # Choose the first read pair encounter as the "template", to which all
             # other read pairs that need to be collapsed will be added
@@ -830,14 +1161,16 @@ class Position:
             for member in members:
 
                 if consensusPair is None:
-                    consensusPair = self.negFamilies[member]
+                    consensusPair = families[member]
                     continue
-                consensusPair.add(self.negFamilies[member])
+                consensusPair.add(families[member])
 
             # Finally, collapse the consensus read into an actual consensus
             consensusPair.consensus()
-            tmpNegFamilies[familyName] = consensusPair
-        self.negFamilies = tmpNegFamilies
+            collapsedFamilies[familyName] = consensusPair
+
+        # To save memory, families which were collapsed into the consensus families are discarded
+        return collapsedFamilies
 
     def markDuplexes(self, duplexIndices, duplexDistance=2, collapseDuplex=False):
         """
@@ -846,6 +1179,12 @@ class Position:
         """
 
         global counter
+        # Index the (+) strand families, so each (-) strand family is only compared against (+) strand families which
+        # could be within the mismatch threshold
+        plusIndex = Barcodes.BarcodeIndex(duplexIndices, duplexDistance)
+        for familyName, readPair in self.plusFamilies.items():
+            plusIndex.add(familyName, size=readPair.size)
+
         # Here we are simply going to examine each family which originates from a (-) strand molecule
         # and try to find a coresponding (+) strand family
         processedPlusFamilies = {}
@@ -855,46 +1194,31 @@ class Position:
             # This was not necessary for collapsing, since all molecules derrived from the same parental strand had the adapter
             # Sequences in the same orientation, but since we are now comparing between (+) and (-) strand families, this
             # will need to occur
-            lKey = len(key)
-            adapter = key[int(lKey / 2):] + key[:int(lKey / 2)]
+            lKey = Barcodes.barcodeLength(key)
+            adapter = Barcodes.rotateBarcode(key, lKey)
+            adapterSequence = Barcodes.unpackBarcode(adapter)
 
             # Assign this family a unique name. If a (+) strand family is in duplex, it will be assigned a complementary name later
-            name = adapter + ":-:" + str(readPair.size) + ":" + str(counter)
+            name = adapterSequence + ":-:" + str(readPair.size) + ":" + str(counter)
             readPair.name = name
 
             # If there are no families which originate from the (+) parental strand, just assign the current (-) strand families
             # a unique name
             if len(self.plusFamilies) == 0:
-                counter += 1
+                counter += counterIncrement
                 continue
 
             # Otherwise, we need to determine if any of families which originate from the parental (+) strand could originate from the
             # same parental molecule, using the adapter sequence
-            # First, calculate the distance between the (-) strand family, and all possible (+) strand families, and find the (+) strand family
-            # which is closest
-            dKey = tuple(adapter[x] for x in duplexIndices)
-            minDist = 100000
-            minAdapter = None
-            minSize = 0
-            for familyName in self.plusFamilies:
-                # Calculate the distance between these two family names
-                dFamilyName = tuple(familyName[x] for x in duplexIndices)
-                distance = 0
-                for base1, base2 in zip(dKey, dFamilyName):
-                    if base1 != base2:
-                        distance += 1
-
-                # If this family is closer than the current closest family, replace it
-                # If there is a tie, use the largest family size (and if that is a tie, take the first one that is encountered)
-                if distance < minDist or (distance == minDist and self.plusFamilies[familyName].size > minSize):
-                    minDist = distance
-                    minAdapter = familyName
-                    minSize = self.plusFamilies[familyName].size
+            # Find the closest (+) strand family within the specified mismatch threshold
+            # If there is a tie, use the largest family size (and if that is a tie, take the first one that is encountered)
+            minAdapter, minDist = plusIndex.nearest(adapter)
 
             # If the (-) strand family and closest (+) strand family are within the specified mismatch threshold, they are considered to be
             # in duplex
-            if minDist <= duplexDistance:
+            if minAdapter is not None:
                 duplexPair = self.plusFamilies.pop(minAdapter)
+                plusIndex.remove(minAdapter)
                 readPair.inDuplex = True
                 # Are we flagging duplexes, or collapsing them?
                 if collapseDuplex:
@@ -903,7 +1227,7 @@ class Position:
                 else:
                     # In this case, ensure that the names of the families are given a complimentary names
                     # so they can be identified as in duplex
-                    duplexPair.name = adapter + ":+:" + str(duplexPair.size) + ":" + str(counter)
+                    duplexPair.name = adapterSequence + ":+:" + str(duplexPair.size) + ":" + str(counter)
                     processedPlusFamilies[minAdapter] = duplexPair
                     duplexPair.inDuplex = True
 
@@ -925,7 +1249,7 @@ class Position:
                         else:  # In the case of a tie, it doesn't really matter which one is flagged a duplicate
                             readPair.R1.is_duplicate = True
                             readPair.R2.is_duplicate = True
-            counter += 1
+            counter += counterIncrement
 
         # We have finished processing all the families which originate from the (+) parental strand
         # Any (+) families remaining must be derived from unique molecules, as they were not paired with a (-) family
@@ -933,9 +1257,9 @@ class Position:
         # In this case, just assign each an apropriate name
         for adapter in list(self.plusFamilies.keys()):
             readPair = self.plusFamilies.pop(adapter)
-            readPair.name = adapter + ":+:" + str(readPair.size) + ":" + str(counter)
+            readPair.name = Barcodes.unpackBarcode(adapter) + ":+:" + str(readPair.size) + ":" + str(counter)
             processedPlusFamilies[adapter] = readPair
-            counter += 1
+            counter += counterIncrement
         self.plusFamilies = processedPlusFamilies
 
 
@@ -946,8 +1270,17 @@ class FamilyCoordinator:
 
     def __init__(self, inputFile, reference, familyIndices, familyThreshold, duplexIndices, duplexThreshold,
                  barcodeLength, targets=None, tagOrig = False, baseBuffer=400, padding=10, noBarcodes=False,
-                 mergeDuplex = False, printPrefix="DELLINGR-COLLAPSE"):
+                 mergeDuplex = False, printPrefix="DELLINGR-COLLAPSE", shard=None, counterStart=0, counterStep=1):
+        """
+        :param shard: A tuple generated by shardRegions(), listing a contig and the region of that contig in this
+                    shard. If specified, only reads within this region are collapsed (using the index of the input
+                    file), and status messages are not printed (see collapseShard())
+        :param counterStart: An int specifying the number assigned to the first family. Used to give the families of
+                    each shard unique names
+        :param counterStep: An int specifying the difference between the numbers assigned to consecutive families
+        """
         self.inFile = inputFile
+        self.shard = shard
         self.tagOrig = tagOrig
 
         # Read classification counters
@@ -957,6 +1290,7 @@ class FamilyCoordinator:
         self.malformedCigar = 0
         self.failedQC = 0
         self.missingBarcode = 0
+        self.unsupportedBarcode = 0  # Barcodes containing something other than A, C, G, T or N
         self.outsideCaptureSpace = 0
 
         # Do we need to leading sequence of the read pair as a "barcode"?
@@ -1001,7 +1335,13 @@ class FamilyCoordinator:
         self._previousChr = None
         self._baseBuffer = baseBuffer
         global counter
-        counter = 0
+        counter = counterStart
+        global counterIncrement
+        counterIncrement = counterStep
+        self.counterStart = counterStart
+        self.counterStep = counterStep
+        self.shardFamilies = 0  # The number of families collapsed by shards which have been merged into this object
+        self.mergedShards = 0
 
         self.printPrefix = printPrefix
 
@@ -1101,11 +1441,15 @@ class FamilyCoordinator:
 
     def __iter__(self):
 
-        sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'), "Starting...\n"]))
         global counter
+        if self.shard is None:
+            sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'), "Starting...\n"]))
+            reads = self.inFile
+        else:
+            reads = self._shardReads()
         try:
             while True:
-                read = next(self.inFile)
+                read = next(reads)
 
                 # Discard supplementary and secondary alignments
                 if read.is_supplementary or read.is_secondary:
@@ -1196,7 +1540,11 @@ class FamilyCoordinator:
 
                 # Is this read pair missing a barcode tag? If so, we can't process it, as we
                 # won't be able to find out which family it belongs to
-                if pair.invalidBarcode:
+                if pair.unsupportedBarcode:
+                    self.unsupportedBarcode += 1
+                    self.readCounter -= 2
+                    continue
+                elif pair.invalidBarcode:
                     self.missingBarcode += 1
                     self.readCounter -= 2
                     continue
@@ -1225,10 +1573,10 @@ class FamilyCoordinator:
 
                 self.pairCounter += 1
 
-                if self.pairCounter % 100000 == 0:
+                if self.pairCounter % 100000 == 0 and self.shard is None:
                     sys.stderr.write(
                         "\t".join(
-                            [self.printPrefix, time.strftime('%X'), "Collapsed " + str(self.pairCounter) + " pairs into " + str(counter) + " families" + os.linesep]))
+                            [self.printPrefix, time.strftime('%X'), "Collapsed " + str(self.pairCounter) + " pairs into " + str(self.collapsedFamilies()) + " families" + os.linesep]))
 
                 # Store this read pair until we obtain all read pairs that overlap this position
                 # If this is the first time we are seeing a read pair at this position,
@@ -1273,21 +1621,174 @@ class FamilyCoordinator:
                         yield readPair.R1
                         yield readPair.R2
 
+            # Read pairs which map to different contigs are discarded (see above). When the input is sharded, each mate
+            # is counted by a different shard, and is never paired, so remove them here instead
+            if self.shard is not None:
+                self.readCounter -= sum(1 for read in self._waitingForMate.values()
+                                        if read.next_reference_id >= 0 and read.next_reference_id != read.reference_id)
+
             # Print out a status (or error) message, briefly summarizing the overall collapse
-            if self.missingBarcode > 0 and self.familyCounter == 0:
-                sys.stderr.write("ERROR: Unable to find a \'OX\' tag, which contains the degenerate barcode, for any read in the input BAM file" + os.linesep)
+            # If this is a shard, this is done once all shards have been merged
+            if self.shard is None:
+                self.printSummary()
+
+    def printSummary(self):
+        """
+        Prints out a status (or error) message, briefly summarizing the overall collapse
+        """
+        if self.missingBarcode > 0 and self.familyCounter == 0:
+            sys.stderr.write("ERROR: Unable to find a \'OX\' tag, which contains the degenerate barcode, for any read in the input BAM file" + os.linesep)
+            sys.stderr.write(
+                "Check that BWA was run using the \'-C\' option" + os.linesep)
+            exit(1)
+
+        elif self.unsupportedBarcode > 0 and self.familyCounter == 0:
+            sys.stderr.write("ERROR: The barcode of every read pair contains bases other than A, C, G, T or N" + os.linesep)
+            exit(1)
+
+        elif self.readCounter == 0:
+            sys.stderr.write("ERROR: The input BAM file is empty!" + os.linesep)
+            exit(1)
+        else:
+            if self.unsupportedBarcode > 0:
+                sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'), "WARNING: Skipped " + str(self.unsupportedBarcode) + " read pairs with barcodes containing bases other than A, C, G, T or N" + os.linesep]))
+            # When collapsing in parallel, the progress of each shard is printed instead
+            if self.pairCounter % 100000 != 0 or self.mergedShards > 0:
                 sys.stderr.write(
-                    "Check that BWA was run using the \'-C\' option" + os.linesep)
-                exit(1)
+                "\t".join([self.printPrefix, time.strftime('%X'), "Collapsed " + str(self.pairCounter) + " pairs into " + str(self.collapsedFamilies()) + " families" + os.linesep]))
+            sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'), "Collapse Complete\n"]))
 
-            elif self.readCounter == 0:
-                sys.stderr.write("ERROR: The input BAM file is empty!" + os.linesep)
-                exit(1)
-            else:
-                if self.pairCounter % 100000 != 0:
-                    sys.stderr.write(
-                    "\t".join([self.printPrefix, time.strftime('%X'), "Collapsed " + str(self.pairCounter) + " pairs into " + str(counter) + " families" + os.linesep]))
-                sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'), "Collapse Complete\n"]))
+    def collapsedFamilies(self):
+        """
+        :return: The number of families which have been collapsed (and named) so far, including those of merged shards
+        """
+        return (counter - self.counterStart) // self.counterStep + self.shardFamilies
+
+    def shardRegions(self, shardCount, margin=SHARD_MARGIN):
+        """
+        Splits the input file into shards, which can be collapsed independently (and in parallel)
+
+        If targets were specified, the targets on each contig (plus "margin" bases on either side) are merged into
+        windows, and consecutive windows are grouped into shards of roughly the same size. Each contig is split
+        half-way between the last window of one shard and the first window of the next, so every read on the contig
+        falls into exactly one shard. Otherwise, each contig is a shard. Contigs which do not contain any targets are
+        skipped, as none of their read pairs fall within the capture space. Read pairs whose mates fall into different
+        shards are collapsed by the shard containing the first mate (see _shardReads())
+
+        :param shardCount: An int specifying the approximate number of shards to create, if targets were specified
+        :param margin: An int specifying the number of bases on either side of each target to include in its window
+        :return: A list of tuples containing (contig, start of the shard, end of the shard)
+        """
+
+        contigs = list(zip(self.inFile.references, self.inFile.lengths))
+        # Skip contigs which do not contain any reads
+        try:
+            readContigs = set(x.contig for x in self.inFile.get_index_statistics() if x.total > 0)
+            contigs = list(x for x in contigs if x[0] in readContigs)
+        except (AttributeError, ValueError):  # i.e. The index does not list the number of reads on each contig (ex. CRAM)
+            pass
+
+        if not self.targets:
+            return list((contig, 0, length) for contig, length in contigs)
+
+        # Merge targets whose windows overlap
+        windows = []
+        for contig, length in contigs:
+            if contig not in self.targets:
+                continue
+            locations = self.targets[contig]
+            contigWindows = []
+            for start, end in sorted(zip(locations[0::2], locations[1::2])):
+                start = max(0, start - margin)
+                end = min(length, end + margin)
+                if contigWindows and start <= contigWindows[-1][1]:
+                    contigWindows[-1][1] = max(contigWindows[-1][1], end)
+                else:
+                    contigWindows.append([start, end])
+            windows.append((contig, length, contigWindows))
+
+        # Group consecutive windows into shards. Shards never span multiple contigs
+        totalBases = sum(end - start for contig, length, contigWindows in windows for start, end in contigWindows)
+        shardBases = max(1, totalBases // shardCount)
+        shards = []
+        for contig, length, contigWindows in windows:
+            shardStart = 0
+            shardSize = 0
+            for i in range(0, len(contigWindows) - 1):
+                shardSize += contigWindows[i][1] - contigWindows[i][0]
+                if shardSize >= shardBases:
+                    # Split the contig between this window and the next
+                    shardEnd = (contigWindows[i][1] + contigWindows[i + 1][0]) // 2
+                    shards.append((contig, shardStart, shardEnd))
+                    shardStart = shardEnd
+                    shardSize = 0
+            shards.append((contig, shardStart, length))
+        return shards
+
+    def _shardReads(self):
+        """
+        Obtains the reads which start within this shard, using the index of the input file
+
+        If the mates of a read pair fall into different shards, the pair is collapsed by the shard containing the first
+        mate. Once all reads in this shard have been returned, the mates of any read pairs which extend into a
+        subsequent shard are fetched, so that these read pairs are collapsed exactly as they would be if the input file
+        was not sharded
+
+        :return: Yields pysam.AlignedSegment() objects, in coordinate order
+        """
+        contig, shardStart, shardEnd = self.shard
+        for read in self.inFile.fetch(contig, shardStart, shardEnd):
+            # Does this read start in the previous shard?
+            if read.reference_start < shardStart:
+                continue
+            # Is this read's mate in a previous shard? If so, that shard collapses this read pair
+            if read.next_reference_id == read.reference_id and read.next_reference_start < shardStart:
+                continue
+            yield read
+
+        # Find the mates of reads which are still waiting for them, and which fall into a subsequent shard
+        tid = self.inFile.get_tid(contig)
+        mateStarts = {}
+        for name, read in self._waitingForMate.items():
+            if read.next_reference_id == tid and read.next_reference_start >= shardEnd:
+                if read.next_reference_start not in mateStarts:
+                    mateStarts[read.next_reference_start] = set()
+                mateStarts[read.next_reference_start].add(name)
+        # Return these mates in the same order as they appear in the input file
+        for mateStart in sorted(mateStarts):
+            names = mateStarts[mateStart]
+            for read in self.inFile.fetch(contig, mateStart, mateStart + 1):
+                if read.reference_start != mateStart or read.query_name not in names:
+                    continue
+                if read.is_supplementary or read.is_secondary:
+                    continue
+                names.discard(read.query_name)
+                yield read
+
+    def shardStats(self):
+        """
+        :return: A dictionary containing the read classification counters and family size distributions of this shard
+        """
+        return {"readCounter": self.readCounter, "pairCounter": self.pairCounter, "familyCounter": self.familyCounter,
+                "malformedCigar": self.malformedCigar, "failedQC": self.failedQC,
+                "missingBarcode": self.missingBarcode, "unsupportedBarcode": self.unsupportedBarcode,
+                "outsideCaptureSpace": self.outsideCaptureSpace, "familyDistribution": self.familyDistribution, "duplexDistribution": self.duplexDistribution,
+                "depthDistribution": self.depthDistribution, "families": self.collapsedFamilies()}
+
+    def mergeShard(self, stats):
+        """
+        Adds the statistics of a shard which was collapsed in a separate process to this object
+
+        :param stats: A dictionary generated by shardStats()
+        """
+        for counterName in ("readCounter", "pairCounter", "familyCounter", "malformedCigar", "failedQC",
+                            "missingBarcode", "unsupportedBarcode", "outsideCaptureSpace"):
+            setattr(self, counterName, getattr(self, counterName) + stats[counterName])
+        self.familyDistribution.extend(stats["familyDistribution"])
+        self.duplexDistribution.extend(stats["duplexDistribution"])
+        self.depthDistribution.extend(stats["depthDistribution"])
+        self.shardFamilies += stats["families"]
+        self.mergedShards += 1
 
     def generatePlots(self, outPrefix, ignoreException=False):
         """
@@ -1318,6 +1819,59 @@ class FamilyCoordinator:
                 raise e
 
 
+def openInput(inputFile, inputFormat, reference, indexFile=None):
+    """
+    Opens the specified SAM/BAM/CRAM file
+
+    :param inputFile: A string containing a filepath to the input file (or a file-like object, such as sys.stdin)
+    :param inputFormat: A string specifying the format of the input file ("SAM", "BAM" or "CRAM"). If None, the
+                    format is determined using the file extension
+    :param reference: A string containing a filepath to the reference genome, used to decode CRAM files
+    :param indexFile: A string containing a filepath to the index of a BAM or CRAM file. If None, the index is
+                    expected to be beside the input file
+    :return: A tuple containing a pysam.AlignmentFile object, and the format of the input file
+    """
+    if not inputFormat:
+        # Use the file extension to determine the file type
+        inputFormat = inputFile.split(".")[-1]
+    if inputFormat == "SAM":
+        return pysam.AlignmentFile(inputFile, "r"), "SAM"
+    elif inputFormat == "CRAM":
+        return pysam.AlignmentFile(inputFile, "rc", reference_filename=reference, index_filename=indexFile), "CRAM"  # Specify the reference for CRAM files
+    else:
+        return pysam.AlignmentFile(inputFile, "rb", index_filename=indexFile), "BAM"
+
+
+def collapseShard(shardArgs):
+    """
+    Collapses the reads within a single shard (see FamilyCoordinator.shardRegions()), and writes the resulting families
+    to a temporary BAM file. Used to parallelize Collapse
+
+    :param shardArgs: A tuple containing (the arguments dictionary, the family indices, the duplex indices, the output
+                    header, the shard, the index of this shard, the total number of shards, the output BAM file, the
+                    status message prefix, and the index of the input file)
+    :return: A dictionary containing the statistics of this shard (see FamilyCoordinator.shardStats())
+    """
+
+    args, familyIndices, duplexIndices, header, shard, shardIndex, shardCount, outFile, printPrefix, indexFile = shardArgs
+    inBAM, inFormat = openInput(args["input"], args["input_format"], args["reference"], indexFile)
+    # Since this file is temporary, it is not compressed
+    outBAM = pysam.AlignmentFile(outFile, "wbu", header=header)
+
+    # The number of each family is offset by the index of this shard, and incremented by the number of shards, so
+    # families from different shards are never assigned the same name
+    readProcessor = FamilyCoordinator(inBAM, args["reference"], familyIndices, args["family_mismatch"],
+                                      duplexIndices, args["duplex_mismatch"], len(args["duplex_mask"]) * 2,
+                                      args["targets"], args["tag_family_members"], noBarcodes=args["no_barcodes"],
+                                      mergeDuplex=args["collapse_duplexes"], printPrefix=printPrefix, shard=shard,
+                                      counterStart=shardIndex, counterStep=shardCount)
+    for read in readProcessor:
+        outBAM.write(read)
+    outBAM.close()
+    inBAM.close()
+    return readProcessor.shardStats()
+
+
 def validateArgs(args):
     """
     Validates that the specified set of arguments are valid
@@ -1370,6 +1924,8 @@ def validateArgs(args):
                         help="Reference genome, in FASTA format")
     parser.add_argument("--input_format", metavar="SAM/BAM/CRAM", choices=["SAM", "BAM", "CRAM"],
                           help="Input file format [Default: Detect using file extension]")
+    parser.add_argument("--threads", metavar="INT", type=int,
+                        help="Number of processes used to collapse reads. Requires an indexed BAM or CRAM file")
     parser.add_argument("--ignore_exception", action="store_true", help=argparse.SUPPRESS)
     validatedArgs = parser.parse_args(listArgs)
     validateArgs = vars(validatedArgs)
@@ -1451,6 +2007,8 @@ miscArgs.add_argument("--plot_prefix", metavar="DIR", help="Output directory/pre
 miscArgs.add_argument("--collapse_duplexes", action="store_true",
                     help="Generate a consensus from the forward and reverse strands")
 miscArgs.add_argument("--input_format", metavar="SAM/BAM/CRAM", choices=["SAM", "BAM", "CRAM"], help="Input file format [Default: Detect using file extension]")
+miscArgs.add_argument("--threads", metavar="INT", type=int,
+                    help="Number of processes used to collapse reads. The input file is split into shards (by contig, or by clusters of targets if \'--targets\' is specified), which are collapsed in parallel. Requires an indexed BAM or CRAM file [Default: 1]")
 miscArgs.add_argument("--ignore_exception", action="store_true", help=argparse.SUPPRESS)
 
 
@@ -1503,29 +2061,36 @@ def main(args=None, sysStdin=None, printPrefix="DELLINGR-COLLAPSE"):
 
     # Open the input file
     # Here we handle different file types
-    if args["input_format"]:
-        # Open the input file in the format that the user specified
-        if args["input_format"] == "SAM":
-            inBAM = pysam.AlignmentFile(args["input"], "r")
-            inFormat = "SAM"
-        elif args["input_format"] == "CRAM":
-            inBAM = pysam.AlignmentFile(args["input"], "rc", reference_filename=args["reference"])  # Specify the reference for CRAM files
-            inFormat = "CRAM"
+    inBAM, inFormat = openInput(args["input"], args["input_format"], args["reference"])
+
+    # If multiple threads were specified, the input file is split into shards which are collapsed in parallel
+    # This requires random access to the input file (i.e. an index)
+    threads = args["threads"] if args["threads"] is not None else 1
+    indexFile = None
+    if threads > 1:
+        if args["input"] is sys.stdin or inFormat == "SAM":
+            sys.stderr.write("WARNING: Reads can only be collapsed in parallel if the input is a BAM or CRAM file. Using a single thread" + os.linesep)
+            threads = 1
         else:
-            inBAM = pysam.AlignmentFile(args["input"], "rb")
-            inFormat = "BAM"
-    else:
-        # Use the file extension to determine the file type
-        fileExt = args["input"].split(".")[-1]
-        if fileExt == "SAM":
-            inBAM = pysam.AlignmentFile(args["input"], "r")
-            inFormat = "SAM"
-        elif fileExt == "CRAM":
-            inBAM = pysam.AlignmentFile(args["input"], "rc", reference_filename=args["reference"])  # Specify the reference for CRAM files
-            inFormat = "CRAM"
-        else:
-            inBAM = pysam.AlignmentFile(args["input"], "rb")
-            inFormat = "BAM"
+            # The output of each shard is written to a temporary directory beside the output file
+            if isinstance(args["output"], str):
+                tmpDir = tempfile.mkdtemp(prefix=os.path.basename(args["output"]) + ".shards.", dir=os.path.dirname(os.path.abspath(args["output"])))
+            else:
+                tmpDir = tempfile.mkdtemp(prefix="collapse.shards.")
+        if threads > 1 and not inBAM.has_index():
+            # Index the input file. Since the directory containing the input file may be read-only (or shared), the
+            # index is written into the temporary directory
+            sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Indexing \'%s\'...\n" % args["input"]]))
+            indexFile = os.path.join(tmpDir, "input.crai" if inFormat == "CRAM" else "input.bai")
+            try:
+                pysam.index(args["input"], indexFile)
+                inBAM.close()
+                inBAM, inFormat = openInput(args["input"], args["input_format"], args["reference"], indexFile)
+            except (pysam.SamtoolsError, OSError):
+                sys.stderr.write("WARNING: Unable to index \'%s\'. Using a single thread" % args["input"] + os.linesep)
+                shutil.rmtree(tmpDir, ignore_errors=True)
+                indexFile = None
+                threads = 1
 
     # As of pysam V0.14.0, the header is now managed using an AlignmentHeader class.
     # Thus, support both approaches
@@ -1573,8 +2138,42 @@ def main(args=None, sysStdin=None, printPrefix="DELLINGR-COLLAPSE"):
                                       args["targets"], args["tag_family_members"], noBarcodes=args["no_barcodes"],
                                       mergeDuplex=args["collapse_duplexes"], printPrefix=printPrefix)
 
-    for read in readProcessor:
-        outBAM.write(read)
+    if threads > 1:
+        # Split the input file into shards, and collapse each shard in a separate process
+        shards = readProcessor.shardRegions(threads * SHARDS_PER_THREAD)
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Starting... (collapsing %s shards using %s threads)\n" % (len(shards), threads)]))
+        shardFiles = list(os.path.join(tmpDir, "shard%s.bam" % i) for i in range(0, len(shards)))
+        # File objects (i.e. stdout) can't be sent to other processes
+        shardArgs = dict(args, output=None)
+        multithreadArgs = list((shardArgs, familyIndices, duplexIndices, header, shards[i], i, len(shards), shardFiles[i], printPrefix, indexFile)
+                               for i in range(0, len(shards)))
+
+        processPool = multiprocessing.Pool(processes=max(1, min(threads, len(shards))))
+        try:
+            for stats in processPool.imap_unordered(collapseShard, multithreadArgs):
+                readProcessor.mergeShard(stats)
+                sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Collapsed %s of %s shards (%s pairs into %s families)\n"
+                                             % (readProcessor.mergedShards, len(shards), readProcessor.pairCounter, readProcessor.collapsedFamilies())]))
+            processPool.close()
+        except BaseException as e:
+            sys.stderr.write("ERROR: An error occured while collapsing reads. Terminating workers..." + os.linesep)
+            processPool.terminate()
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise e
+        finally:
+            processPool.join()
+
+        # Merge the output of each shard
+        for shardFile in shardFiles:
+            shardBAM = pysam.AlignmentFile(shardFile, "rb", check_sq=False)
+            for read in shardBAM.fetch(until_eof=True):
+                outBAM.write(read)
+            shardBAM.close()
+        shutil.rmtree(tmpDir)
+        readProcessor.printSummary()
+    else:
+        for read in readProcessor:
+            outBAM.write(read)
 
     # If the user specified an output directory for plots, generate them
     if args["plot_prefix"] is not None:
@@ -1,13 +1,14 @@
 #! /usr/bin/env python
 
 import argparse
+import functools
+import hashlib
 import os
 import shutil
 import sys
 import subprocess
 import re
 import time
-import multiprocessing
 from packaging import version
 from configobj import ConfigObj
 
@@ -18,8 +19,11 @@ try: # If not installed, this works
     import __version
     import AdapterPredict
     import Call
+    import Scheduler
+    import ProcessChain
+    import WorkQueue
 except ImportError:
-    from Dellingr import Trim, Collapse, ClipOverlap, __version, AdapterPredict, Call
+    from Dellingr import Trim, Collapse, ClipOverlap, __version, AdapterPredict, Call, Scheduler, ProcessChain, WorkQueue
 
 
 def isValidFile(file, parser, default=None):
@@ -66,21 +70,27 @@ def configureOutput(sampleName, sampleParameters, outDir, argsToScript, appendNo
     # Inside this directory, we are going to create seperate directories for the data,
     # intermediate files, and results
 
-    # If a directory corresponding to this sample already exists, don't proccess this sample,
-    # as it likely has already been processed (at least partially)
+    # If a directory corresponding to this sample already exists, it has likely already been processed (at least
+    # partially). Update the config files, and only re-run stages whose inputs or parameters have changed
     samplePath = outDir + os.sep + sampleName
     if os.path.exists(samplePath) and not appendNormal:
         sys.stderr.write("WARNING: A folder corresponding to \'%s\' already exists inside \'%s\'.\n" % (sampleName, outDir))
-        sys.stderr.write("We will attempt to finish analyzing this sample using the existing configuration.\n")
-        return samplePath
+        sys.stderr.write("We will attempt to finish analyzing this sample. Stages whose inputs and parameters have not changed will not be re-run.\n")
 
     try:
         os.mkdir(samplePath)
     except FileExistsError:
         pass
 
+    # If a scratch directory was specified, intermediate files (and the final BAM file, until it is copied to the
+    # results directory) are written there instead of the sample directory
+    if sampleParameters.get("scratch_dir") is not None:
+        workPath = sampleScratchDir(sampleParameters["scratch_dir"], outDir, sampleName)
+    else:
+        workPath = samplePath
+
     # Create a tmp directory, which will hold intermediate files
-    tmpDir = samplePath + os.sep + "tmp" + os.sep
+    tmpDir = workPath + os.sep + "tmp" + os.sep
 
     # Create a results directory which will hold the finalized BAM file, as well as the variant calls
     resultsDir = samplePath + os.sep + "results" + os.sep
@@ -110,7 +120,7 @@ def configureOutput(sampleName, sampleParameters, outDir, argsToScript, appendNo
         bwaR2In = tmpDir + sampleName + ".trim_R2.fastq.gz"
     bwaOut = tmpDir + sampleName + ".trim.bam"
     collapseOut = tmpDir + sampleName + ".collapse.bam"
-    collapseSortedOut = resultsDir + sampleName + ".collapse.sort.bam"
+    collapseSortedOut = sortedOutput(collapseOut)
     callPassedOut = resultsDir + sampleName + ".call.passed.vcf"
     callAllOut = resultsDir + sampleName + ".call.all.vcf"
 
@@ -118,7 +128,8 @@ def configureOutput(sampleName, sampleParameters, outDir, argsToScript, appendNo
     # Since the input and output of each script will be unique, specify them here
     scriptToArgs["bwa"] = {"input": [bwaR1In, bwaR2In], "output": bwaOut, "reference": sampleParameters["reference"],
                            "fastqComment": not sampleParameters["no_barcodes"]}
-    scriptToArgs["trim"] = {"input": sampleParameters["fastqs"], "output": [bwaR1In, bwaR2In]}
+    # The trimmed FASTQs are only read once by bwa before they are deleted, so use the fastest compression level for them
+    scriptToArgs["trim"] = {"input": sampleParameters["fastqs"], "output": [bwaR1In, bwaR2In], "compression_level": 1}
     scriptToArgs["collapse"] = {"input": bwaOut, "output": collapseOut, "plot_prefix": plotDir + sampleName, "ignore_exception": "True"}
     scriptToArgs["call"] = {"input": collapseSortedOut, "output": callPassedOut, "unfiltered": callAllOut}
 
@@ -149,6 +160,9 @@ def configureOutput(sampleName, sampleParameters, outDir, argsToScript, appendNo
         os.mkdir(samplePath + os.sep + "figures")
     except FileExistsError:
         pass
+    if workPath != samplePath:
+        for workDir in ("tmp", "results"):
+            os.makedirs(os.path.join(workPath, workDir), exist_ok=True)
 
     # If normal FASTQ files were specified, we will also need to create a config for those samples
     if sampleParameters["normal_fastqs"] is not None and not appendNormal:
@@ -167,6 +181,36 @@ def configureOutput(sampleName, sampleParameters, outDir, argsToScript, appendNo
     return samplePath
 
 
+def sampleScratchDir(scratchDir, outDir, sampleName):
+    """
+    Generates the filepath to a sample's directory inside the scratch directory
+
+    The path includes the name (and a checksum of the full path) of the analysis directory, so several analyses can
+    share the same scratch directory
+
+    :param scratchDir: A string containing a filepath to the scratch directory
+    :param outDir: A string containing a filepath to the base output directory of the analysis
+    :param sampleName: A string containing the sample name
+    :return: A string containing a filepath
+    """
+    outDir = os.path.abspath(outDir)
+    analysisName = "dellingr_%s_%s" % (os.path.basename(outDir.rstrip(os.sep)), hashlib.md5(outDir.encode("utf-8")).hexdigest()[:8])
+    return os.path.join(os.path.abspath(scratchDir), analysisName, sampleName)
+
+
+def sortedOutput(collapseOutput):
+    """
+    Generates the filepath to the final (sorted) BAM file from the filepath to Collapse's output
+
+    The final BAM file is written to the "results" directory which is beside Collapse's "tmp" directory
+
+    :param collapseOutput: A string containing a filepath to the BAM file generated by Collapse
+    :return: A string containing a filepath
+    """
+    workPath = os.path.dirname(os.path.dirname(collapseOutput))
+    return os.path.join(workPath, "results", os.path.basename(collapseOutput).replace(".bam", ".sort.bam"))
+
+
 def combineArgs(confArgs, args):
     """
     Merges arguments specified in the config file with those parsed from the command line
@@ -298,8 +342,24 @@ def checkArgs(rawArgs):
                           help="Classifier threshold to use when filtering variants. Decrease to be more lenient [Default: 0.65]")
 
     miscArgs = parser.add_argument_group("Miscellaneous Args")
-    miscArgs.add_argument("-j", "--jobs", metavar="INT", type=int, default=1,
-                        help="If multiple samples are specified (using \'-sc\'), how many samples will be processed in parallel")
+    miscArgs.add_argument("-j", "--jobs", metavar="INT", type=int, default=None,
+                        help="Maximum number of pipeline stages to run in parallel. Independent stages (ex. the tumour and normal samples, or different samples) are run concurrently [Default: 1, or all CPUs if \'--max_memory\' is specified]")
+    miscArgs.add_argument("--threads", metavar="INT", type=int, default=None,
+                        help="Total number of CPUs which can be used by all running stages. These are split between samples, and passed to bwa, samtools sort, Trim and Collapse [Default: Same as \'-j\']")
+    miscArgs.add_argument("--sort_memory", metavar="SIZE", type=str, default=None,
+                        help="Maximum amount of memory used by each samtools sort (ex. 4G), split between its threads [Default: samtools default]")
+    miscArgs.add_argument("--max_memory", metavar="SIZE", type=str, default=None,
+                        help="Maximum amount of memory (ex. 64G) used by all running stages. A stage is only started if its estimated memory usage fits within this limit")
+    miscArgs.add_argument("--hash_inputs", action="store_true",
+                        help="When determining if a stage needs to be re-run, compare the checksums of its input files instead of their modification times")
+    miscArgs.add_argument("--executor", choices=["local", "queue"], default="local",
+                        help="How pipeline stages are run. \'local\' runs all stages on this machine. \'queue\' also allows other workers (\'dellingr worker\') to process the same analysis directory")
+    miscArgs.add_argument("--shared_index", action="store_true",
+                        help="Load the BWA index into shared memory once (using \'bwa shm\'), and use it to align every sample. Saves memory when aligning several samples at once")
+    miscArgs.add_argument("--retries", metavar="INT", type=int, default=0,
+                        help="Number of times a stage which fails is re-run before its sample is considered failed (ex. to recover from transient filesystem errors)")
+    miscArgs.add_argument("--fail_fast", action="store_true",
+                        help="Once any stage has failed, stop all running stages, and do not start any others")
     miscArgs.add_argument("--bwa", default="bwa", type=lambda x: isValidFile(x, parser, default="bwa"),
                         help="Path to bwa executable")
     miscArgs.add_argument("--samtools", default="samtools", type=lambda x: isValidFile(x, parser, default="samtools"),
@@ -309,6 +369,10 @@ def checkArgs(rawArgs):
     miscArgs.add_argument("--append_to_directory", action="store_true",
                         help="If \'--directory_name\' already exists in the specified output directory, simply append new results to that directory")
     miscArgs.add_argument("--cleanup", action="store_true", help="Remove intermediate files")
+    miscArgs.add_argument("--scratch_dir", metavar="DIR", type=str, default=None,
+                        help="Write intermediate files to this directory (ex. a node-local disk) instead of the output directory. Final BAM files are copied to the output directory, and the scratch directory is removed once each sample is complete")
+    miscArgs.add_argument("--stream_trim", action="store_true",
+                          help="Stream trimmed reads directly into bwa, instead of writing them to intermediate FASTQ files")
 
     validatedArgs = parser.parse_args(args=listArgs)
 
@@ -318,6 +382,15 @@ def checkArgs(rawArgs):
         if element != "0" and element != "1":
             raise parser.error("\'-p/--barcode_position\' should be specified using \"1\" and \"0\". Did you mean \"-j/--jobs\"")
 
+    if validatedArgs.threads is not None and validatedArgs.threads < 1:
+        raise parser.error("\'--threads\' must be at least 1")
+    for memoryArg in ("sort_memory", "max_memory"):
+        if getattr(validatedArgs, memoryArg) is not None:
+            try:
+                parseMemory(getattr(validatedArgs, memoryArg))
+            except ValueError as e:
+                raise parser.error("\'--%s\': %s" % (memoryArg, e))
+
     validatedArgs = vars(validatedArgs)
 
     # Finally, invert norm_barcodes, so it is consistent with no_barcodes for the normals
@@ -468,19 +541,17 @@ def checkIndexes(refFasta, bwaExec, samtoolsExec, outDir):
     else:
         # Generate the indexes
         bwaCommand = [bwaExec, "index", newRefFasta]
-        bwaRun = subprocess.Popen(bwaCommand, stderr=subprocess.PIPE)
-        for line in bwaRun.stderr:
-            line = line.decode("utf-8")
+
+        def printBWAStderr(line):
             if "[BWTIncConstructFromPacked]" in line:
-                continue
+                return
             elif "[main]" in line:  # Just cleaning up the terminal output a bit
-                continue
-            else:
-                sys.stderr.write(line)
+                return
+            sys.stderr.write(line)
 
-        bwaRun.wait()
-        if bwaRun.returncode != 0:
-            raise subprocess.CalledProcessError(" ".join(bwaCommand), bwaRun.returncode)
+        with ProcessChain.ProcessChain() as bwaRun:
+            bwaRun.add("BWA index", bwaCommand, stderrCallback=printBWAStderr)
+            bwaRun.wait()
 
     if hasFastaIndex:
         # Some versions of BWA create this
@@ -497,241 +568,366 @@ def checkIndexes(refFasta, bwaExec, samtoolsExec, outDir):
     return newRefFasta
 
 
-def runPipelineMultithread(args):
+def listSharedIndexes(bwaExec):
     """
-    This function does basically nothing, except unpack the arguments provided and pass them to runPipeline
+    Lists the bwa indexes which are currently loaded into shared memory (using "bwa shm")
 
-    This is required since "map" only passes each function one argument
+    :param bwaExec: A string containing a filepath to the bwa executable
+    :return: A dictionary listing {index name: size (in bytes)}
+    """
+    shmCom = subprocess.Popen([bwaExec, "shm", "-l"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    shmOut, shmErr = shmCom.communicate()
+    staged = {}
+    if shmCom.returncode != 0:
+        return staged
+    for line in shmOut.decode("utf-8").split("\n"):
+        line = line.split("\t")
+        if len(line) == 2:
+            staged[line[0]] = int(line[1])
+    return staged
+
+
+def stageSharedIndex(refFasta, bwaExec):
+    """
+    Loads the bwa index of the reference genome into shared memory
 
-    :param args: An iterable containing the arguments to be passed to runPipeline()
-    :return:
+    Every bwa process started afterwards uses the shared copy of the index, instead of loading its own. This saves
+    several GB of memory (and the time required to load the index) for each sample which is aligned at the same time
+
+    :param refFasta: A string containing a filepath to the reference genome
+    :param bwaExec: A string containing a filepath to the bwa executable
+    :return: A boolean indicating if the index was loaded by this call (and thus should be released afterwards)
     """
 
-    runPipeline(args[0], args[1], args[2])
+    printPrefix = "DELLINGR-MAIN\t"
+    # bwa identifies shared indexes using the name of the reference genome
+    indexName = os.path.basename(refFasta)
+    if indexName in listSharedIndexes(bwaExec):
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                    "The BWA index of \'%s\' is already in shared memory. Using that index\n" % indexName]))
+        return False
+
+    sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Loading the BWA index of \'%s\' into shared memory...\n" % indexName]))
+    shmRun = ProcessChain.ProcessChain()
+    try:
+        with shmRun:
+            shmRun.add("BWA shm", [bwaExec, "shm", refFasta])
+            shmRun.wait()
+    except subprocess.CalledProcessError:
+        # Not fatal, as bwa will just load the index itself
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                    "WARNING: Unable to load the BWA index into shared memory. Each sample will load its own copy\n"]))
+        sys.stderr.write(shmRun.errorReport())
+        return False
+    return True
+
+
+def releaseSharedIndex(refFastas, bwaExec):
+    """
+    Removes the bwa indexes loaded by stageSharedIndex() from shared memory
 
-def runPipeline(sampleName, sampleDir, cleanup=False):
+    Since "bwa shm -d" removes every index in shared memory, nothing is removed if indexes which were not loaded by
+    this run are present
+
+    :param refFastas: A list of filepaths to the reference genomes whose index was loaded by stageSharedIndex()
+    :param bwaExec: A string containing a filepath to the bwa executable
     """
-    Run all scripts in the Dellingr pipeline on the specified sample
-    :param sampleName: A string containing the sample name, for status message updates
-    :param sampleDir: A string containg the filepath to the base sample directory
-    :param cleanup: A boolean indicating if temporary files should be deleted
-    :return:
+
+    printPrefix = "DELLINGR-MAIN\t"
+    ownIndexes = set(os.path.basename(x) for x in refFastas)
+    otherIndexes = set(listSharedIndexes(bwaExec).keys()) - ownIndexes
+    if otherIndexes:
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                    "WARNING: Other BWA indexes (%s) are in shared memory, so \'%s\' was not removed. Use \'bwa shm -d\' to remove all indexes\n"
+                                    % (", ".join(sorted(otherIndexes)), "\', \'".join(sorted(ownIndexes)))]))
+        return
+
+    sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Removing the BWA index from shared memory\n"]))
+    shmRun = ProcessChain.ProcessChain()
+    try:
+        with shmRun:
+            shmRun.add("BWA shm", [bwaExec, "shm", "-d"])
+            shmRun.wait()
+    except subprocess.CalledProcessError:
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                    "WARNING: Unable to remove the BWA index from shared memory. Use \'bwa shm -d\' to remove it\n"]))
+        sys.stderr.write(shmRun.errorReport())
+
+
+def parseMemory(size):
     """
+    Converts a memory size (ex. "768M", "4G") into a number of bytes
 
-    def runBWA(configPath):
-        """
-        Aligns the reads in the specified FASTQ files using the Burrows-Wheeler aligner
-        In addition, a read group is added, and the resulting BAM file is sorted
+    :param size: A string containing an integer, optionally followed by K, M, or G
+    :return: An int containing the number of bytes
+    :raises ValueError: If the size is not formatted correctly
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    amount = str(size).strip().upper()
+    multiplier = 1
+    if amount[-1:] in units:
+        multiplier = units[amount[-1]]
+        amount = amount[:-1]
+    if not amount.isdigit() or int(amount) == 0:
+        raise ValueError("Unable to interpret \'%s\' as a memory size. Use an integer, optionally followed by K, M or G" % size)
+    return int(amount) * multiplier
+
+
+def sortThreadArgs(threads, sortMemory=None):
+    """
+    Generates the arguments which tell samtools sort how many threads (and how much memory) it can use
 
-        :param configPath: A string containing a filepath to a ini file listing bwa's parameters
-        :return: None
-        """
+    :param threads: An int specifying the number of CPUs available to samtools sort
+    :param sortMemory: A string containing the total amount of memory available to samtools sort (ex. 4G). As samtools
+                    allocates this amount per thread, it is split between all threads
+    :return: A list of arguments
+    """
+    sortArgs = []
+    # -@ specifies the number of threads in addition to the main thread
+    if threads > 1:
+        sortArgs.extend(["-@", str(threads - 1)])
+    if sortMemory is not None and sortMemory != "None":
+        memoryPerThread = max(1, parseMemory(sortMemory) // threads // 1024)
+        sortArgs.extend(["-m", "%dK" % memoryPerThread])
+    return sortArgs
 
-        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Running BWA...\n"]))
-        # Read the arguments from the config file
-        try:
-            bwaConfig = ConfigObj(configPath)["bwa"]
-        except KeyError:  # Thrown if the section is not labelled "bwa"
-            sys.stderr.write(
-                "ERROR: The config file \'%s\' does not appear to be a bwa config, as no section is labelled \'bwa\'\n" % (
-                configPath))
-            exit(1)
-        # Parse the arguments from the config file in the required order
-        try:
+
+def runBWA(configPath, printPrefix, trimConfigPath=None, trimPrintPrefix=None, threads=1):
+    """
+    Aligns the reads in the specified FASTQ files using the Burrows-Wheeler aligner
+    In addition, a read group is added, and the resulting BAM file is sorted
+
+    If a Trim config file is specified, Trim is run at the same time, and the trimmed reads are streamed directly
+    into bwa (as interleaved read pairs) instead of being written to intermediate FASTQ files
+
+    :param configPath: A string containing a filepath to a ini file listing bwa's parameters
+    :param printPrefix: A string which will be prepended to status messages
+    :param trimConfigPath: A string containing a filepath to a ini file listing Trim's parameters
+    :param trimPrintPrefix: A string which will be prepended to Trim's status messages
+    :param threads: An int specifying the number of CPUs available to bwa and samtools sort
+    :return: None
+    """
+
+    sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Running BWA...\n"]))
+    # Read the arguments from the config file
+    try:
+        bwaConfig = ConfigObj(configPath)["bwa"]
+    except KeyError:  # Thrown if the section is not labelled "bwa"
+        sys.stderr.write(
+            "ERROR: The config file \'%s\' does not appear to be a bwa config, as no section is labelled \'bwa\'\n" % (
+            configPath))
+        exit(1)
+    # Parse the arguments from the config file in the required order
+    try:
+        if trimConfigPath is None:
             bwaCommand = [bwaConfig["bwa"], "mem",
                           bwaConfig["reference"],
                           bwaConfig["input"][0],
                           bwaConfig["input"][1],
                           ]
-            if bwaConfig["fastqComment"] == "True":  # We need to append the barcode sequence to the output BAM file
-                bwaCommand.insert(2, "-C")
-            sortCommand = [bwaConfig["samtools"],
-                           "sort", "-O", "BAM", "-o",
-                           bwaConfig["output"]]
-
-            # To supress BWA's status messages, we are going to buffer the stderr stream of every process into a variable
-            # If BWA or a samtools task crashes (exit code != 0), we will print out everything that is buffered
-            bwaStderr = []
-            samtoolsStderr = []
-            bwaCounter = 0
+        else:
+            # Read interleaved read pairs from stdin
+            bwaCommand = [bwaConfig["bwa"], "mem", "-p",
+                          bwaConfig["reference"],
+                          "-"
+                          ]
+        if bwaConfig["fastqComment"] == "True":  # We need to append the barcode sequence to the output BAM file
+            bwaCommand.insert(2, "-C")
+        if threads > 1:
+            bwaCommand[2:2] = ["-t", str(threads)]
+        sortCommand = [bwaConfig["samtools"], "sort"]
+        sortCommand.extend(sortThreadArgs(threads, bwaConfig.get("sort_memory")))
+        sortCommand.extend(["-O", "BAM", "-o", bwaConfig["output"]])
+
+        # To supress BWA's status messages, the stderr stream of every process is buffered
+        # If BWA or a samtools task crashes (exit code != 0), we will print out what was buffered
+        bwaCounter = [0]
+
+        def readBWAStderr(bwaLine):
+            # If this line indicates the progress of BWA, print it out
+            if bwaLine.startswith("[M::mem_process_seqs]"):
+                bwaCounter[0] += int(bwaLine.split(" ")[2])
+                sys.stderr.write(
+                    "\t".join([printPrefix, time.strftime('%X'), "Reads Processed:" + str(bwaCounter[0]) + "\n"]))
+
+        chain = ProcessChain.ProcessChain()
+        try:
+            with chain:
+                # If the reads are streamed from Trim, bwa reads them from stdin
+                bwaCom = chain.add("BWA", bwaCommand, pipeStdin=trimConfigPath is not None, pipeStdout=True,
+                                   stderrCallback=readBWAStderr)
+                chain.add("Samtools Sort", sortCommand)
+                if trimConfigPath is not None:
+                    # Trim is given a single process (its default), as it is much faster than bwa
+                    Trim.main(sysStdin=["--config", trimConfigPath], printPrefix=trimPrintPrefix, outputStream=bwaCom.stdin)
+                chain.wait()
+        except BaseException as e:  # Either a program crashed, or something is hanging and the user has force quit
+            # To be safe, print out debugging info
+            sys.stderr.write("ERROR: BWA and Samtools encountered an unexpected error and were terminated" + os.linesep)
+            sys.stderr.write(chain.errorReport())
+            raise e
 
-            try:
-                bwaCom = subprocess.Popen(bwaCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                sortCom = subprocess.Popen(sortCommand, stdin=bwaCom.stdout, stderr=subprocess.PIPE)
-
-                # Parse through the stderr lines of BWA and samtools, and buffer them as necessary
-                for bwaLine in bwaCom.stderr:
-                    # If this line indicates the progress of BWA, print it out
-                    bwaLine = bwaLine.decode("utf-8")
-                    if bwaLine.startswith("[M::mem_process_seqs]"):
-                        bwaCounter += int(bwaLine.split(" ")[2])
-                        sys.stderr.write(
-                            "\t".join([printPrefix, time.strftime('%X'), "Reads Processed:" + str(bwaCounter) + "\n"]))
-                    bwaStderr.append(bwaLine)
-
-                for samtoolsLine in sortCom.stderr:
-                    samtoolsStderr.append(samtoolsLine.decode("utf-8"))
-
-                bwaCom.stdout.close()
-                bwaCom.wait()
-                sortCom.wait()
-                if bwaCom.returncode != 0 or sortCom.returncode != 0:  # i.e. Something crashed
-                    raise subprocess.CalledProcessError()
-            except BaseException as e:  # Either a program crashed, or something is hanging and the user has force quit
-                # To be safe, print out debugging info
-                sys.stderr.write("ERROR: BWA and Samtools encountered an unexpected error and were terminated" + os.linesep)
-                sys.stderr.write("BWA Standard Error Stream:" + os.linesep)
-                sys.stderr.write("".join(bwaStderr))
-                sys.stderr.write("Samtools Sort Standard Error Stream:" + os.linesep)
-                sys.stderr.write("".join(samtoolsStderr))
-                raise e
-
-            sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Mapping Complete\n"]))
-
-        except KeyError as e:  # i.e. A required argument is missing from the config file
-            sys.stderr.write(
-                "ERROR: Unable to locate a required argument in the bwa config file \'%s\'\n" % (configPath))
+        # Index the BAM file, so Collapse can split it into shards which are processed in parallel
+        indexChain = ProcessChain.ProcessChain()
+        try:
+            with indexChain:
+                indexChain.add("Samtools index", [bwaConfig["samtools"], "index", bwaConfig["output"]])
+                indexChain.wait()
+        except subprocess.CalledProcessError as e:
+            sys.stderr.write("ERROR: Unable to index \'%s\'\n" % bwaConfig["output"])
+            sys.stderr.write(indexChain.errorReport())
             raise e
 
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Mapping Complete\n"]))
+
+    except KeyError as e:  # i.e. A required argument is missing from the config file
+        sys.stderr.write(
+            "ERROR: Unable to locate a required argument in the bwa config file \'%s\'\n" % (configPath))
+        raise e
+
+
+def isStreamed(bwaConfigPath):
+    """
+    Should the trimmed reads be streamed directly into bwa?
 
-    def sortAndRetag(inFile, outFile, bwaConfigPath):
-        """
-        Recalculare the MD and NM tags of the secified SAM file, and sort it
+    :param bwaConfigPath: A string containing a filepath to the bwa config file
+    :return: A boolean
+    """
+    return ConfigObj(bwaConfigPath)["bwa"].get("stream_trim", "False") == "True"
 
-        :param inFile: A string containing a filepath to an input BAM file. Usually generated by clipOverlap
-        :param outFile: A string containing an output filepath
-        :param bwaConfigPath: A string containing a filepath to the BWA config file
-        :return:
-        """
 
-        # Parse the reference genome location from the BWA config file
-        bwaConfig = ConfigObj(bwaConfigPath)["bwa"]
-        refGenome = bwaConfig["reference"]
+def sortAndRetag(inFile, outFile, bwaConfigPath, threads=1):
+    """
+    Recalculare the MD and NM tags of the secified SAM file, and sort it
 
-        calmdCom = ["samtools", "calmd", inFile, refGenome, "-b"]  # Recalculate MD and NM tags
-        sortCom = ["samtools", "sort", "-o", outFile]
+    :param inFile: A string containing a filepath to an input BAM file. Usually generated by clipOverlap
+    :param outFile: A string containing an output filepath
+    :param bwaConfigPath: A string containing a filepath to the BWA config file
+    :param threads: An int specifying the number of CPUs available to samtools sort
+    :return:
+    """
 
-        # To cleanup the terminal, we are going to buffer the stderr stream of every process into a variable
-        # If a samtools task crashes (exit code != 0), we will print out everything that is buffered
-        calmdStderr = []
-        sortStderr = []
+    # Parse the reference genome location from the BWA config file
+    bwaConfig = ConfigObj(bwaConfigPath)["bwa"]
+    refGenome = bwaConfig["reference"]
 
-        calmdTask = subprocess.Popen(calmdCom, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        sortTask = subprocess.Popen(sortCom, stdin=calmdTask.stdout, stderr=subprocess.PIPE)
+    calmdCom = ["samtools", "calmd", inFile, refGenome, "-b"]  # Recalculate MD and NM tags
+    # calmd and index are run using a single thread, as older versions of samtools do not support multithreading
+    sortCom = ["samtools", "sort"] + sortThreadArgs(threads, bwaConfig.get("sort_memory")) + ["-o", outFile]
 
-        # Parse through the stderr lines of samtools, and buffer them as necessary
-        for calmdLine in calmdTask.stderr:
-            calmdStderr.append(calmdLine.decode("utf-8"))
+    # To cleanup the terminal, the stderr stream of every process is buffered
+    # If a samtools task crashes (exit code != 0), we will print out what was buffered
+    chain = ProcessChain.ProcessChain()
+    try:
+        with chain:
+            chain.add("Samtools calmd", calmdCom, pipeStdout=True)
+            chain.add("Samtools Sort", sortCom)
+            chain.wait()
+    except subprocess.CalledProcessError:  # i.e. Something crashed
+        sys.stderr.write("ERROR: Samtools encountered an unexpected error and was terminated\n")
+        sys.stderr.write(chain.errorReport())
+        exit(1)
+
+    # Finally, index the BAM file
+    indexChain = ProcessChain.ProcessChain()
+    try:
+        with indexChain:
+            indexChain.add("Samtools index", ["samtools", "index", outFile])
+            indexChain.wait()
+    except subprocess.CalledProcessError:
+        sys.stderr.write("ERROR: Unable to index \'%s\'\n" % outFile)
+        sys.stderr.write(indexChain.errorReport())
+        exit(1)
 
-        for sortLine in sortTask.stderr:
-            sortStderr.append(sortLine.decode("utf-8"))
 
-        calmdTask.stdout.close()
-        calmdTask.wait()
-        sortTask.wait()
+def runTrim(trimConfigPath, trimPrintPrefix, threads=1):
+    """
+    Trims the barcodes from the sample's FASTQ files
 
-        if calmdTask.returncode != 0 or sortTask.returncode != 0:  # i.e. Something crashed
-            sys.stderr.write("ERROR: Samtools encountered an unexpected error and was terminated\n")
-            sys.stderr.write("Samtools calmd Standard Error Stream:\n")
-            sys.stderr.write("\n".join(calmdStderr))
-            sys.stderr.write("Samtools Sort Standard Error Stream:\n")
-            sys.stderr.write("\n".join(sortStderr))
-            exit(1)
+    :param trimConfigPath: A string containing a filepath to a ini file listing Trim's parameters
+    :param trimPrintPrefix: A string which will be prepended to Trim's status messages
+    :param threads: An int specifying the number of processes Trim can use
+    """
+    Trim.main(sysStdin=["--config", trimConfigPath, "--threads", str(threads)], printPrefix=trimPrintPrefix)
 
-        # Finally, index the BAM file
-        subprocess.check_call(["samtools", "index", outFile])
 
-    printPrefix = "DELLINGR-MAIN\t\t"+ sampleName
-    sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Processing Sample \'%s\'\n" % sampleName.rstrip()]))
+def runCollapse(collapseConfigPath, collapsePrintPrefix, threads=1):
+    """
+    Collapses the aligned reads of the sample into consensus reads
 
-    # Run Trim
-    trimDone = os.path.join(sampleDir, "config", "Trim_Complete")  # Similar to Make's "TASK_COMPLETE" file
-    if not os.path.exists(trimDone):  # i.e. Did Trim already complete for this sample? If so, do not re-run it
-        trimConfig = os.path.join(sampleDir, "config", "trim_task.ini")  # Where is Trim's config file?
-        # Is there a trim config file? If not, then we don't need to run trim, as the sample doesn't have barcodes
-        if os.path.exists(trimConfig):
-            trimPrintPrefix = "DELLINGR-TRIM\t\t" + sampleName
-            Trim.main(sysStdin=["--config", trimConfig], printPrefix=trimPrintPrefix)  # Actually run Trim
-            open(trimDone,
-                 "w").close()  # After Trim completes, it will create this file, signifying to the end user that this task completed
-
-    # Run Trim on the normal (if specified)
-    trimNormConfig = os.path.join(sampleDir, "config", "trim_normal_task.ini")
-    trimNormDone = os.path.join(sampleDir, "config", "Trim_Normal_Complete")  # Similar to Make's "TASK_COMPLETE" file
-    if os.path.exists(trimNormConfig) and not os.path.exists(trimNormDone):  # i.e. Did Trim already complete for the normal? If so, do not re-run it
-        # Is there a trim config file? If not, then we don't need to run trim, as the sample doesn't have barcodes
-        trimPrintPrefix = "DELLINGR-TRIM\t\t" + sampleName + "-Normal"
-        Trim.main(sysStdin=["--config", trimNormConfig], printPrefix=trimPrintPrefix)  # Actually run Trim
-        open(trimNormDone, "w").close()  # After Trim completes, it will create this file, signifying to the end user that this task completed
-
-    # Run bwa
-    bwaDone = os.path.join(sampleDir, "config", "BWA_Complete")
-    if not os.path.exists(bwaDone):
-        bwaConfig = os.path.join(sampleDir, "config", "bwa_task.ini")
-        runBWA(bwaConfig)
-        open(bwaDone, "w").close()
-
-    # Run BWA on the normal (if required)
-    bwaNormDone = os.path.join(sampleDir, "config", "BWA_Normal_Complete")
-    bwaNormConfig = os.path.join(sampleDir, "config", "bwa_normal_task.ini")
-    if os.path.exists(bwaNormConfig) and not os.path.exists(bwaNormDone):
-        runBWA(bwaNormConfig)
-        open(bwaNormDone, "w").close()
-
-    # Run Collapse
-    collapseDone = os.path.join(sampleDir, "config", "Collapse_Complete")
-    if not os.path.exists(collapseDone):
-        collapseConfig = os.path.join(sampleDir, "config", "collapse_task.ini")
-        collapsePrintPrefix = "DELLINGR-COLLAPSE\t" + sampleName
-        Collapse.main(sysStdin=["--config", collapseConfig], printPrefix=collapsePrintPrefix)
-
-        # Sort the collapse BAM output output
-        # Parse the config file for the output file name
-        collapseConfArgs = ConfigObj(collapseConfig)
-        sortInput = collapseConfArgs["collapse"]["output"]
-        # Append "sort" as the output file name
-        sortOutput = sortInput.replace(".bam", ".sort.bam")
-        tmpDir = os.sep + "tmp" + os.sep
-        resultsDir = os.sep + "results" + os.sep
-        sortOutput = sortOutput.replace(tmpDir, resultsDir)
-        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Sorting final BAM file, and recalculating tags...\n"]))
-        bwaConfig = os.path.join(sampleDir, "config", "bwa_task.ini")
-        sortAndRetag(sortInput, sortOutput, bwaConfig)
-
-        open(collapseDone, "w").close()
-
-    # Run Collapse on the normal sample (if specified)
-    collapseNormDone = os.path.join(sampleDir, "config", "Collapse_Normal_Complete")
-    collapseNormConfig = os.path.join(sampleDir, "config", "collapse_normal_task.ini")
-    if os.path.exists(collapseNormConfig) and not os.path.exists(collapseNormDone):
-        collapsePrintPrefix = "DELLINGR-COLLAPSE\t" + sampleName + "-Normal"
-        Collapse.main(sysStdin=["--config", collapseNormConfig], printPrefix=collapsePrintPrefix)
-
-        # Sort the collapse normal BAM output
-        # Parse the config file for the output file name
-        collapseConfArgs = ConfigObj(collapseNormConfig)
-        sortInput = collapseConfArgs["collapse"]["output"]
-        # Append "sort" as the output file name
-        sortOutput = sortInput.replace(".bam", ".sort.bam")
-        tmpDir = os.sep + "tmp" + os.sep
-        resultsDir = os.sep + "results" + os.sep
-        sortOutput = sortOutput.replace(tmpDir, resultsDir)
+    :param collapseConfigPath: A string containing a filepath to a ini file listing Collapse's parameters
+    :param collapsePrintPrefix: A string which will be prepended to Collapse's status messages
+    :param threads: An int specifying the number of processes Collapse can use
+    """
+    Collapse.main(sysStdin=["--config", collapseConfigPath, "--threads", str(threads)], printPrefix=collapsePrintPrefix)
+
+
+def sortCollapsed(collapseConfigPath, bwaConfigPath, printPrefix, normal=False, threads=1):
+    """
+    Sorts the output of Collapse, recalculates the MD and NM tags, and places the final BAM file in the results directory
+
+    :param collapseConfigPath: A string containing a filepath to the Collapse config file
+    :param bwaConfigPath: A string containing a filepath to the BWA config file
+    :param printPrefix: A string which will be prepended to status messages
+    :param normal: A boolean indicating if this is the matched normal sample
+    :param threads: An int specifying the number of CPUs available to samtools sort
+    """
+
+    # Parse the config file for the output file name
+    collapseConfArgs = ConfigObj(collapseConfigPath)
+    sortInput = collapseConfArgs["collapse"]["output"]
+    # Append "sort" as the output file name
+    sortOutput = sortedOutput(sortInput)
+    if normal:
         sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Sorting final matched-normal BAM file, and recalculating tags...\n"]))
-        bwaConfig = os.path.join(sampleDir, "config", "bwa_task.ini")
-        sortAndRetag(sortInput, sortOutput, bwaConfig)
-        open(collapseNormDone, "w").close()
-
-    # Run call (variant calling)
-    callDone = os.path.join(sampleDir, "config", "Call_Complete")
-    pipelineDone = os.path.join(sampleDir, "config", "Pipeline_Complete")
-    if not os.path.exists(callDone):
-        callConfig = os.path.join(sampleDir, "config", "call_task.ini")
-        callPrintPrefix = "DELLINGR-CALL\t\t" + sampleName
-        Call.main(sysStdin=["--config", callConfig], printPrefix=callPrintPrefix)
-        open(callDone, "w").close()
-
-        # Mark this sample as fully processed
-        open(pipelineDone, "w").close()
+    else:
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Sorting final BAM file, and recalculating tags...\n"]))
+    sortAndRetag(sortInput, sortOutput, bwaConfigPath, threads)
+
+
+def promoteResults(files, resultsDir, printPrefix):
+    """
+    Copies the final BAM file (and its index) from the scratch directory to the results directory
+
+    Each file is copied under a temporary name, and renamed once the copy is complete, so an interrupted copy never
+    leaves a truncated file in the results directory
+
+    :param files: A list of filepaths to the files which will be copied
+    :param resultsDir: A string containing a filepath to the sample's results directory
+    :param printPrefix: A string which will be prepended to status messages
+    """
+    sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Copying final BAM file to the results directory...\n"]))
+    for inFile in files:
+        outFile = os.path.join(resultsDir, os.path.basename(inFile))
+        # The modification time is preserved, so the copy is identical to the original when determining if a stage needs
+        # to be re-run
+        shutil.copy2(inFile, outFile + ".partial")
+        os.replace(outFile + ".partial", outFile)
+
+
+def runCall(callConfigPath, callPrintPrefix, inputOverrides=()):
+    """
+    Identifies and filters variants in the sample
+
+    :param callConfigPath: A string containing a filepath to a ini file listing Call's parameters
+    :param callPrintPrefix: A string which will be prepended to Call's status messages
+    :param inputOverrides: A list of additional command line arguments (ex. ["--input", "sample.bam"]), which take
+                    precedence over those in the config file
+    """
+    Call.main(sysStdin=["--config", callConfigPath] + list(inputOverrides), printPrefix=callPrintPrefix)
+
+
+def finishSample(sampleName, sampleDir, printPrefix, cleanup=False, scratchDir=None):
+    """
+    Removes intermediate files (if specified) once all other stages of the pipeline have completed
+
+    :param sampleName: A string containing the sample name
+    :param sampleDir: A string containg the filepath to the base sample directory
+    :param printPrefix: A string which will be prepended to status messages
+    :param cleanup: A boolean indicating if temporary files should be deleted
+    :param scratchDir: A string containing a filepath to the sample's scratch directory (if any). Always removed, as
+                    the final BAM file has already been copied to the results directory
+    """
 
     # Cleanup intermediate files (if specified)
     if cleanup:
@@ -740,9 +936,542 @@ def runPipeline(sampleName, sampleDir, cleanup=False):
         for tmpFile in tmpFiles:
             os.remove(os.path.join(tmpDir, tmpFile))
 
+    if scratchDir is not None:
+        removeScratchDir(scratchDir)
+
     sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "%s: Pipeline Complete\n" % sampleName.rstrip()]))
 
 
+def scratchDirectory(sampleDir):
+    """
+    Determines if this sample's intermediate files are written to a scratch directory (i.e. "--scratch_dir")
+
+    :param sampleDir: A string containg the filepath to the base sample directory
+    :return: A string containing a filepath to the sample's scratch directory. None if intermediate files are written to
+            the sample directory
+    """
+    bwaConfig = os.path.join(sampleDir, "config", "bwa_task.ini")
+    if not os.path.exists(bwaConfig):
+        return None
+    # The intermediate files are written to a "tmp" directory inside the scratch directory
+    workPath = os.path.dirname(os.path.dirname(os.path.abspath(configSection(bwaConfig, "bwa")["output"])))
+    if workPath == os.path.abspath(sampleDir):
+        return None
+    return workPath
+
+
+def removeScratchDir(scratchDir):
+    """
+    Removes a sample's scratch directory, as well as the analysis' scratch directory if no other samples are using it
+
+    :param scratchDir: A string containing a filepath to the sample's scratch directory
+    """
+    shutil.rmtree(scratchDir, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(scratchDir))
+    except OSError:  # i.e. Other samples are still using it
+        pass
+
+
+def configSection(configPath, section):
+    """
+    Loads the arguments listed in the specified config file
+
+    :param configPath: A string containing a filepath to a config file
+    :param section: A string containing the name of the section to load
+    :return: A dictionary listing {argument: parameter}
+    """
+    return ConfigObj(configPath)[section].dict()
+
+
+def asList(parameter):
+    """
+    Config files store single values as a string, and multiple values as a list. Convert either into a list
+
+    :param parameter: A string, a list, or None
+    :return: A list
+    """
+    if parameter is None or parameter == "None":
+        return []
+    if isinstance(parameter, list):
+        return parameter
+    return [parameter]
+
+
+# The version number of each external tool, so each executable is only checked once
+_toolVersions = {}
+
+
+def toolVersion(command, path):
+    """
+    Obtains the version number of the specified tool
+
+    :param command: Literal name of the command
+    :param path: A string containing a filepath to the command executable
+    :return: A string containing the version number
+    """
+    if path not in _toolVersions:
+        _toolVersions[path] = checkCommand(command, path)
+    return _toolVersions[path]
+
+
+# The amount of memory used by samtools sort for each thread, if --sort_memory is not specified
+SAMTOOLS_SORT_MEMORY = 768 * 1024 ** 2
+# The files generated by "bwa index", which are loaded into memory by bwa mem
+BWA_INDEX_EXTENSIONS = (".bwt", ".sa", ".pac", ".ann", ".amb")
+# If the barcode needs to be predicted, there is no need to examine the entire FASTQ file. The base frequencies
+# converge long before then (and AdapterPredict will stop early once the predicted barcode is stable)
+ADAPTER_PREDICT_MAX_READS = 2000000
+
+
+def loadProfileHistory(reportPath):
+    """
+    Loads the peak memory usage of each stage from previous runs, as recorded by writeProfile()
+
+    :param reportPath: A string containing the filepath to a resource usage report. May not exist
+    :return: A dictionary listing {stage: [(peak memory usage, total input size, number of CPUs), ...]}. The number of
+            CPUs is None if it was not recorded
+    """
+    history = {}
+    if reportPath is None or not os.path.exists(reportPath):
+        return history
+    with open(reportPath) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        for line in f:
+            row = dict(zip(header, line.rstrip("\n").split("\t")))
+            if row.get("status") != Scheduler.COMPLETE:
+                continue
+            try:
+                peakMemory = int(row["max_rss_bytes"])
+                inputBytes = int(row["input_bytes"])
+            except (KeyError, ValueError):
+                continue
+            try:
+                cpus = int(row["cpus"])
+            except (KeyError, ValueError):
+                cpus = None
+            # The tumour and normal branches of a sample are run identically
+            stage = row["stage"].replace("-normal", "")
+            if stage not in history:
+                history[stage] = []
+            history[stage].append((peakMemory, inputBytes, cpus))
+    return history
+
+
+def estimateMemory(stage, inputs, threads=1, reference=None, sortMemory=None, history=None):
+    """
+    Estimates the peak memory usage of a pipeline stage
+
+    A conservative estimate is made using the size of the input files (and the bwa index, for alignment). If this stage
+    was run previously (as recorded in the resource usage report), the peak memory usage of each previous run is also
+    scaled by the size of the input files and the number of CPUs, and the largest estimate is used. The history never
+    lowers the estimate, since a previous run may have used less memory than this run will (ex. a different depth)
+
+    :param stage: A string containing the name of the stage (ex. "bwa", "collapse")
+    :param inputs: A list of filepaths to the input files of this stage
+    :param threads: An int specifying the number of CPUs used by this stage
+    :param reference: A string containing a filepath to the reference genome
+    :param sortMemory: A string containing the amount of memory used by samtools sort (ex. 4G). None = samtools default
+    :param history: A dictionary listing {stage: [(peak memory usage, total input size, number of CPUs), ...]} from
+                    previous runs, generated by loadProfileHistory()
+    :return: An int containing the estimated peak memory usage, in bytes
+    """
+
+    stage = stage.replace("-normal", "")
+    estimate = _heuristicMemory(stage, inputs, threads, reference, sortMemory)
+
+    if history is not None and stage in history:
+        inputBytes = sum(os.path.getsize(x) for x in inputs if os.path.exists(x))
+        for peakMemory, previousInputBytes, previousCpus in history[stage]:
+            # Most stages hold a batch of reads (or run a process) for each thread
+            if previousCpus:
+                peakMemory = peakMemory * threads // previousCpus
+            if previousInputBytes > 0:
+                peakMemory = peakMemory * inputBytes // previousInputBytes
+            estimate = max(estimate, peakMemory)
+    return estimate
+
+
+def _heuristicMemory(stage, inputs, threads=1, reference=None, sortMemory=None):
+    """
+    Estimates the peak memory usage of a pipeline stage using the size of its input files (see estimateMemory())
+
+    :return: An int containing the estimated peak memory usage, in bytes
+    """
+
+    inputBytes = sum(os.path.getsize(x) for x in inputs if os.path.exists(x))
+
+    # How much memory will samtools sort use?
+    if sortMemory is not None and sortMemory != "None":
+        sortBytes = parseMemory(sortMemory)
+    else:
+        sortBytes = SAMTOOLS_SORT_MEMORY * threads
+    baseMemory = 256 * 1024 ** 2  # The python interpreter, numpy, etc.
+
+    if stage == "trim":
+        # Each Trim process holds a batch of reads
+        return baseMemory * (threads + 1)
+    elif stage in ("bwa", "trim-bwa"):
+        # bwa loads its index into memory, and each thread holds a batch of reads
+        indexBytes = 0
+        if reference is not None:
+            indexBytes = sum(os.path.getsize(reference + x) for x in BWA_INDEX_EXTENSIONS if os.path.exists(reference + x))
+        return indexBytes + baseMemory * (threads + 1) + sortBytes
+    elif stage == "collapse":
+        # Collapse stores the reads overlapping the current position, which depends upon the depth of the sample
+        # When collapsing in parallel, each process only stores the reads overlapping its own position
+        return 4 * baseMemory * threads + inputBytes
+    elif stage == "sort":
+        return baseMemory + sortBytes
+    elif stage == "call":
+        return 4 * baseMemory + inputBytes // 2
+    return baseMemory
+
+
+def pipelineTasks(sampleName, sampleDir, cleanup=False, threads=1, history=None, sharedReferences=(), hashInputs=False):
+    """
+    Generates the tasks required to run all stages of the Dellingr pipeline on the specified sample
+
+    The tumour and (if specified) normal samples are trimmed, aligned and collapsed independently, so those stages can be
+    run at the same time. Each task records the input files, config file section, and tool versions it was run with in
+    its "*_Complete" file, so tasks which were completed by a previous run (with identical inputs and parameters) are not
+    re-run
+
+    :param sampleName: A string containing the sample name, for status message updates
+    :param sampleDir: A string containg the filepath to the base sample directory
+    :param cleanup: A boolean indicating if temporary files should be deleted
+    :param threads: An int specifying the number of CPUs given to each multithreaded stage (Trim, bwa, Collapse, and sort)
+    :param history: A dictionary listing the peak memory usage of each stage in previous runs, from loadProfileHistory()
+    :param sharedReferences: A list of reference genomes whose bwa index was loaded into shared memory. bwa does not
+                    load these indexes itself, so they are not included in its estimated memory usage
+    :param hashInputs: A boolean. If True, use checksums to determine if the input files of each stage have changed
+    :return: A list of Scheduler.Task objects
+    """
+
+    printPrefix = "DELLINGR-MAIN\t\t" + sampleName
+    configDir = os.path.join(sampleDir, "config")
+    sample = sampleName.rstrip()
+    taskPrefix = sample + ":"  # To ensure the task names of each sample are unique
+    dellingrVersion = __version.__version__
+    tasks = []
+    sortTasks = []
+    promoteTasks = []
+    promoted = {}  # i.e. {final BAM file in the scratch directory: final BAM file in the results directory}
+    resultsDir = os.path.join(sampleDir, "results")
+
+    # Trim, align, and collapse the tumour and normal samples
+    for normalSuffix, printSuffix, stageSuffix in (("", "", ""), ("_normal", "-Normal", "_Normal")):
+        trimConfig = os.path.join(configDir, "trim" + normalSuffix + "_task.ini")  # Where is Trim's config file?
+        bwaConfig = os.path.join(configDir, "bwa" + normalSuffix + "_task.ini")
+        collapseConfig = os.path.join(configDir, "collapse" + normalSuffix + "_task.ini")
+        trimDone = os.path.join(configDir, "Trim" + stageSuffix + "_Complete")  # Similar to Make's "TASK_COMPLETE" file
+        bwaDone = os.path.join(configDir, "BWA" + stageSuffix + "_Complete")
+        trimBWADone = os.path.join(configDir, "Trim_BWA" + stageSuffix + "_Complete")
+        collapseDone = os.path.join(configDir, "Collapse" + stageSuffix + "_Consensus_Complete")
+        sortDone = os.path.join(configDir, "Collapse" + stageSuffix + "_Complete")
+        trimPrintPrefix = "DELLINGR-TRIM\t\t" + sampleName + printSuffix
+        collapsePrintPrefix = "DELLINGR-COLLAPSE\t" + sampleName + printSuffix
+        taskSuffix = printSuffix.lower()
+
+        # Is there a bwa config file? If not, this is the normal, and no matched normal FASTQs were specified
+        if not os.path.exists(bwaConfig):
+            continue
+        bwaArgs = configSection(bwaConfig, "bwa")
+        sortMemory = bwaArgs.get("sort_memory")
+        bwaVersions = {"bwa": toolVersion("bwa", bwaArgs["bwa"]), "samtools": toolVersion("samtools", bwaArgs["samtools"])}
+        # If the bwa index is in shared memory, it is not loaded by each bwa process
+        bwaIndex = None if bwaArgs["reference"] in sharedReferences else bwaArgs["reference"]
+
+        # Is there a trim config file? If not, then we don't need to run trim, as the sample doesn't have barcodes
+        # If the trimmed reads are streamed into bwa, both are run together as a single task
+        if os.path.exists(trimConfig) and isStreamed(bwaConfig):
+            trimArgs = configSection(trimConfig, "trim")
+            alignInputs = asList(trimArgs["input"]) + [bwaArgs["reference"]]
+            alignTask = Scheduler.Task(taskPrefix + "trim-bwa" + taskSuffix, runBWA,
+                                       (bwaConfig, printPrefix, trimConfig, trimPrintPrefix, threads),
+                                       cpus=threads, marker=trimBWADone, sample=sample, inputs=alignInputs,
+                                       memory=functools.partial(estimateMemory, "trim-bwa", alignInputs, threads,
+                                                                bwaIndex, sortMemory, history),
+                                       parameters={"trim": trimArgs, "bwa": bwaArgs,
+                                                   "versions": dict(bwaVersions, dellingr=dellingrVersion)})
+            tasks.append(alignTask)
+        else:
+            alignDependencies = []
+            if os.path.exists(trimConfig):
+                trimArgs = configSection(trimConfig, "trim")
+                trimTask = Scheduler.Task(taskPrefix + "trim" + taskSuffix, runTrim, (trimConfig, trimPrintPrefix, threads),
+                                          cpus=threads, marker=trimDone, sample=sample, inputs=asList(trimArgs["input"]),
+                                          memory=functools.partial(estimateMemory, "trim", asList(trimArgs["input"]),
+                                                                   threads, history=history),
+                                          parameters={"trim": trimArgs, "versions": {"dellingr": dellingrVersion}})
+                tasks.append(trimTask)
+                alignDependencies.append(trimTask.name)
+            alignInputs = asList(bwaArgs["input"]) + [bwaArgs["reference"]]
+            alignTask = Scheduler.Task(taskPrefix + "bwa" + taskSuffix, runBWA, (bwaConfig, printPrefix, None, None, threads),
+                                       dependencies=alignDependencies, cpus=threads, marker=bwaDone, sample=sample,
+                                       inputs=alignInputs,
+                                       memory=functools.partial(estimateMemory, "bwa", alignInputs, threads,
+                                                                bwaIndex, sortMemory, history),
+                                       parameters={"bwa": bwaArgs, "versions": bwaVersions})
+            tasks.append(alignTask)
+
+        # Collapse the aligned reads, then sort the final BAM file
+        if not os.path.exists(collapseConfig):
+            continue
+        collapseArgs = configSection(collapseConfig, "collapse")
+        collapseTask = Scheduler.Task(taskPrefix + "collapse" + taskSuffix, runCollapse, (collapseConfig, collapsePrintPrefix, threads),
+                                      dependencies=[alignTask.name], cpus=threads, marker=collapseDone, sample=sample,
+                                      inputs=[collapseArgs["input"]],
+                                      memory=functools.partial(estimateMemory, "collapse", [collapseArgs["input"]],
+                                                               threads, history=history),
+                                      parameters={"collapse": collapseArgs, "versions": {"dellingr": dellingrVersion}})
+        # Older versions of Dellingr only created "Collapse_Complete" once both Collapse and the final sort had
+        # completed, so if that (empty) marker exists, Collapse has been run
+        if not os.path.exists(collapseDone) and os.path.exists(sortDone) and os.path.getsize(sortDone) == 0:
+            collapseTask.state = Scheduler.COMPLETE
+        # The reference genome is the same for the tumour and normal, so the tumour bwa config is always used here
+        sortTask = Scheduler.Task(taskPrefix + "sort" + taskSuffix, sortCollapsed,
+                                  (collapseConfig, os.path.join(configDir, "bwa_task.ini"), printPrefix, normalSuffix != "", threads),
+                                  dependencies=[collapseTask.name], cpus=threads, marker=sortDone, sample=sample,
+                                  inputs=[collapseArgs["output"]],
+                                  memory=functools.partial(estimateMemory, "sort", [collapseArgs["output"]], threads,
+                                                           sortMemory=sortMemory, history=history),
+                                  parameters={"reference": bwaArgs["reference"],
+                                              "versions": {"samtools": toolVersion("samtools", "samtools")}})
+        tasks.extend((collapseTask, sortTask))
+        sortTasks.append(sortTask.name)
+
+        # If the final BAM file was written to a scratch directory, copy it to the results directory. Since Call reads
+        # the copy in the scratch directory, this is done in the background while Call is running
+        sortOutput = sortedOutput(collapseArgs["output"])
+        if os.path.dirname(os.path.abspath(sortOutput)) != os.path.abspath(resultsDir):
+            promoteFiles = [sortOutput, sortOutput + ".bai"]
+            # Copying files uses very little CPU time
+            promoteTask = Scheduler.Task(taskPrefix + "promote" + taskSuffix, promoteResults, (promoteFiles, resultsDir, printPrefix),
+                                         dependencies=[sortTask.name], cpus=0, sample=sample, inputs=promoteFiles,
+                                         marker=os.path.join(configDir, "Promote" + stageSuffix + "_Complete"),
+                                         memory=functools.partial(estimateMemory, "promote", promoteFiles, history=history),
+                                         parameters={"results": resultsDir})
+            tasks.append(promoteTask)
+            promoteTasks.append(promoteTask.name)
+            promoted[os.path.abspath(sortOutput)] = os.path.join(resultsDir, os.path.basename(sortOutput))
+
+    # Run call (variant calling) once the tumour and normal BAM files have been generated
+    callConfig = os.path.join(configDir, "call_task.ini")
+    callPrintPrefix = "DELLINGR-CALL\t\t" + sampleName
+    callArgs = configSection(callConfig, "call")
+
+    def makeCallTask(bamFiles, overrides, dependencies):
+        callInputs = asList(bamFiles["input"]) + asList(bamFiles.get("normal"))
+        return Scheduler.Task(taskPrefix + "call", runCall, (callConfig, callPrintPrefix, overrides), dependencies=dependencies,
+                              marker=os.path.join(configDir, "Call_Complete"), sample=sample, inputs=callInputs,
+                              memory=functools.partial(estimateMemory, "call", callInputs, history=history),
+                              parameters={"call": dict(callArgs, **bamFiles), "versions": {"dellingr": dellingrVersion}})
+    callBams = dict((x, callArgs[x]) for x in ("input", "normal") if callArgs.get(x) is not None)
+    callTask = makeCallTask(callBams, (), sortTasks)
+    # The scratch directory is removed once the sample is complete. If Call needs to be re-run after that, use the
+    # final BAM files in the results directory instead (which are identical)
+    promotedBams = dict((x, promoted.get(os.path.abspath(y), y)) for x, y in callBams.items())
+    if any(not os.path.exists(x) for x in callBams.values()) and all(os.path.exists(x) for x in promotedBams.values()) \
+            and not callTask.isUpToDate(hashInputs):
+        overrides = []
+        for argument, bamFile in promotedBams.items():
+            overrides.extend(["--" + argument, bamFile])
+        callTask = makeCallTask(promotedBams, overrides, sortTasks + promoteTasks)
+    # Mark this sample as fully processed, and cleanup intermediate files (if specified)
+    finishTask = Scheduler.Task(taskPrefix + "finish", finishSample,
+                                (sampleName, sampleDir, printPrefix, cleanup, scratchDirectory(sampleDir)),
+                                dependencies=[callTask.name] + promoteTasks, marker=os.path.join(configDir, "Pipeline_Complete"),
+                                sample=sample, parameters={"cleanup": cleanup})
+    tasks.extend((callTask, finishTask))
+    return tasks
+
+
+def unfinishedBranches(sampleDir):
+    """
+    Counts the number of branches (i.e. the tumour and matched normal) of a sample which have not been sorted yet
+
+    :param sampleDir: A string containg the filepath to the base sample directory
+    :return: An int
+    """
+    configDir = os.path.join(sampleDir, "config")
+    if os.path.exists(os.path.join(configDir, "Pipeline_Complete")):
+        return 0
+    branches = 0
+    for normalSuffix, stageSuffix in (("", ""), ("_normal", "_Normal")):
+        if os.path.exists(os.path.join(configDir, "bwa" + normalSuffix + "_task.ini")) \
+                and not os.path.exists(os.path.join(configDir, "Collapse" + stageSuffix + "_Complete")):
+            branches += 1
+    return branches
+
+
+# The columns of the resource usage report, and the corresponding field in Scheduler.Task.profile
+PROFILE_COLUMNS = (("wall_seconds", "wall"), ("user_cpu_seconds", "user_cpu"), ("system_cpu_seconds", "system_cpu"),
+                   ("max_rss_bytes", "max_rss"), ("read_bytes", "read_bytes"), ("write_bytes", "write_bytes"),
+                   ("input_bytes", "input_bytes"))
+
+
+def writeProfile(reportPath, tasks, runStart):
+    """
+    Appends the resources used by each stage which was run to a tab-delimited report
+
+    Since the report is appended to, it contains the history of every run in the analysis directory. This can be used
+    to size cluster jobs, or to identify which stage is slower after an upgrade
+
+    :param reportPath: A string containing the filepath to the report
+    :param tasks: A list of Scheduler.Task objects
+    :param runStart: A float containing the time at which this run was started (in seconds since the epoch)
+    """
+    writeHeader = not os.path.exists(reportPath) or os.path.getsize(reportPath) == 0
+    with open(reportPath, "a") as o:
+        if writeHeader:
+            o.write("\t".join(["run_start", "sample", "stage", "status", "cpus"] + list(x[0] for x in PROFILE_COLUMNS) + ["dellingr_version"]) + os.linesep)
+        for task in tasks:
+            # Tasks which were not run (i.e. they were completed previously, or skipped) have no profile
+            if task.profile is None:
+                continue
+            stage = task.name.split(":", 1)[-1]
+            outLine = [time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(runStart)), str(task.sample), stage, task.state, str(task.cpus)]
+            for column, field in PROFILE_COLUMNS:
+                value = task.profile.get(field)
+                if value is None:  # i.e. The task was killed before it could report its resource usage
+                    outLine.append("NA")
+                elif isinstance(value, float):
+                    outLine.append("%.2f" % value)
+                else:
+                    outLine.append(str(value))
+            outLine.append(__version.__version__)
+            o.write("\t".join(outLine) + os.linesep)
+
+
+def runSamples(samplesToProcess, jobs=1, cleanup=False, threads=None, hashInputs=False, reportPath=None, maxMemory=None,
+               sharedIndex=False, workQueue=None, retries=0, failFast=False):
+    """
+    Runs all stages of the Dellingr pipeline on the specified samples
+
+    The stages of every sample are run by a single scheduler, so stages which do not depend upon each other (including
+    stages from different samples) can run at the same time. The CPU budget is split evenly between the branches which
+    can run at once, and each multithreaded stage (Trim, bwa, and samtools sort) is given its share
+
+    :param samplesToProcess: A dictionary listing {sample name: sample directory}
+    :param jobs: An int specifying the maximum number of stages which can run at once
+    :param cleanup: A boolean indicating if temporary files should be deleted
+    :param threads: An int specifying the total number of CPUs which can be used at once. Defaults to jobs
+    :param hashInputs: A boolean. If True, use checksums to determine if the input files of each stage have changed
+    :param reportPath: A string containing a filepath. If specified, the resources used by each stage are appended to
+                    this file
+    :param maxMemory: An int specifying the amount of memory (in bytes) which can be used at once. A stage is only
+                    started if its estimated peak memory usage fits within this limit. None = No limit
+    :param sharedIndex: A boolean. If True, the bwa index is loaded into shared memory once, and used by every sample.
+                    It is removed from shared memory once all samples have been processed
+    :param workQueue: A WorkQueue.WorkQueue object. If specified, other workers (ex. "dellingr worker") can process the
+                    same samples at the same time, and each stage is only run by one of them
+    :param retries: An int specifying the number of times a stage which fails is re-run
+    :param failFast: A boolean. If True, all remaining stages (of every sample) are cancelled once any stage has failed
+    :return: A list of samples which did not complete successfully
+    """
+
+    printPrefix = "DELLINGR-MAIN\t"
+    if threads is None:
+        threads = jobs
+    # How many tumour/normal branches will be aligned and sorted at the same time?
+    branches = sum(unfinishedBranches(x) for x in samplesToProcess.values())
+    concurrentBranches = max(1, min(jobs, branches))
+    threadsPerStage = max(1, threads // concurrentBranches)
+    if threadsPerStage > 1:
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                    "Using %s CPUs for each multithreaded stage\n" % threadsPerStage]))
+
+    # Which reference genomes will the samples be aligned against?
+    references = {}  # i.e. {reference: bwa executable}
+    if sharedIndex:
+        for sampleDir in samplesToProcess.values():
+            if unfinishedBranches(sampleDir) == 0:  # i.e. This sample does not need to be aligned
+                continue
+            for bwaConfig in ("bwa_task.ini", "bwa_normal_task.ini"):
+                bwaConfig = os.path.join(sampleDir, "config", bwaConfig)
+                if os.path.exists(bwaConfig):
+                    bwaArgs = configSection(bwaConfig, "bwa")
+                    references[bwaArgs["reference"]] = bwaArgs["bwa"]
+
+    stagedReferences = []
+    try:
+        # Load each bwa index into shared memory once, instead of once per sample
+        sharedReferences = []
+        sharedBytes = 0
+        for reference, bwaExec in references.items():
+            if stageSharedIndex(reference, bwaExec):
+                stagedReferences.append(reference)
+            sharedSize = listSharedIndexes(bwaExec).get(os.path.basename(reference))
+            if sharedSize is not None:
+                sharedReferences.append(reference)
+                sharedBytes += sharedSize
+        # The shared indexes use memory for the entire run
+        if maxMemory is not None and sharedBytes > 0:
+            maxMemory = max(0, maxMemory - sharedBytes)
+
+        scheduler = Scheduler.Scheduler(cpus=threads, memory=maxMemory, maxTasks=jobs, hashInputs=hashInputs, printPrefix=printPrefix,
+                                        workQueue=workQueue, retries=retries, failFast=failFast)
+        # Use the peak memory usage of previous runs (if available) to estimate how much memory each stage will need
+        history = loadProfileHistory(reportPath)
+
+        # To keep the command line status messages semi-reasonable, normalize for sample name length
+        maxLength = max(list(len(x) for x in samplesToProcess.keys()) + [0])
+        scratchDirs = {}
+        for sample, sampleDir in samplesToProcess.items():
+            sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Processing Sample \'%s\'\n" % sample]))
+            # If this sample uses a scratch directory, it may have been removed (ex. if the analysis was started on
+            # another node). Any intermediate files which are missing will be regenerated
+            scratchDir = scratchDirectory(sampleDir)
+            if scratchDir is not None:
+                scratchDirs[sample] = scratchDir
+                # Other workers may be running on a different host, where this scratch directory does not exist
+                if workQueue is not None:
+                    sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                                "WARNING: \'%s\' uses a scratch directory. All workers processing this sample must have access to \'%s\'\n" % (sample, scratchDir)]))
+                for workDir in ("tmp", "results"):
+                    os.makedirs(os.path.join(scratchDir, workDir), exist_ok=True)
+            for task in pipelineTasks(sample.ljust(maxLength, " "), sampleDir, cleanup, threadsPerStage, history,
+                                      sharedReferences, hashInputs):
+                scheduler.addTask(task)
+
+        runStart = time.time()
+        try:
+            scheduler.run()
+        finally:
+            # Record the resources used by each stage, even if the run was interrupted
+            if reportPath is not None:
+                writeProfile(reportPath, scheduler.tasks.values(), runStart)
+    finally:
+        # Remove the bwa indexes from shared memory, even if the run was interrupted
+        if stagedReferences:
+            releaseSharedIndex(stagedReferences, references[stagedReferences[0]])
+
+    # Which samples did not complete?
+    # Each failed sample was already reported once all of its stages finished
+    failedSamples = sorted(x for x, state in scheduler.sampleResults().items() if state != Scheduler.COMPLETE)
+    if failedSamples:
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                    "ERROR: The following samples did not complete: %s\n" % ", ".join(failedSamples)]))
+    # The scratch directory of each completed sample is no longer needed. This is normally removed once the sample is
+    # finished, but the sample may have been finished by a previous run
+    for sample, scratchDir in scratchDirs.items():
+        if sample not in failedSamples and os.path.exists(scratchDir):
+            removeScratchDir(scratchDir)
+    return failedSamples
+
+
+def runPipeline(sampleName, sampleDir, cleanup=False):
+    """
+    Run all scripts in the Dellingr pipeline on the specified sample
+    :param sampleName: A string containing the sample name, for status message updates
+    :param sampleDir: A string containg the filepath to the base sample directory
+    :param cleanup: A boolean indicating if temporary files should be deleted
+    :return: A boolean indicating if all stages completed successfully
+    """
+    return len(runSamples({sampleName: sampleDir}, jobs=1, cleanup=cleanup)) == 0
+
+
 parser = argparse.ArgumentParser(description="Runs all stages of the Dellingr pipeline on the designated samples")
 parser.add_argument("-c", "--config", metavar="INI", default=None, type=lambda x: isValidFile(x, parser),
                     help="A configuration file, specifying one or more arguments. Overriden by command line parameters")
@@ -795,7 +1524,15 @@ callArgs.add_argument("--threshold", metavar="FLOAT", type=float, help="Classifi
 callArgs.add_argument("-f", "--filter", metavar="PICKLE", type=lambda x:isValidFile(x, parser), help="A python pickle containing a trained Random Forest variant filter")
 
 miscArgs = parser.add_argument_group("Miscellaneous Arguments")
-miscArgs.add_argument("-j", "--jobs", metavar="INT", type=int, help="If multiple samples are specified (using \'-sc\'), how many samples will be processed in parallel")
+miscArgs.add_argument("-j", "--jobs", metavar="INT", type=int, help="Maximum number of pipeline stages to run in parallel. Independent stages (ex. the tumour and normal samples, or different samples) are run concurrently [Default: 1, or all CPUs if \'--max_memory\' is specified]")
+miscArgs.add_argument("--threads", metavar="INT", type=int, help="Total number of CPUs which can be used by all running stages. These are split between samples, and passed to bwa, samtools sort, Trim and Collapse [Default: Same as \'-j\']")
+miscArgs.add_argument("--sort_memory", metavar="SIZE", type=str, help="Maximum amount of memory used by each samtools sort (ex. 4G), split between its threads [Default: samtools default]")
+miscArgs.add_argument("--max_memory", metavar="SIZE", type=str, help="Maximum amount of memory (ex. 64G) used by all running stages. A stage is only started if its estimated memory usage fits within this limit")
+miscArgs.add_argument("--hash_inputs", action="store_true", help="When determining if a stage needs to be re-run, compare the checksums of its input files instead of their modification times")
+miscArgs.add_argument("--executor", choices=["local", "queue"], help="How pipeline stages are run. \'local\' runs all stages on this machine. \'queue\' also allows other workers (\'dellingr worker\') to process the same analysis directory [Default: \'local\']")
+miscArgs.add_argument("--shared_index", action="store_true", help="Load the BWA index into shared memory once (using \'bwa shm\'), and use it to align every sample. Saves memory when aligning several samples at once")
+miscArgs.add_argument("--retries", metavar="INT", type=int, help="Number of times a stage which fails is re-run before its sample is considered failed (ex. to recover from transient filesystem errors) [Default: 0]")
+miscArgs.add_argument("--fail_fast", action="store_true", help="Once any stage has failed, stop all running stages, and do not start any others")
 miscArgs.add_argument("--bwa", help="Path to bwa executable [Default: \'bwa\']")
 miscArgs.add_argument("--samtools", help="Path to samtools executable [Default: \'samtools\']")
 miscArgs.add_argument("--directory_name",
@@ -803,6 +1540,9 @@ miscArgs.add_argument("--directory_name",
 miscArgs.add_argument("--append_to_directory", action="store_true",
                     help="If \'--directory_name\' already exists in the specified output directory, simply append new results to that directory")
 miscArgs.add_argument("--cleanup", action="store_true", help="Remove intermediate files")
+miscArgs.add_argument("--scratch_dir", metavar="DIR", help="Write intermediate files to this directory (ex. a node-local disk) instead of the output directory. Final BAM files are copied to the output directory, and the scratch directory is removed once each sample is complete")
+miscArgs.add_argument("--stream_trim", action="store_true",
+                      help="Stream trimmed reads directly into bwa, instead of writing them to intermediate FASTQ files")
 
 # For config parsing purposes, assign each parameter to the pipeline component from which it originates
 argsToPipelineComponent = {
@@ -814,6 +1554,8 @@ argsToPipelineComponent = {
     "reference": ["pipeline", "collapse", "call"],
     "bwa": ["bwa"],
     "samtools": ["bwa"],
+    "stream_trim": ["bwa"],
+    "sort_memory": ["bwa"],
     "family_mask": ["collapse"],
     "family_mismatch": ["collapse"],
     "duplex_mask": ["collapse"],
@@ -929,7 +1671,7 @@ def main(args=None, sysStdin=None):
             if not barcodeWarned:
                 sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Predicting Barcode Sequences...\n"]))
                 barcodeWarned = True
-            adapterPredictArgs = ["--max_barcode_length", str(len(runArgs["barcode_position"])), "--input"]
+            adapterPredictArgs = ["--max_barcode_length", str(len(runArgs["barcode_position"])), "--max_reads", str(ADAPTER_PREDICT_MAX_READS), "--input"]
             adapterPredictArgs.extend(runArgs["fastqs"])
             runArgs["barcode_sequence"] = AdapterPredict.main(sysStdin=adapterPredictArgs, supressOutput=True)
             # Check if the resulting barcode is garbage
@@ -948,7 +1690,7 @@ def main(args=None, sysStdin=None):
             # If no barcode length was explicitly set for the normal FASTQs, assume it is the same as the tumour sample
             if runArgs["norm_barcode_position"] is None:
                 runArgs["norm_barcode_position"] = runArgs["barcode_position"]
-            adapterPredictArgs = ["--max_barcode_length", str(len(runArgs["norm_barcode_position"])), "--input"]
+            adapterPredictArgs = ["--max_barcode_length", str(len(runArgs["norm_barcode_position"])), "--max_reads", str(ADAPTER_PREDICT_MAX_READS), "--input"]
             adapterPredictArgs.extend(runArgs["normal_fastqs"])
             runArgs["norm_barcode_sequence"] = AdapterPredict.main(sysStdin=adapterPredictArgs, supressOutput=True)
             # Check if the resulting barcode is garbage
@@ -962,7 +1704,12 @@ def main(args=None, sysStdin=None):
         # If matched normal FASTQ files were specified, there will be an output BAM file, so lets specify that to the
         # tumour call script
         if runArgs["normal_fastqs"] is not None:
-            normBam = os.path.join(baseOutDir, sample, "results", sample + ".normal.collapse.sort.bam")
+            # If a scratch directory was specified, Call reads the copy of the BAM file in the scratch directory
+            if runArgs["scratch_dir"] is not None:
+                normDir = sampleScratchDir(runArgs["scratch_dir"], baseOutDir, sample)
+            else:
+                normDir = os.path.join(baseOutDir, sample)
+            normBam = os.path.join(normDir, "results", sample + ".normal.collapse.sort.bam")
             runArgs["normal"] = normBam
 
         # Configure the output directories and config files for this sample
@@ -972,34 +1719,32 @@ def main(args=None, sysStdin=None):
         createLogFile(sLogName, runArgs, bwa=bwaVer, samtools=samtoolsVer, python=pythonVer)
         samplesToProcess[sample] = sampleDir
 
-    # If multiple samples were provided, and more than 1 job was specified, run these samples in parallel
-    if args["jobs"] == 0:  # i.e. use as many threads as possible
-        threads = None  # The multiprocessing module will chose the number of threads
+    # Run all stages of each sample. Independent stages (i.e. the tumour and normal samples, or different samples)
+    # are run in parallel, as long as no more than -j/--jobs stages are running at once
+    # The --threads CPU budget (if specified) is split between the stages which are running at the same time
+    # If a memory limit was specified, the number of stages which are run at once is limited by memory instead
+    maxMemory = None
+    if args["max_memory"] is not None:
+        maxMemory = parseMemory(args["max_memory"])
+    if args["jobs"] is None:
+        jobs = os.cpu_count() if maxMemory is not None else 1
+    elif args["jobs"] <= 0:  # i.e. use as many CPUs as possible
+        jobs = os.cpu_count()
     else:
-        threads = min(len(samplesToProcess), args["jobs"], os.cpu_count())  # Just as a safety measure, don't let the user spawn more threads then there are CPU cores
-
-    if threads > 1 or threads is None:
-        processPool = multiprocessing.Pool(processes=threads)
-
-        # Convert the dictionary which contains the sample arguments into a list of tuples, for multithreading use
-        # In addition, to keep the command line status messages semi-reasonable, normalize for sample name length
-        maxLength = max(len(x) for x in samplesToProcess.keys())
-        multithreadArgs = list((x.ljust(maxLength, " "), y, args["cleanup"]) for x, y in samplesToProcess.items())
-        try:
-            # Run the jobs
-            processPool.imap_unordered(runPipelineMultithread, multithreadArgs)
-            processPool.close()
-            processPool.join()
-        except Exception as e:
-            sys.stderr.write("Error occured while processing sample. Terminating workers..." + os.linesep)
-            # This is very likely to deadlock
-            processPool.terminate()
-            raise e
-
-    else:
-        # Run each sample in series
-        for sample, sampleDir in samplesToProcess.items():
-            runPipeline(sample, sampleDir, args["cleanup"])
+        jobs = args["jobs"]
+
+    # If the work queue is used, other workers (ex. on other hosts) can help process these samples using
+    # "dellingr worker -d <analysis directory>"
+    workQueue = None
+    if args["executor"] == "queue":
+        workQueue = WorkQueue.WorkQueue()
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                    "Additional workers can be started using \'dellingr worker -d %s\'\n" % baseOutDir]))
+    failedSamples = runSamples(samplesToProcess, jobs, args["cleanup"], args["threads"], args["hash_inputs"],
+                               os.path.join(baseOutDir, "Dellingr_profile.tsv"), maxMemory, args["shared_index"],
+                               workQueue, args["retries"], args["fail_fast"])
+    if failedSamples:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,419 @@
+#! /usr/bin/env python
+
+"""
+Routines for reading and writing (possibly gzipped) FASTQ files
+"""
+
+import collections
+import gzip
+import itertools
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import DellingrExceptions as pe
+except ImportError:
+    from Dellingr import DellingrExceptions as pe
+
+
+# A single FASTQ record. Each element is a bytes object, without the trailing line ending
+FastqRecord = collections.namedtuple("FastqRecord", ["name", "seq", "plus", "qual"])
+
+
+class FastqReader:
+    """
+    Reads records from a (possibly gzipped) FASTQ file
+
+    Large blocks of the (decompressed) file are read at once and split into lines as bytes, which is much faster than
+    iterating over the lines of a file opened in text mode
+    """
+
+    def __init__(self, filePath, blockSize=4194304):
+        """
+        :param filePath: A string containing a path to a FASTQ file. If it ends in ".gz", it is assumed to be gzipped
+                        If "-", the (uncompressed) FASTQ records are read from stdin
+        :param blockSize: The number of (decompressed) bytes to read from the file at once
+        """
+
+        self.filePath = filePath
+        self.blockSize = blockSize
+        if filePath == "-":
+            self.filePath = "stdin"
+            self._inFile = sys.stdin.buffer
+        elif filePath.endswith(".gz"):
+            self._inFile = gzip.open(filePath, "rb")
+        else:
+            self._inFile = open(filePath, "rb")
+        self._lines = []
+        self._remainder = b""
+        self._eof = False
+
+    def _fill(self):
+        """
+        Reads the next block of the file, and splits it into lines
+        """
+
+        block = self._inFile.read(self.blockSize)
+        if not block:
+            self._eof = True
+            # The last line of the file may not end with a newline
+            if self._remainder:
+                self._lines.append(self._remainder.rstrip(b"\r"))
+                self._remainder = b""
+            # Ignore any blank lines at the end of the file
+            while self._lines and not self._lines[-1]:
+                self._lines.pop()
+            return
+
+        lines = (self._remainder + block).split(b"\n")
+        # The last line is likely incomplete, so save it until the next block is read
+        self._remainder = lines.pop()
+        if b"\r" in block:  # Windows line endings
+            lines = list(x.rstrip(b"\r") for x in lines)
+        self._lines.extend(lines)
+
+    def readLines(self, batchSize):
+        """
+        Reads the lines of the next batchSize records from this FASTQ file
+
+        :param batchSize: An int specifying the maximum number of records to read
+        :return: A list containing the lines of each record (four per record). This list will be empty once the end of the file is reached
+        :raises InvalidInputException: If the file is truncated, or does not appear to be a FASTQ file
+        """
+
+        lineNum = batchSize * 4
+        while len(self._lines) < lineNum and not self._eof:
+            self._fill()
+
+        if len(self._lines) < lineNum:
+            if len(self._lines) % 4 != 0:
+                raise pe.InvalidInputException("The FASTQ file \'%s\' appears to be truncated" % self.filePath)
+            lineNum = len(self._lines)
+        batchLines = self._lines[:lineNum]
+        self._lines = self._lines[lineNum:]
+
+        # As a sanity check, make sure we are still in sync with the start of each record
+        # If a malformed record shifts the position of the lines, every subsequent record will be out of sync. Thus,
+        # it is sufficient to check the first and last record of each batch
+        if lineNum != 0:
+            for i in (0, lineNum - 4):
+                if batchLines[i][:1] != b"@" or batchLines[i + 2][:1] != b"+":
+                    raise pe.InvalidInputException("The FASTQ file \'%s\' appears to be malformed" % self.filePath)
+        return batchLines
+
+    def readBatch(self, batchSize):
+        """
+        Reads the next batchSize records from this FASTQ file
+
+        :param batchSize: An int specifying the maximum number of records to read
+        :return: A list of FastqRecords. This list will be empty once the end of the file is reached
+        :raises InvalidInputException: If the file is truncated, or does not appear to be a FASTQ file
+        """
+        return linesToRecords(self.readLines(batchSize))
+
+    def __iter__(self):
+        while True:
+            batch = self.readBatch(10000)
+            if not batch:
+                break
+            for record in batch:
+                yield record
+
+    def close(self):
+        # Leave stdin open, as it does not belong to us
+        if self._inFile is not sys.stdin.buffer:
+            self._inFile.close()
+
+
+def linesToRecords(lines):
+    """
+    Groups the lines of a FASTQ file into records
+
+    :param lines: A list containing the lines of each record (four per record)
+    :return: A list of FastqRecords
+    """
+    return list(itertools.starmap(FastqRecord, zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4])))
+
+
+def readID(name):
+    """
+    Obtains the read ID from the name line of a FASTQ record, ignoring any comment and "/1" or "/2" suffix
+
+    :param name: A bytes object containing the name line of a FASTQ record
+    :return: A bytes object containing the read ID
+    """
+    readName = name.split(None, 1)[0]
+    if readName.endswith(b"/1") or readName.endswith(b"/2"):
+        readName = readName[:-2]
+    return readName
+
+
+class PairedFastqReader:
+    """
+    Reads records from a pair of FASTQ files generated from paired-end sequencing, and ensures the mates remain in sync
+    """
+
+    def __init__(self, r1Path, r2Path, blockSize=4194304, checkNames=True):
+        """
+        :param r1Path: A string containing a path to the read 1 FASTQ file
+        :param r2Path: A string containing a path to the read 2 FASTQ file
+        :param blockSize: The number of (decompressed) bytes to read from each file at once
+        :param checkNames: A boolean. If True, ensure the read names of each read pair match
+        """
+
+        self.r1Reader = FastqReader(r1Path, blockSize)
+        self.r2Reader = FastqReader(r2Path, blockSize)
+        self.checkNames = checkNames
+
+    def readLines(self, batchSize):
+        """
+        Reads the lines of the next batchSize read pairs
+
+        :param batchSize: An int specifying the maximum number of read pairs to read
+        :return: Two lists containing the lines of the read 1 and read 2 records. These lists are empty once the end of the files are reached
+        :raises InvalidInputException: If one file has more records than the other, or the read names do not match
+        """
+
+        r1Lines = self.r1Reader.readLines(batchSize)
+        r2Lines = self.r2Reader.readLines(batchSize)
+        if len(r1Lines) != len(r2Lines):
+            raise pe.InvalidInputException("\'%s\' and \'%s\' contain a different number of reads. One of these files may be truncated"
+                                           % (self.r1Reader.filePath, self.r2Reader.filePath))
+        # Ensure the read pairs are still in sync. Once the mates are out of sync, every subsequent read pair will be
+        # as well, so checking the first and last read pair of each batch is sufficient
+        if self.checkNames and r1Lines:
+            for i in (0, len(r1Lines) - 4):
+                r1Name = readID(r1Lines[i])
+                r2Name = readID(r2Lines[i])
+                if r1Name != r2Name:
+                    raise pe.InvalidInputException("Read names \'%s\' and \'%s\' do not match. \'%s\' and \'%s\' appear to be out of sync"
+                                                   % (r1Name.decode(), r2Name.decode(), self.r1Reader.filePath, self.r2Reader.filePath))
+        return r1Lines, r2Lines
+
+    def readBatch(self, batchSize):
+        """
+        Reads the next batchSize read pairs
+
+        :param batchSize: An int specifying the maximum number of read pairs to read
+        :return: Two lists of FastqRecords, containing the read 1 and read 2 records. These lists are empty once the end of the files are reached
+        :raises InvalidInputException: If one file has more records than the other, or the read names do not match
+        """
+        r1Lines, r2Lines = self.readLines(batchSize)
+        return linesToRecords(r1Lines), linesToRecords(r2Lines)
+
+    def readSequences(self, batchSize):
+        """
+        Reads the nucleotide sequences of the next batchSize read pairs
+
+        This is faster than readBatch() if the names and quality scores of each read are not required
+
+        :param batchSize: An int specifying the maximum number of read pairs to read
+        :return: Two lists containing the read 1 and read 2 sequences (as bytes). These lists are empty once the end of the files are reached
+        :raises InvalidInputException: If one file has more records than the other, or the read names do not match
+        """
+        r1Lines, r2Lines = self.readLines(batchSize)
+        return r1Lines[1::4], r2Lines[1::4]
+
+    def __iter__(self):
+        while True:
+            r1Records, r2Records = self.readBatch(10000)
+            if not r1Records:
+                break
+            for records in zip(r1Records, r2Records):
+                yield records
+
+    def close(self):
+        self.r1Reader.close()
+        self.r2Reader.close()
+
+
+class InterleavedFastqReader(PairedFastqReader):
+    """
+    Reads read pairs from a single FASTQ file, where read 1 of each pair is directly followed by read 2
+    """
+
+    def __init__(self, filePath, blockSize=4194304, checkNames=True):
+        """
+        :param filePath: A string containing a path to an interleaved FASTQ file, or "-" to read from stdin
+        :param blockSize: The number of (decompressed) bytes to read from the file at once
+        :param checkNames: A boolean. If True, ensure the read names of each read pair match
+        """
+
+        self.reader = FastqReader(filePath, blockSize)
+        self.checkNames = checkNames
+
+    def readLines(self, batchSize):
+        """
+        Reads the lines of the next batchSize read pairs
+
+        :param batchSize: An int specifying the maximum number of read pairs to read
+        :return: Two lists containing the lines of the read 1 and read 2 records. These lists are empty once the end of the file is reached
+        :raises InvalidInputException: If the last read is missing its mate, or the read names do not match
+        """
+
+        lines = self.reader.readLines(batchSize * 2)
+        if len(lines) % 8 != 0:
+            raise pe.InvalidInputException("The last read in \'%s\' does not have a mate. The file may be truncated" % self.reader.filePath)
+
+        # Split each group of 8 lines into the read 1 and read 2 records
+        r1Lines = []
+        r2Lines = []
+        for i in range(0, 4):
+            r1Lines.append(lines[i::8])
+            r2Lines.append(lines[i + 4::8])
+        r1Lines = list(itertools.chain.from_iterable(zip(*r1Lines)))
+        r2Lines = list(itertools.chain.from_iterable(zip(*r2Lines)))
+
+        # Since the mates of each pair are in the same file, a missing read will shift every subsequent read pair.
+        # Thus, checking the first and last read pair of each batch is sufficient
+        if self.checkNames and r1Lines:
+            for i in (0, len(r1Lines) - 4):
+                r1Name = readID(r1Lines[i])
+                r2Name = readID(r2Lines[i])
+                if r1Name != r2Name:
+                    raise pe.InvalidInputException("Read names \'%s\' and \'%s\' do not match. \'%s\' does not appear to be interleaved"
+                                                   % (r1Name.decode(), r2Name.decode(), self.reader.filePath))
+        return r1Lines, r2Lines
+
+    def close(self):
+        self.reader.close()
+
+
+class BlockGzipWriter:
+    """
+    Writes a gzipped file as a series of independently compressed gzip members
+
+    Data is buffered until a full block is available, and each block is compressed into its own gzip member. As the
+    gzip format allows members to be concatenated, the output can be read by any gzip reader. Since the blocks are
+    independent of each other, they can be compressed by several threads at once (zlib releases the GIL while it is
+    compressing)
+    """
+
+    def __init__(self, filePath, compressionLevel=6, threads=1, blockSize=4194304):
+        """
+        :param filePath: A string containing the output file path
+        :param compressionLevel: An int (0-9) specifying the gzip compression level. 0 stores the data uncompressed
+        :param threads: An int specifying the number of threads to use for compression
+        :param blockSize: The number of (uncompressed) bytes stored in each gzip member
+        """
+
+        if compressionLevel < 0 or compressionLevel > 9:
+            raise ValueError("The compression level must be between 0 and 9")
+        self.compressionLevel = compressionLevel
+        self.blockSize = blockSize
+        self.threads = max(1, threads)
+        self._outFile = open(filePath, "wb")
+        self._buffer = []
+        self._bufferSize = 0
+        self._pendingBlocks = collections.deque()
+        self._empty = True  # Has any data been written?
+        if self.threads > 1:
+            self._compressPool = ThreadPoolExecutor(max_workers=self.threads)
+        else:
+            self._compressPool = None
+        self.closed = False
+
+    def _compress(self, data):
+        """
+        Compresses the specified data into a single gzip member
+
+        :param data: A bytes object
+        :return: A bytes object containing a complete gzip member
+        """
+        compressor = zlib.compressobj(self.compressionLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def _flushBuffer(self):
+        """
+        Compresses the contents of the buffer, and writes out any compressed blocks that are complete
+        """
+
+        if self._bufferSize == 0:
+            return
+        self._empty = False
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._bufferSize = 0
+
+        if self._compressPool is None:
+            self._outFile.write(self._compress(data))
+            return
+
+        # Blocks are written out in the order they were submitted, regardless of which thread finishes first
+        self._pendingBlocks.append(self._compressPool.submit(self._compress, data))
+        while len(self._pendingBlocks) > self.threads * 2:
+            self._outFile.write(self._pendingBlocks.popleft().result())
+
+    def write(self, data):
+        """
+        Adds the specified data to the output file
+
+        :param data: A string or bytes object
+        """
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._buffer.append(data)
+        self._bufferSize += len(data)
+        if self._bufferSize >= self.blockSize:
+            self._flushBuffer()
+
+    def close(self):
+        """
+        Compresses any remaining data, and closes the output file
+        """
+
+        if self.closed:
+            return
+        self._flushBuffer()
+        while self._pendingBlocks:
+            self._outFile.write(self._pendingBlocks.popleft().result())
+        # An empty file is not a valid gzip file, so if nothing was written (ex. no reads were assigned to this
+        # sample), write a single empty gzip member
+        if self._empty:
+            self._outFile.write(self._compress(b""))
+        if self._compressPool is not None:
+            self._compressPool.shutdown()
+        self._outFile.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+def openOutput(filePath, compressionLevel=6, threads=1):
+    """
+    Opens the specified FASTQ file for writing
+
+    If the file name ends in ".gz", the output will be gzipped using the specified compression level and number of
+    threads. Otherwise, the output is written uncompressed
+
+    :param filePath: A string containing the output file path
+    :param compressionLevel: An int (0-9) specifying the gzip compression level
+    :param threads: An int specifying the number of threads to use for compression
+    :return: A writeable (binary) file-like object
+    """
+
+    if filePath.endswith(".gz"):
+        return BlockGzipWriter(filePath, compressionLevel, threads)
+    else:
+        return open(filePath, "wb")
+
+
+def openPairedInput(inputPaths, blockSize=4194304):
+    """
+    Opens the specified paired-end FASTQ file(s) for reading
+
+    :param inputPaths: A list containing either a read 1 and read 2 FASTQ file, or a single interleaved FASTQ file ("-" for stdin)
+    :param blockSize: The number of (decompressed) bytes to read from each file at once
+    :return: A PairedFastqReader or InterleavedFastqReader object
+    """
+
+    if len(inputPaths) == 1:
+        return InterleavedFastqReader(inputPaths[0], blockSize)
+    else:
+        return PairedFastqReader(inputPaths[0], inputPaths[1], blockSize)
@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+
+"""
+Runs a chain of external programs (ex. bwa | samtools sort), where the output of each program is piped into the next
+
+The standard error stream of every program is read by a separate thread as soon as the program is started, so a
+program which writes a large amount to standard error can never stall the chain. Only the last few lines of each
+stream are kept, so they can be printed if a program crashes
+
+Each program is started in its own process group. If any program fails (or the chain takes too long, or the pipeline
+is interrupted), every program in the chain is killed, along with any processes they started
+"""
+
+import collections
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# The number of standard error lines kept for each program
+ERROR_BUFFER_LINES = 200
+
+
+class ProcessChain:
+    """
+    A set of external programs which are run at the same time, and supervised together
+
+    Can be used as a context manager, in which case all programs are killed if an exception occurs
+    """
+
+    def __init__(self, bufferLines=ERROR_BUFFER_LINES):
+        """
+        :param bufferLines: An int specifying the number of standard error lines to keep from each program
+        """
+        self.bufferLines = bufferLines
+        self.names = []
+        self.commands = []
+        self.processes = []
+        self.stderrBuffers = []
+        self._readers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is not None:
+            self.kill()
+        return False
+
+    def add(self, name, command, pipeStdin=False, pipeStdout=False, stderrCallback=None):
+        """
+        Starts a program. If the previous program's output was piped, it is used as the input of this program
+
+        :param name: A string containing the name of this program, for error messages
+        :param command: A list containing the program and its arguments
+        :param pipeStdin: A boolean. If True, the standard input of this program can be written to using
+                        ProcessChain.processes[i].stdin
+        :param pipeStdout: A boolean. If True, the output of this program will be piped into the next program
+        :param stderrCallback: A function which is called with each (decoded) line this program writes to standard
+                        error. Called from a background thread
+        :return: A subprocess.Popen object
+        """
+
+        # Is the previous program's output being piped into this program?
+        previous = self.processes[-1] if self.processes else None
+        if previous is not None and previous.stdout is not None:
+            stdin = previous.stdout
+        elif pipeStdin:
+            stdin = subprocess.PIPE
+        else:
+            stdin = subprocess.DEVNULL
+
+        process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE if pipeStdout else None,
+                                   stderr=subprocess.PIPE, start_new_session=True)
+        # The previous program's output is now only read by this program. Otherwise, if this program crashes, the
+        # previous program would wait forever for someone to read its output
+        if stdin is not subprocess.PIPE and stdin is not subprocess.DEVNULL:
+            stdin.close()
+
+        self.names.append(name)
+        self.commands.append(command)
+        self.processes.append(process)
+        stderrBuffer = collections.deque(maxlen=self.bufferLines)
+        self.stderrBuffers.append(stderrBuffer)
+
+        # Start reading this program's standard error stream immediately
+        reader = threading.Thread(target=self._readStderr, args=(process.stderr, stderrBuffer, stderrCallback))
+        reader.daemon = True
+        reader.start()
+        self._readers.append(reader)
+        return process
+
+    @staticmethod
+    def _readStderr(stream, stderrBuffer, stderrCallback):
+        """
+        Reads a standard error stream until the program closes it
+
+        :param stream: A file object
+        :param stderrBuffer: A collections.deque in which the most recent lines are stored
+        :param stderrCallback: A function which is called with each line (or None)
+        """
+        for line in stream:
+            line = line.decode("utf-8", errors="replace")
+            stderrBuffer.append(line)
+            if stderrCallback is not None:
+                stderrCallback(line)
+        stream.close()
+
+    def wait(self, timeout=None):
+        """
+        Waits for all programs to finish
+
+        If any program fails, all programs which are still running are killed
+
+        :param timeout: A number of seconds after which all programs are killed. None = No timeout
+        :raises subprocess.TimeoutExpired: If the programs did not finish before the timeout
+        :raises subprocess.CalledProcessError: If any program exited with a non-zero exit code
+        """
+        # Since nothing else will be written to the first program, tell it that it has reached the end of its input
+        if self.processes and self.processes[0].stdin is not None and not self.processes[0].stdin.closed:
+            self.processes[0].stdin.close()
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            # Check on every program (not just the first one which is still running), so a failure anywhere in the
+            # chain is noticed immediately
+            returnCodes = list(x.poll() for x in self.processes)
+            if None not in returnCodes:
+                break
+            if any(x not in (None, 0) for x in returnCodes):
+                self.kill()
+                break
+            if deadline is not None and time.time() > deadline:
+                self.kill()
+                raise subprocess.TimeoutExpired(" ".join(self.commands[0]), timeout)
+            time.sleep(0.1)
+
+        for reader in self._readers:
+            reader.join()
+
+        # If a program crashed, the programs writing to it were likely killed by SIGPIPE (or by kill()), so report the
+        # program which actually crashed
+        failed = list(i for i, x in enumerate(self.processes) if x.returncode != 0)
+        if failed:
+            consequences = (-signal.SIGPIPE, -signal.SIGKILL)
+            failed.sort(key=lambda i: self.processes[i].returncode in consequences)
+            culprit = failed[0]
+            raise subprocess.CalledProcessError(self.processes[culprit].returncode, " ".join(self.commands[culprit]))
+
+    def kill(self):
+        """
+        Kills all programs which are still running, as well as any processes they started
+        """
+        for process in self.processes:
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:  # i.e. The program exited in the meantime
+                    pass
+        for process in self.processes:
+            process.wait()
+
+    def errorReport(self):
+        """
+        Generates a summary of the last lines each program wrote to standard error
+
+        :return: A string
+        """
+        report = []
+        for name, stderrBuffer in zip(self.names, self.stderrBuffers):
+            report.append("%s Standard Error Stream:%s" % (name, os.linesep))
+            report.append("".join(stderrBuffer))
+        return "".join(report)
@@ -2,17 +2,20 @@
 
 """
 Resumes a previously terminated analysis. Only works for analysis generated using Dellingr version 0.9 and above
+
+Also used by "dellingr worker", which processes an analysis directory alongside other workers (possibly on other
+hosts). Each stage is only run by the worker which obtains its lease (see WorkQueue)
 """
 
 import argparse
 import os
 import sys
-import multiprocessing
 
 try:
     import DellingrPipeline
+    import WorkQueue
 except ImportError:
-    from Dellingr import DellingrPipeline
+    from Dellingr import DellingrPipeline, WorkQueue
 
 
 def isValidDir(dir, parser):
@@ -30,23 +33,37 @@ def isValidDir(dir, parser):
     else:
         return dir
 
-def getArgs(stdin):
+def getArgs(stdin, worker=False):
 
-    parser = argparse.ArgumentParser(description="Resumes analysis of a previously terminated Pipeline")
+    if worker:
+        parser = argparse.ArgumentParser(description="Processes the samples in an existing Dellingr analysis directory, alongside any other workers (ex. on other hosts) processing the same directory")
+    else:
+        parser = argparse.ArgumentParser(description="Resumes analysis of a previously terminated Pipeline")
     parser.add_argument("-d", "--dellingr_dir", type=lambda x: isValidDir(x, parser), required=True, help="An existing output directory for Dellingr analysis")
-    parser.add_argument("-j", "--jobs", metavar="INT", default=1, type=int, help="Number of samples to process in parallel")
+    parser.add_argument("-j", "--jobs", metavar="INT", default=None, type=int, help="Maximum number of pipeline stages to run in parallel [Default: 1, or all CPUs if \'--max_memory\' is specified]")
+    parser.add_argument("--threads", metavar="INT", default=None, type=int, help="Total number of CPUs which can be used by all running stages. These are split between samples, and passed to bwa, samtools sort, Trim and Collapse [Default: Same as \'-j\']")
+    parser.add_argument("--max_memory", metavar="SIZE", type=str, help="Maximum amount of memory (ex. 64G) used by all running stages. A stage is only started if its estimated memory usage fits within this limit")
     parser.add_argument("--cleanup", action="store_true", help="Once a sample is processed, remove intermediate files")
+    parser.add_argument("--hash_inputs", action="store_true", help="When determining if a stage needs to be re-run, compare the checksums of its input files instead of their modification times")
+    if not worker:  # Workers always use the work queue
+        parser.add_argument("--executor", choices=["local", "queue"], default="local", help="How pipeline stages are run. \'local\' runs all stages on this machine. \'queue\' also allows other workers (\'dellingr worker\') to process the same analysis directory [Default: \'local\']")
+    parser.add_argument("--lease_timeout", metavar="SECONDS", type=int, default=WorkQueue.LEASE_TIMEOUT, help="If a worker has not updated the lease of the stage it is running in this long, assume the worker has died, and allow another worker to run that stage. Should be the same for all workers [Default: %s]" % WorkQueue.LEASE_TIMEOUT)
+    parser.add_argument("--shared_index", action="store_true", help="Load the BWA index into shared memory once (using \'bwa shm\'), and use it to align every sample")
+    parser.add_argument("--retries", metavar="INT", type=int, default=0, help="Number of times a stage which fails is re-run before its sample is considered failed (ex. to recover from transient filesystem errors) [Default: 0]")
+    parser.add_argument("--fail_fast", action="store_true", help="Once any stage has failed, stop all running stages, and do not start any others")
     if stdin is None:
         return parser.parse_args()
     else:
         return parser.parse_args(stdin)
 
 
-def main(args=None, sysStdin=None):
+def main(args=None, sysStdin=None, worker=False):
     if args is None:
-        args = getArgs(sysStdin)
+        args = getArgs(sysStdin, worker)
 
     args = vars(args)
+    if worker:
+        args["executor"] = "queue"
     args["dellingr_dir"] = os.path.abspath(args["dellingr_dir"])
     # Assuming that the directory the user provided is actually a "dellingr_analysis_directory", we need to figure out what samples are in it
     # Since each directory corresponds to a different sample, obtain a list of all subdirectories
@@ -71,30 +88,35 @@ def main(args=None, sysStdin=None):
     if len(validSamples) == 0:
          sys.stderr.write("ERROR: Unable to find any valid sample directories in \"%s\". Check that this a directory was created by \"run_dellingr\", and that configuration completed sucessfully." % args["dellingr_dir"] + os.linesep)
 
-    # If multiple samples are to be processed in parallel
-    if args["jobs"] == 0:
-        threads = None
-    else:
-        threads = min(len(validSamples), args["jobs"], os.cpu_count())
-    if threads > 1 or threads is None:
-        # Convert the dictionary which contains the sample arguments into a list of tuples, for multithreading use
-        # In addition, to keep the command line status messages semi-reasonable, normalize for sample name length
-        maxLength = max(len(x) for x in validSamples.keys())
-        multithreadArgs = list((x.ljust(maxLength, " "), y, args["cleanup"]) for x, y in validSamples.items())
-
-        processPool = multiprocessing.Pool(processes=threads)
+    # Re-run each sample. Stages which were already completed (i.e. their "*_Complete" file exists) are skipped
+    # Independent stages are run in parallel, as long as no more than -j/--jobs stages are running at once
+    # The --threads CPU budget (if specified) is split between the stages which are running at the same time
+    # If a memory limit was specified, the number of stages which are run at once is limited by memory instead
+    maxMemory = None
+    if args["max_memory"] is not None:
         try:
-            # Run the jobs
-            processPool.imap_unordered(DellingrPipeline.runPipelineMultithread, multithreadArgs)
-            processPool.close()
-            processPool.join()
-        except Exception as e:
-            sys.stderr.write("Error occured while processing sample. Terminating workers..." + os.linesep)
-            processPool.terminate()
-            raise e
-    # Obtain the sample name, and re-run this sample
-    for sampleName, sPath in validSamples.items():
-        DellingrPipeline.runPipeline(sampleName, sPath, args["cleanup"])
+            maxMemory = DellingrPipeline.parseMemory(args["max_memory"])
+        except ValueError as e:
+            sys.stderr.write("ERROR: \'--max_memory\': %s\n" % e)
+            sys.exit(1)
+    if args["jobs"] is None:
+        jobs = os.cpu_count() if maxMemory is not None else 1
+    elif args["jobs"] <= 0:  # i.e. use as many CPUs as possible
+        jobs = os.cpu_count()
+    else:
+        jobs = args["jobs"]
+    # If the work queue is used, each stage is only run by the worker which obtains its lease
+    workQueue = None
+    if args["executor"] == "queue":
+        if args["lease_timeout"] < 1:
+            sys.stderr.write("ERROR: \'--lease_timeout\' must be at least 1 second\n")
+            sys.exit(1)
+        workQueue = WorkQueue.WorkQueue(leaseTimeout=args["lease_timeout"])
+    failedSamples = DellingrPipeline.runSamples(validSamples, jobs, args["cleanup"], args["threads"], args["hash_inputs"],
+                                                os.path.join(args["dellingr_dir"], "Dellingr_profile.tsv"), maxMemory,
+                                                args["shared_index"], workQueue, args["retries"], args["fail_fast"])
+    if failedSamples:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
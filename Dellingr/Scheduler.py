@@ -0,0 +1,753 @@
+#! /usr/bin/env python
+
+"""
+Runs the stages of the Dellingr pipeline as a dependency graph
+
+Each stage (ex. Trim, bwa, Collapse) is a Task with a set of dependencies, and an estimate of the number of CPUs and
+the amount of memory it requires. A Task is started (in its own process) once all of its dependencies have completed,
+and enough CPUs and memory are available. Thus, independent stages (such as the tumour and normal branches of the same
+sample, or different samples) can run concurrently, while sharing a single resource budget
+
+Each Task can have a marker file (ex. "Trim_Complete") which is created once the Task completes. The marker file stores
+a fingerprint of the Task: the identity (size, modification time, and optionally a checksum) of each input file, as well
+as the Task's parameters (ex. its config file section and tool versions). When the pipeline is re-run, a Task is only
+skipped if its fingerprint is unchanged. If a Task is re-run, all Tasks which depend upon it are also re-run
+
+The resources used by each Task (wall time, CPU time, peak memory usage, and disk IO, including any external programs
+it runs) are recorded in Task.profile
+
+If a WorkQueue is specified, several schedulers (i.e. workers, possibly on different hosts) can run the same Tasks. Each
+Task is only run by the worker which obtains its lease, and the other workers wait for it to complete
+"""
+
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+import traceback
+
+# Task states
+PENDING = "Pending"
+RUNNING = "Running"
+COMPLETE = "Complete"
+FAILED = "Failed"
+SKIPPED = "Skipped"  # One of this task's dependencies failed
+ELSEWHERE = "Running Elsewhere"  # This task is being run by another worker
+CANCELLED = "Cancelled"  # Another task failed, and the scheduler was told to stop at the first failure
+FINISHED = (COMPLETE, FAILED, SKIPPED, CANCELLED)
+
+# How often (in seconds) the memory usage of a running task (and all of its child processes) is sampled
+MEMORY_SAMPLE_INTERVAL = 0.5
+
+
+class Task:
+    """
+    A single stage of the pipeline
+    """
+
+    def __init__(self, name, function, args=(), dependencies=(), cpus=1, memory=0, marker=None, sample=None,
+                 inputs=(), parameters=None):
+        """
+        :param name: A string containing a unique name for this task
+        :param function: The function to run. Must be a module-level function, so it can be run in another process
+        :param args: A tuple of arguments to pass to the function
+        :param dependencies: A list of Task names which must complete before this task is run
+        :param cpus: An int specifying the number of CPUs this task uses
+        :param memory: An int specifying the (estimated) amount of memory this task uses, in bytes. Alternatively, a
+                    function which returns this estimate. The function is called once all of this task's dependencies
+                    have completed (i.e. once its input files exist)
+        :param marker: A string containing a filepath. This file is created once this task completes
+        :param sample: A string containing the name of the sample this task belongs to (if any)
+        :param inputs: A list of filepaths read by this task
+        :param parameters: A JSON-serializable dictionary listing anything else which affects the output of this task
+                        (ex. arguments and tool versions)
+        """
+
+        self.name = name
+        self.function = function
+        self.args = args
+        self.dependencies = list(dependencies)
+        self.cpus = cpus
+        self.memory = memory
+        self.marker = marker
+        self.sample = sample
+        self.inputs = list(inputs)
+        self.parameters = parameters if parameters is not None else {}
+        self.state = PENDING
+        self.exitCode = None
+        self.profile = None  # The resources used by this task, once it has been run
+        self._process = None
+        self._connection = None
+        self._startTime = None
+        self._inputBytes = 0
+        self._waitingForMemory = False
+        self.attempts = 0  # The number of times this task has been started
+        self._retryAfter = 0  # If this task failed, it is not retried until this time
+        self.leaseContents = None  # The lease of the worker running this task (if a WorkQueue is used)
+
+    def fingerprint(self, hashInputs=False):
+        """
+        Summarizes everything which affects the output of this task
+
+        :param hashInputs: A boolean. If True, include the checksum of each input file
+        :return: A dictionary
+        """
+        inputs = {}
+        for inputFile in self.inputs:
+            inputs[os.path.abspath(inputFile)] = fileIdentity(inputFile, hashInputs)
+        return {"inputs": inputs, "parameters": self.parameters}
+
+    def isUpToDate(self, hashInputs=False):
+        """
+        Was this task completed by a previous run, using the same inputs and parameters?
+
+        Input files which no longer exist (ex. intermediate files which were cleaned up) are not compared, as the task
+        which generated them is checked separately
+
+        :param hashInputs: A boolean. If True, also compare the checksum of each input file
+        :return: A boolean
+        """
+        if self.marker is None or not os.path.exists(self.marker):
+            return False
+        with open(self.marker) as f:
+            contents = f.read()
+        # Marker files generated by older versions of Dellingr are empty. Since there is nothing to compare against,
+        # trust them
+        if contents.strip() == "":
+            return True
+        try:
+            previous = json.loads(contents)
+            previousInputs = previous["inputs"]
+            previousParameters = previous["parameters"]
+        except (ValueError, KeyError, TypeError):
+            return False
+
+        # Round-trip the current parameters through JSON, so tuples, etc. compare equal to their stored equivalents
+        if json.loads(json.dumps(self.parameters)) != previousParameters:
+            return False
+        if set(os.path.abspath(x) for x in self.inputs) != set(previousInputs.keys()):
+            return False
+        for inputFile in self.inputs:
+            if not os.path.exists(inputFile):
+                continue
+            previousIdentity = previousInputs[os.path.abspath(inputFile)]
+            if not isinstance(previousIdentity, dict):
+                return False
+            # If checksums are available, they are used instead of the modification time, so a file which was copied
+            # or touched (but not modified) is not considered to have changed
+            hashContents = hashInputs and "md5" in previousIdentity
+            identity = fileIdentity(inputFile, hashContents)
+            if identity["size"] != previousIdentity.get("size"):
+                return False
+            if hashContents and identity["md5"] != previousIdentity["md5"]:
+                return False
+            if not hashContents and identity["mtime"] != previousIdentity.get("mtime"):
+                return False
+        return True
+
+    def writeMarker(self, fingerprint):
+        """
+        Records that this task has completed, by saving its fingerprint to the marker file
+
+        :param fingerprint: A dictionary, as generated by fingerprint()
+        """
+        if self.marker is None:
+            return
+        with open(self.marker, "w") as o:
+            json.dump(fingerprint, o, indent=1, sort_keys=True)
+            o.write("\n")
+
+
+def fileIdentity(filePath, hashContents=False):
+    """
+    Generates a summary of the specified file which will change if the file is modified
+
+    :param filePath: A string containing a filepath
+    :param hashContents: A boolean. If True, also calculate the MD5 checksum of the file
+    :return: A dictionary listing the size, modification time, and (optionally) checksum of the file. None if the file
+            does not exist
+    """
+    try:
+        fileStat = os.stat(filePath)
+    except OSError:
+        return None
+    identity = {"size": fileStat.st_size, "mtime": fileStat.st_mtime_ns}
+    if hashContents:
+        md5 = hashlib.md5()
+        with open(filePath, "rb") as f:
+            for chunk in iter(lambda: f.read(1048576), b""):
+                md5.update(chunk)
+        identity["md5"] = md5.hexdigest()
+    return identity
+
+
+def resourceUsage():
+    """
+    Obtains the resources used by this process, and all child processes which have finished
+
+    :return: A dictionary listing the user and system CPU time (in seconds), the peak memory usage of this process or
+            any single child process (in bytes), and the number of bytes read from and written to disk. Since child
+            processes which ran at the same time are not combined, use MemoryMonitor to obtain the peak memory usage of
+            the entire process tree
+    """
+    selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+    childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    rssUnits = 1 if sys.platform == "darwin" else 1024
+    usage = {
+        "user_cpu": selfUsage.ru_utime + childUsage.ru_utime,
+        "system_cpu": selfUsage.ru_stime + childUsage.ru_stime,
+        "max_rss": max(selfUsage.ru_maxrss, childUsage.ru_maxrss) * rssUnits,
+        # Fall back to the number of blocks (512 bytes) read and written if /proc is not available
+        "read_bytes": (selfUsage.ru_inblock + childUsage.ru_inblock) * 512,
+        "write_bytes": (selfUsage.ru_oublock + childUsage.ru_oublock) * 512
+    }
+    # On Linux, the IO counters of a process include those of every child process it has waited on
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                field, value = line.split(":")
+                if field in ("read_bytes", "write_bytes"):
+                    usage[field] = int(value)
+    except (OSError, ValueError):
+        pass
+    return usage
+
+
+def _childProcesses(pid, parents=None):
+    """
+    Lists the child processes of the specified process
+
+    :param pid: An int containing a process ID
+    :param parents: A dictionary listing {process ID: parent process ID} for every process, from _parentProcesses().
+                    Only used if the kernel does not list the children of each process
+    :return: A list of process IDs
+    """
+    if parents is not None:
+        return list(x for x, parent in parents.items() if parent == pid)
+    children = []
+    for thread in os.listdir("/proc/%s/task" % pid):
+        with open("/proc/%s/task/%s/children" % (pid, thread)) as f:
+            children.extend(int(x) for x in f.read().split())
+    return children
+
+
+def _parentProcesses():
+    """
+    :return: A dictionary listing {process ID: parent process ID} for every running process
+    """
+    parents = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % pid) as f:
+                # The process name (field 2) can contain spaces, so the parent process ID is found after its end
+                parents[int(pid)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):  # i.e. The process has finished
+            pass
+    return parents
+
+
+def processTreeMemory(pid):
+    """
+    Calculates the total memory usage (resident set size) of the specified process, and all of its descendants
+
+    :param pid: An int containing a process ID
+    :return: An int containing the memory usage, in bytes. None if this is not available (i.e. /proc does not exist)
+    """
+    totalRss = None
+    parents = None
+    toVisit = [pid]
+    while toVisit:
+        pid = toVisit.pop()
+        try:
+            with open("/proc/%s/status" % pid) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        totalRss = (totalRss or 0) + int(line.split()[1]) * 1024  # VmRSS is in kilobytes
+                        break
+        except (OSError, ValueError):  # i.e. The process has finished
+            continue
+        try:
+            toVisit.extend(_childProcesses(pid, parents))
+        except OSError:
+            # The kernel does not list the children of each process. Find the parent of every process instead
+            parents = _parentProcesses()
+            toVisit.extend(_childProcesses(pid, parents))
+    return totalRss
+
+
+class MemoryMonitor(threading.Thread):
+    """
+    Periodically samples the total memory usage of this process and all of its descendants (ex. external programs, or
+    the workers of a multiprocessing.Pool), and records the peak
+
+    Unlike ru_maxrss, which only lists the peak of the single largest process, this includes child processes which run
+    at the same time (ex. bwa piped into samtools)
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        """
+        :param interval: A number of seconds specifying how often the memory usage is sampled
+        """
+        threading.Thread.__init__(self, name="MemoryMonitor", daemon=True)
+        self.interval = interval
+        self.peak = None  # The peak memory usage (in bytes), or None if it could not be sampled
+        self._pid = os.getpid()
+        self._stopEvent = threading.Event()
+
+    def sample(self):
+        memory = processTreeMemory(self._pid)
+        if memory is not None and (self.peak is None or memory > self.peak):
+            self.peak = memory
+
+    def run(self):
+        while True:
+            self.sample()
+            if self._stopEvent.wait(self.interval):
+                break
+
+    def stop(self):
+        """
+        Stops sampling, and waits for the final sample
+
+        :return: The peak memory usage, in bytes (or None)
+        """
+        self._stopEvent.set()
+        self.join()
+        return self.peak
+
+
+def _terminate(signalNumber, frame):
+    """
+    Converts a SIGTERM into an exception, so the task can clean up (ex. kill any external programs it started)
+    """
+    raise SystemExit(128 + signalNumber)
+
+
+def _runTask(task, hashInputs=False, connection=None):
+    """
+    Runs a task inside a worker process, and creates its marker file if it completes successfully
+
+    Any exceptions are printed before the process exits, since they would otherwise be lost
+
+    :param task: The Task to run
+    :param hashInputs: A boolean. If True, include the checksum of each input file in the task's fingerprint
+    :param connection: A multiprocessing.Connection. If specified, the resources used by this task are sent through it
+    """
+    signal.signal(signal.SIGTERM, _terminate)
+    startUsage = resourceUsage()
+    memoryMonitor = None
+    if connection is not None:
+        memoryMonitor = MemoryMonitor()
+        memoryMonitor.start()
+    error = None
+    try:
+        # The inputs are fingerprinted before the task starts, so any changes made while it is running will be caught
+        # by the next run
+        fingerprint = task.fingerprint(hashInputs)
+        try:
+            task.function(*task.args)
+        except SystemExit as e:
+            # Many stages call exit() if they encounter an error
+            if e.code not in (None, 0):
+                raise
+        task.writeMarker(fingerprint)
+    except SystemExit as e:
+        error = e
+    except BaseException:
+        traceback.print_exc()
+        error = SystemExit(1)
+
+    # Report the resources used by this task, even if it failed
+    if connection is not None:
+        endUsage = resourceUsage()
+        for field in ("user_cpu", "system_cpu", "read_bytes", "write_bytes"):
+            endUsage[field] -= startUsage[field]
+        # The peak of the entire process tree (as sampled) includes child processes which ran at the same time
+        treePeak = memoryMonitor.stop()
+        if treePeak is not None:
+            endUsage["max_rss"] = max(endUsage["max_rss"], treePeak)
+        try:
+            connection.send(endUsage)
+        except (OSError, ValueError):
+            pass
+        connection.close()
+    sys.stderr.flush()
+    if error is not None:
+        raise error
+
+
+class Scheduler:
+    """
+    Runs a set of Tasks, starting each Task once its dependencies have completed and enough resources are available
+    """
+
+    def __init__(self, cpus=1, memory=None, maxTasks=None, hashInputs=False, printPrefix="DELLINGR-SCHEDULER\t",
+                 workQueue=None, retries=0, retryDelay=60, failFast=False):
+        """
+        :param cpus: An int specifying the number of CPUs that can be used at once
+        :param memory: An int specifying the amount of memory (in bytes) that can be used at once. None = No limit
+        :param maxTasks: An int specifying the maximum number of tasks which can run at once. None = No limit. Tasks
+                        which do not use any CPUs (ex. copying files in the background) are not counted
+        :param hashInputs: A boolean. If True, the checksum of each input file is used to determine if a task has changed
+        :param printPrefix: A string which is prepended to status messages
+        :param workQueue: A WorkQueue.WorkQueue object. If specified, tasks (with a marker file) are only run if their
+                        lease can be obtained, so other workers can run the same tasks. None = Run all tasks locally
+        :param retries: An int specifying the number of times a task which fails is re-run before it is considered failed
+        :param retryDelay: A number of seconds to wait before re-running a task which failed (ex. so a network filesystem
+                        has time to recover)
+        :param failFast: A boolean. If True, once any task has failed (and will not be retried), all running tasks are
+                        stopped, and no further tasks are started
+        """
+
+        self.cpus = max(1, cpus)
+        self.memory = memory
+        self.maxTasks = None if maxTasks is None else max(1, maxTasks)
+        self.hashInputs = hashInputs
+        self.printPrefix = printPrefix
+        self.workQueue = workQueue
+        self.retries = max(0, retries)
+        self.retryDelay = retryDelay
+        self.failFast = failFast
+        self.tasks = {}  # Tasks are started in the order they were added (if possible)
+
+    def addTask(self, task):
+        """
+        Adds the specified Task to this scheduler
+
+        :param task: A Task object
+        :raises ValueError: If a Task with the same name was already added
+        """
+        if task.name in self.tasks:
+            raise ValueError("A task named \'%s\' was already added" % task.name)
+        self.tasks[task.name] = task
+
+    def _checkGraph(self):
+        """
+        Ensures every dependency exists, and that there are no circular dependencies
+
+        In addition, determines which tasks were completed by a previous run. A task is re-run if its fingerprint has
+        changed, if any of its dependencies are re-run, or if a task which depends upon it needs to be re-run and its
+        output no longer exists
+
+        :raises ValueError: If a dependency is missing, or the dependencies contain a cycle
+        """
+
+        for task in self.tasks.values():
+            for dependency in task.dependencies:
+                if dependency not in self.tasks:
+                    raise ValueError("Task \'%s\' depends on \'%s\', which does not exist" % (task.name, dependency))
+
+        # Check for cycles by repeatedly removing tasks which have no (remaining) dependencies
+        # If any tasks are left over, they must depend upon each other
+        remaining = dict((name, set(task.dependencies)) for name, task in self.tasks.items())
+        ready = list(name for name, dependencies in remaining.items() if not dependencies)
+        while ready:
+            name = ready.pop()
+            del remaining[name]
+            for otherName, dependencies in remaining.items():
+                if name in dependencies:
+                    dependencies.remove(name)
+                    if not dependencies:
+                        ready.append(otherName)
+        if remaining:
+            raise ValueError("The following tasks have circular dependencies: %s" % ", ".join(sorted(remaining.keys())))
+
+        # Which tasks were completed by a previous run?
+        for task in self.tasks.values():
+            if task.state == PENDING and task.isUpToDate(self.hashInputs):
+                task.state = COMPLETE
+
+        changed = True
+        while changed:
+            changed = False
+            for task in self.tasks.values():
+                if task.state != PENDING:
+                    continue
+                # If this task's input files are missing (ex. they were removed by --cleanup), the tasks which
+                # generated them need to be re-run
+                if any(not os.path.exists(x) for x in task.inputs):
+                    for dependency in task.dependencies:
+                        if self.tasks[dependency].state == COMPLETE:
+                            self.tasks[dependency].state = PENDING
+                            changed = True
+                # If this task is re-run, everything which depends upon it must also be re-run
+                for otherTask in self.tasks.values():
+                    if task.name in otherTask.dependencies and otherTask.state == COMPLETE:
+                        otherTask.state = PENDING
+                        changed = True
+
+    def _isReady(self, task):
+        """
+        Have all the dependencies of this task completed?
+
+        :param task: A Task object
+        :return: A boolean
+        """
+        return all(self.tasks[x].state == COMPLETE for x in task.dependencies)
+
+    def _skipDependents(self, failedTask):
+        """
+        Marks all tasks which depend upon the specified task (directly or indirectly) as skipped
+
+        :param failedTask: A Task object which failed
+        """
+        toSkip = [failedTask.name]
+        while toSkip:
+            name = toSkip.pop()
+            for task in self.tasks.values():
+                if name in task.dependencies and task.state == PENDING:
+                    task.state = SKIPPED
+                    toSkip.append(task.name)
+                    sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                                "Skipping \'%s\', as \'%s\' failed\n" % (task.name, failedTask.name)]))
+
+    def sampleResults(self):
+        """
+        Summarizes the state of each sample
+
+        :return: A dictionary listing {sample: COMPLETE, FAILED, or None (i.e. still running)}. A sample has failed if
+                any of its tasks did not complete
+        """
+        results = {}
+        for task in self.tasks.values():
+            if task.sample is None:
+                continue
+            if task.state not in FINISHED:
+                results[task.sample] = None
+            elif task.state != COMPLETE and results.get(task.sample, COMPLETE) is not None:
+                results[task.sample] = FAILED
+            elif task.sample not in results:
+                results[task.sample] = COMPLETE
+        return results
+
+    def _reportSamples(self, reported):
+        """
+        Prints an error message for each sample which has failed, as soon as all of its tasks have finished
+
+        :param reported: A set of samples which have already been reported. Updated in place
+        """
+        for sample, state in self.sampleResults().items():
+            if state is None or sample in reported:
+                continue
+            reported.add(sample)
+            if state == FAILED:
+                failedTasks = list(x.name for x in self.tasks.values() if x.sample == sample and x.state == FAILED)
+                reason = "failed: %s" % ", ".join(failedTasks) if failedTasks else "cancelled"
+                sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                            "ERROR: Sample \'%s\' did not complete (%s)\n" % (sample, reason)]))
+
+    def _stopRunning(self, running, state):
+        """
+        Stops all running tasks
+
+        :param running: A dictionary listing {process sentinel: Task}
+        :param state: The state the stopped tasks are set to
+        """
+        # Tasks convert SIGTERM into an exception, so they can stop any external programs they started
+        for task in running.values():
+            task._process.terminate()
+        for task in running.values():
+            task._process.join()
+            task.state = state
+            # Allow another worker to run this task
+            if self.workQueue is not None:
+                self.workQueue.release(task)
+        running.clear()
+
+    def _receiveProfile(self, task):
+        """
+        Obtains the resources used by the specified (finished) task
+
+        :param task: A Task object
+        :return: A dictionary listing the resources used by this task, as generated by resourceUsage(), as well as the
+                wall time (in seconds) and the total size of its input files (in bytes)
+        """
+        profile = {}
+        try:
+            if task._connection.poll():
+                profile = task._connection.recv()
+        except (EOFError, OSError):  # i.e. The task was killed before it could report its resource usage
+            pass
+        task._connection.close()
+        profile["wall"] = time.time() - task._startTime
+        profile["input_bytes"] = task._inputBytes
+        return profile
+
+    def run(self):
+        """
+        Runs all tasks
+
+        :return: A dictionary listing {task name: task state}
+        """
+
+        self._checkGraph()
+        # Keep track of which tasks are completed by other workers from now on
+        if self.workQueue is not None:
+            for task in self.tasks.values():
+                if task.marker is not None:
+                    self.workQueue.watch(task)
+        usedCpus = 0
+        usedMemory = 0
+        running = {}  # {process sentinel: Task}
+        elsewhere = []  # Tasks being run by other workers
+        reportedSamples = set()
+        cancel = False
+
+        try:
+            while True:
+                # Start as many tasks as possible
+                progressed = False  # Did any task finish without being run by this worker?
+                runningTasks = sum(1 for x in running.values() if x.cpus > 0)
+                for task in self.tasks.values():
+                    # Tasks which do not use any CPUs (ex. copying files) do not count towards the maximum number of
+                    # tasks, so they can run in the background alongside the next stage
+                    if self.maxTasks is not None and task.cpus > 0 and runningTasks >= self.maxTasks:
+                        continue
+                    if task.state != PENDING or not self._isReady(task) or task._retryAfter > time.time():
+                        continue
+                    if callable(task.memory):
+                        task.memory = int(task.memory())
+                    # Tasks which need more resources than are available in total are run by themselves
+                    cpus = min(task.cpus, self.cpus)
+                    memory = task.memory if self.memory is None else min(task.memory, self.memory)
+                    if running and usedCpus + cpus > self.cpus:
+                        continue
+                    if running and self.memory is not None and usedMemory + memory > self.memory:
+                        if not task._waitingForMemory:
+                            task._waitingForMemory = True
+                            sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                                        "Waiting for memory to start \'%s\' (estimated %.1fG)\n" % (task.name, task.memory / 1024 ** 3)]))
+                        continue
+
+                    # If other workers are running the same tasks, only run this task if no one else is
+                    if self.workQueue is not None and task.marker is not None:
+                        if not self.workQueue.claim(task):
+                            task.state = ELSEWHERE
+                            elsewhere.append(task)
+                            sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                                        "\'%s\' is being run by another worker\n" % task.name]))
+                            continue
+                        # Was this task completed (or attempted) by another worker after this worker started?
+                        if self.workQueue.completedElsewhere(task, self.hashInputs):
+                            self.workQueue.release(task, True)
+                            task.state = COMPLETE
+                            progressed = True
+                            continue
+                        if self.workQueue.failedElsewhere(task):
+                            self.workQueue.release(task)
+                            task.state = FAILED
+                            sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                                        "ERROR: \'%s\' failed on another worker\n" % task.name]))
+                            self._skipDependents(task)
+                            cancel = cancel or self.failFast
+                            progressed = True
+                            continue
+
+                    task.state = RUNNING
+                    task.attempts += 1
+                    task._connection, sendConnection = multiprocessing.Pipe(duplex=False)
+                    task._process = multiprocessing.Process(target=_runTask, args=(task, self.hashInputs, sendConnection),
+                                                            name=task.name)
+                    task._startTime = time.time()
+                    task._inputBytes = sum(os.path.getsize(x) for x in task.inputs if os.path.exists(x))
+                    task._process.start()
+                    sendConnection.close()  # Only the worker process writes to this connection
+                    running[task._process.sentinel] = task
+                    if task.cpus > 0:
+                        runningTasks += 1
+                    usedCpus += cpus
+                    usedMemory += memory
+
+                # Are any failed tasks waiting to be retried?
+                retryTimes = list(x._retryAfter for x in self.tasks.values() if x.state == PENDING and x._retryAfter > time.time())
+                if not running and not elsewhere and not retryTimes:
+                    if progressed:
+                        continue
+                    break
+
+                # Wait for a task to finish
+                # If a work queue is used, wake up periodically to send heartbeats, and check on other workers
+                timeout = None if self.workQueue is None else self.workQueue.pollInterval
+                if retryTimes:
+                    untilRetry = max(0, min(retryTimes) - time.time())
+                    timeout = untilRetry if timeout is None else min(timeout, untilRetry)
+                if running:
+                    finished = multiprocessing.connection.wait(list(running.keys()), timeout)
+                else:
+                    time.sleep(timeout)
+                    finished = []
+                for sentinel in finished:
+                    task = running.pop(sentinel)
+                    task._process.join()
+                    task.exitCode = task._process.exitcode
+                    task.profile = self._receiveProfile(task)
+                    usedCpus -= min(task.cpus, self.cpus)
+                    usedMemory -= task.memory if self.memory is None else min(task.memory, self.memory)
+                    if task.exitCode == 0:
+                        task.state = COMPLETE
+                        if self.workQueue is not None:
+                            self.workQueue.release(task, True)
+                    elif task.attempts <= self.retries:
+                        # The failure may be transient (ex. a network filesystem was briefly unavailable), so try again
+                        task.state = PENDING
+                        task._retryAfter = time.time() + self.retryDelay
+                        sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                                    "WARNING: \'%s\' failed (exit code %s). Retrying in %s seconds (attempt %s of %s)\n"
+                                                    % (task.name, task.exitCode, self.retryDelay, task.attempts + 1, self.retries + 1)]))
+                        # Another worker is also allowed to retry this task
+                        if self.workQueue is not None:
+                            self.workQueue.release(task)
+                    else:
+                        task.state = FAILED
+                        sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                                    "ERROR: \'%s\' failed (exit code %s)\n" % (task.name, task.exitCode)]))
+                        if self.workQueue is not None:
+                            self.workQueue.release(task, False)
+                        self._skipDependents(task)
+                        cancel = cancel or self.failFast
+
+                if self.workQueue is not None:
+                    self.workQueue.heartbeat()
+                    # Have any of the tasks run by other workers finished?
+                    for task in list(elsewhere):
+                        state = self.workQueue.status(task)
+                        if state == RUNNING:
+                            continue
+                        elsewhere.remove(task)
+                        if state == FAILED:
+                            task.state = FAILED
+                            sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                                        "ERROR: \'%s\' failed on another worker\n" % task.name]))
+                            self._skipDependents(task)
+                            cancel = cancel or self.failFast
+                        else:
+                            # The lease was released. If the task was completed, this will be detected once its lease
+                            # is obtained. Otherwise (i.e. the other worker was interrupted), this worker will run it
+                            task.state = PENDING
+
+                self._reportSamples(reportedSamples)
+                # Stop at the first failure (if specified)
+                if cancel:
+                    sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                                "Cancelling all remaining tasks, as a task failed\n"]))
+                    self._stopRunning(running, CANCELLED)
+                    for task in self.tasks.values():
+                        if task.state in (PENDING, ELSEWHERE):
+                            task.state = CANCELLED
+                    self._reportSamples(reportedSamples)
+                    break
+        except BaseException as e:
+            # Something went wrong (or the user force quit). Make sure no stages are left running
+            self._stopRunning(running, FAILED)
+            raise e
+
+        return dict((name, task.state) for name, task in self.tasks.items())
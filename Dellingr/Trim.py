@@ -1,25 +1,35 @@
 #! /usr/bin/env python
 
 import argparse
+import collections
+import multiprocessing
 import os
-import gzip
 import time
 import sys
+import numpy as np
 from configobj import ConfigObj
 
+try:
+    import Barcodes
+    import FastqIO
+    import DellingrExceptions as pe
+except ImportError:
+    from Dellingr import Barcodes, FastqIO
+    from Dellingr import DellingrExceptions as pe
+
 
 def isValidFile(file, parser):
     """
     Checks to ensure the provided file is exists, and throws an error if it is not.
 
-    :param file: A string containing a filepath to the file of interest
+    :param file: A string containing a filepath to the file of interest, or "-" for stdin
     :param parser: An argparse.ArgumentParser() object.
 
     :returns: The "file" variable, if the file is valid
     :raises parser.error: If the file is not valid
     """
 
-    if os.path.exists(file):
+    if os.path.exists(file) or file == "-":  # "-" indicates stdin
         return file
     else:
         raise parser.error("Unable to locate %s. Please ensure the file exists, and try again." % (file))
@@ -55,83 +65,484 @@ def validateArgs(args):
     parser = argparse.ArgumentParser(description="Trims degenerate barcodes")
     parser.add_argument("-c", "--config", metavar="INI", type=lambda x: isValidFile(x, parser),
                         help="An optional configuration file, which can provide one or more arguments")
-    parser.add_argument("-i", "--input", metavar="FASTQ", required=True, nargs=2, type=lambda x: isValidFile(x, parser),
-                        help="A pair of FASTQ files generated from paired-end sequencing. May be gzipped")
-    parser.add_argument("-o", "--output", metavar="FASTQ", required=True, nargs=2,
-                        help="A pair of output FASTQ files, to which the trimmed reads will be written to. May be gzipped")
-    parser.add_argument("-mm", "--max_mismatch", metavar="INT", required=True, type=int,
+    parser.add_argument("-i", "--input", metavar="FASTQ", required=True, nargs="+", type=lambda x: isValidFile(x, parser),
+                        help="A pair of FASTQ files generated from paired-end sequencing, or a single interleaved FASTQ file "
+                             "(\'-\' for stdin). May be gzipped")
+    parser.add_argument("-o", "--output", metavar="FASTQ", required=True, nargs="+",
+                        help="A pair of output FASTQ files, to which the trimmed reads will be written to, or a single interleaved "
+                             "output FASTQ file (\'-\' for stdout). May be gzipped")
+    # These arguments are required unless --demultiplex is specified. That is checked below
+    parser.add_argument("-mm", "--max_mismatch", metavar="INT", type=int,
                         help="Maximum mismatch allowed between expected and actual adapter sequences")
-    parser.add_argument("-b", "--barcode_sequence", metavar="NNNWSMRWSYWKMWWT", required=True, type=str,
+    parser.add_argument("-b", "--barcode_sequence", metavar="NNNWSMRWSYWKMWWT", type=str,
                         help="Degenerate barcode sequence, represented in IUPAC bases")
-    parser.add_argument("-p", "--barcode_position", metavar="0001111111111110", required=True, type=str,
+    parser.add_argument("-p", "--barcode_position", metavar="0001111111111110", type=str,
                         help="Positions to consider when comparing expected and actual barcode sequences (1=Yes, 0=No)")
+    parser.add_argument("--demultiplex", metavar="TSV", type=lambda x: isValidFile(x, parser),
+                        help="A tab-delimited table listing the barcode of each sample in these FASTQs (columns: sample, barcode_sequence, "
+                             "barcode_position, max_mismatch [optional]). Each read pair is assigned to the best matching sample")
     parser.add_argument("--reverse", action="store_true",
                         help="Instead, output reads which fall outside the mismatch threshold")
     parser.add_argument("--no_trim", action="store_true", help="Instead, output entries without trimming the adapter sequence")
     parser.add_argument("--trim_other_end", action="store_true",
                         help="In addition, examine the other end of the read for a barcode. Will not remove partial barcodes")
+    parser.add_argument("-t", "--threads", metavar="INT", type=int, default=1,
+                        help="Number of processes to use when trimming reads [Default: %(default)s]")
+    parser.add_argument("--compression_level", metavar="INT", type=int, default=6, choices=range(0, 10),
+                        help="Compression level (0-9) used for gzipped output files. 0 stores reads uncompressed [Default: %(default)s]")
+    parser.add_argument("--compression_threads", metavar="INT", type=int,
+                        help="Number of threads used to compress gzipped output files [Default: Same as \'--threads\']")
+    parser.add_argument("--cache_size", metavar="INT", type=int, default=0,
+                        help="Number of distinct barcodes for which the mismatch count is cached (0 = No cache) [Default: %(default)s]")
     validatedargs = parser.parse_args(listArgs)
+
+    # Either a pair of FASTQ files or a single interleaved FASTQ file can be specified
+    if len(validatedargs.input) > 2:
+        parser.error("-i/--input accepts either two FASTQ files, or a single interleaved FASTQ file")
+    if len(validatedargs.output) > 2:
+        parser.error("-o/--output accepts either two FASTQ files, or a single interleaved FASTQ file")
+
+    # If the reads are being demultiplexed, the barcodes are specified in the demultiplexing table instead
+    if validatedargs.demultiplex is None:
+        for argument, flags in (("barcode_sequence", "-b/--barcode_sequence"), ("barcode_position", "-p/--barcode_position"),
+                                ("max_mismatch", "-mm/--max_mismatch")):
+            if getattr(validatedargs, argument) is None:
+                parser.error("the following arguments are required: %s" % flags)
+    elif validatedargs.reverse:
+        parser.error("--reverse can not be used with --demultiplex")
     return vars(validatedargs)
 
 
 parser = argparse.ArgumentParser(description="Trims degenerate barcodes")
 parser.add_argument("-c", "--config", metavar="INI", type=lambda x: isValidFile(x, parser),
                     help="An optional configuration file, which can provide one or more arguments")
-parser.add_argument("-i", "--input", metavar="FASTQ", nargs=2, type=lambda x: isValidFile(x, parser),
-                    help="A pair of FASTQ files generated from paired-end sequencing. May be gzipped")
-parser.add_argument("-o", "--output", metavar="FASTQ", nargs=2,
-                    help="A pair of output FASTQ files, to which the trimmed reads will be written to. May be gzipped")
+parser.add_argument("-i", "--input", metavar="FASTQ", nargs="+", type=lambda x: isValidFile(x, parser),
+                    help="A pair of FASTQ files generated from paired-end sequencing, or a single interleaved FASTQ file "
+                         "(\'-\' for stdin). May be gzipped")
+parser.add_argument("-o", "--output", metavar="FASTQ", nargs="+",
+                    help="A pair of output FASTQ files, to which the trimmed reads will be written to, or a single interleaved "
+                         "output FASTQ file (\'-\' for stdout). May be gzipped")
 parser.add_argument("-mm", "--max_mismatch", metavar="INT", type=int,
                     help="Maximum mismatch allowed between expected and actual adapter sequences")
 parser.add_argument("-b", "--barcode_sequence", metavar="NNNWSMRWSYWKMWWT", type=str,
                     help="Degenerate barcode sequence, represented in IUPAC bases")
 parser.add_argument("-p", "--barcode_position", metavar="0001111111111110", type=str,
                     help="Positions to consider when comparing expected and actual barcode sequences (1=Yes, 0=No)")
+parser.add_argument("--demultiplex", metavar="TSV", type=lambda x: isValidFile(x, parser),
+                    help="A tab-delimited table listing the barcode of each sample in these FASTQs (columns: sample, barcode_sequence, "
+                         "barcode_position, max_mismatch [optional]). Each read pair is assigned to the best matching sample")
 parser.add_argument("--reverse", action="store_true", help="Instead, output reads which fall outside the mismatch threshold")
 parser.add_argument("--no_trim", action="store_true", help="Instead, output entries without trimming the adapter sequence")
 parser.add_argument("--trim_other_end", action="store_true", help="In addition, examine the other end of the read for a barcode. Will not remove partial barcodes")
+parser.add_argument("-t", "--threads", metavar="INT", type=int, help="Number of processes to use when trimming reads [Default: 1]")
+parser.add_argument("--compression_level", metavar="INT", type=int, choices=range(0, 10),
+                    help="Compression level (0-9) used for gzipped output files. 0 stores reads uncompressed [Default: 6]")
+parser.add_argument("--compression_threads", metavar="INT", type=int,
+                    help="Number of threads used to compress gzipped output files [Default: Same as \'--threads\']")
+parser.add_argument("--cache_size", metavar="INT", type=int,
+                    help="Number of distinct barcodes for which the mismatch count is cached (0 = No cache) [Default: 0]")
+
+
+class BarcodeTrimmer:
+    """
+    Examines the barcodes of read pairs in batches, and trims the read pairs which fall within the mismatch threshold
+    """
 
+    def __init__(self, barcodeSequence, barcodePosition, maxMismatch, reverse=False, noTrim=False, trimOtherEnd=False,
+                 interleaved=False, cacheSize=0):
+        """
+        :param barcodeSequence: A string containing the expected barcode sequence, in IUPAC bases
+        :param barcodePosition: A string of 1s and 0s indicating which barcode positions are to be compared
+        :param maxMismatch: An int specifying the maximum number of mismatches permitted in a read pair's barcodes
+        :param reverse: A boolean. If True, output the read pairs which fall outside the mismatch threshold instead
+        :param noTrim: A boolean. If True, do not remove the barcode from the read pair
+        :param trimOtherEnd: A boolean. If True, also trim barcodes found at the other end of each read
+        :param interleaved: A boolean. If True, output read 1 and read 2 of each pair consecutively, as a single stream
+        :param cacheSize: An int specifying the number of distinct barcodes whose mismatch count is cached (0 = No cache)
+        """
+
+        self.barcodeLength = len(barcodePosition)
+        self.maxMismatch = maxMismatch
+        self.reverse = reverse
+        self.noTrim = noTrim
+        self.trimOtherEnd = trimOtherEnd and not noTrim
+        self.interleaved = interleaved
+        self.forwardMatcher = Barcodes.BarcodeMatcher(barcodeSequence, barcodePosition, cacheSize=cacheSize)
+        self.matchers = [self.forwardMatcher]
+        # If we are examining the other end of the read, the reverse compliment of the barcode will be present there
+        if self.trimOtherEnd:
+            self.reverseMatcher = Barcodes.BarcodeMatcher(barcodeSequence, barcodePosition, fromEnd=True, cacheSize=cacheSize)
+            self.matchers.append(self.reverseMatcher)
+        # Cache statistics from worker processes
+        self.workerCacheHits = 0
+        self.workerCacheLookups = 0
+
+    def cacheStats(self):
+        """
+        Obtains the number of barcodes whose mismatch count was found in the cache
+
+        :return: A tuple containing the number of cache hits and the number of lookups
+        """
+        hits = self.workerCacheHits
+        lookups = self.workerCacheLookups
+        for matcher in self.matchers:
+            matcherHits, matcherLookups = matcher.cacheStats()
+            hits += matcherHits
+            lookups += matcherLookups
+        return hits, lookups
+
+    def mismatches(self, r1Seqs, r2Seqs):
+        """
+        Counts the number of mismatches between the barcodes of each read pair and the expected barcode
+
+        :param r1Seqs: A list of read 1 sequences
+        :param r2Seqs: A list of the corresponding read 2 sequences
+        :return: A numpy.ndarray listing the total number of mismatches in the barcodes of each read pair
+        """
+        return self.forwardMatcher.mismatches(r1Seqs) + self.forwardMatcher.mismatches(r2Seqs)
+
+    def formatReads(self, r1Records, r2Records, keepIndexes):
+        """
+        Tags and trims the specified read pairs
+
+        :param r1Records: A list of read 1 FastqIO.FastqRecords
+        :param r2Records: A list of the corresponding read 2 FastqIO.FastqRecords
+        :param keepIndexes: A numpy.ndarray listing the indexes of the read pairs to output
+        :return: A tuple containing the read 1 output (as bytes) and the read 2 output
+                If the output is interleaved, all reads are stored in the read 1 output, and the read 2 output is empty
+        """
+
+        barcodeLength = self.barcodeLength
+
+        # If we are checking the other end of the read for the presence of a barcode, do so now
+        # Note that we do NOT discard reads here
+        otherEnd = None
+        if self.trimOtherEnd and len(keepIndexes) > 0:
+            r1Tails = list(r1Records[i].seq[barcodeLength:] for i in keepIndexes)
+            r2Tails = list(r2Records[i].seq[barcodeLength:] for i in keepIndexes)
+            tailMismatch = self.reverseMatcher.mismatches(r1Tails) + self.reverseMatcher.mismatches(r2Tails)
+            # If the trailing sequence is within the mismatch, assume that is is a barcode, and trim it
+            otherEnd = tailMismatch < self.maxMismatch
+
+        r1Out = []
+        # If the output is interleaved, read 2 directly follows read 1
+        r2Out = r1Out if self.interleaved else []
+        for j, i in enumerate(keepIndexes):
+            r1name, r1seq, r1strand, r1qual = r1Records[i]
+            r2name, r2seq, r2strand, r2qual = r2Records[i]
 
-def main(args=None, sysStdin=None, printPrefix="DELLINGR-TRIM\t"):
-    IUPACCodeDict = {
-        'A': {'A'},  # Adenine
-        'C': {'C'},  # Cytosine
-        'G': {'G'},  # Guanine
-        'T': {'T', 'U'},  # Thymine
-        'U': {'T', 'U'},  # Uracil
-        'R': {'A', 'G'},  # A or G
-        'Y': {'C', 'T'},  # C or T
-        'S': {'G', 'C'},  # G or C
-        'W': {'A', 'T'},  # A or T
-        'K': {'G', 'T'},  # G or T
-        'M': {'A', 'C'},  # A or C
-        'B': {'C', 'G', 'T'},  # C or G or T
-        'D': {'A', 'G', 'T'},  # A or G or T
-        'H': {'A', 'C', 'T'},  # A or C or T
-        'V': {'A', 'C', 'G'},  # A or C or G
-        'N': {'A', 'C', 'G', 'T'},  # any base
-        '.': {'.', '-'},  # gap
-        '-': {'.', '-'}  # gap
-    }
-
-    compliment = {
-        'A': 'T',
-        'T': 'A',
-        'C': 'G',
-        'G': 'C',
-        'U': 'A',
-        'R': 'Y',
-        'Y': 'R',
-        'S': 'S',
-        'W': 'W',
-        'K': 'M',
-        'M': 'K',
-        'B': 'V',
-        'D': 'H',
-        'H': 'D',
-        'V': 'B',
-        'N': 'N'
-    }
+            # Append the family barcode to the read name
+            # We will specify to BWA that this is a tag later
+            familyBarcode = r1seq[:barcodeLength] + r2seq[:barcodeLength]
+
+            # Remove the Illumina tag from the reads, since BWA's -C option will add that tag to the BAM file as well
+            # which will corrupt the output SAM
+            r1name = r1name.split(b" ")[0].rstrip() + b"\tOX:Z:" + familyBarcode
+            r2name = r2name.split(b" ")[0].rstrip() + b"\tOX:Z:" + familyBarcode
+
+            # Trim the sequence and quality scores, unless the user has specified otherwise
+            if not self.noTrim:
+                r1seq = r1seq[barcodeLength:]
+                r2seq = r2seq[barcodeLength:]
+                r1qual = r1qual[barcodeLength:]
+                r2qual = r2qual[barcodeLength:]
+                if otherEnd is not None and otherEnd[j]:
+                    r1seq = r1seq[:-barcodeLength]
+                    r2seq = r2seq[:-barcodeLength]
+                    r1qual = r1qual[:-barcodeLength]
+                    r2qual = r2qual[:-barcodeLength]
+
+            r1Out.extend((r1name, r1seq, r1strand, r1qual))
+            r2Out.extend((r2name, r2seq, r2strand, r2qual))
+
+        # Each batch ends with a newline, as the last line of each record is joined to the next batch
+        if r1Out:
+            r1Out.append(b"")
+        if self.interleaved:
+            return b"\n".join(r1Out), b""
+        if r2Out:
+            r2Out.append(b"")
+        return b"\n".join(r1Out), b"\n".join(r2Out)
+
+    def trim(self, r1Records, r2Records):
+        """
+        Checks the barcode of each read pair in this batch, and trims the read pairs which should be kept
+
+        :param r1Records: A list of read 1 FastqIO.FastqRecords
+        :param r2Records: A list of the corresponding read 2 FastqIO.FastqRecords
+        :return: A tuple containing the read 1 output (as bytes), the read 2 output, and the number of discarded reads
+                If the output is interleaved, all reads are stored in the read 1 output, and the read 2 output is empty
+        """
+
+        # Determine if the barcode sequences fall within the mismatch threshold
+        mismatch = self.mismatches(list(x.seq for x in r1Records), list(x.seq for x in r2Records))
+
+        # If the mismatch is greater than the mismatch tolerated, "discard" this read
+        # Unless the option is specified to keep reads which fall outside the mismatch threshold. In which case,
+        # do the opposite
+        if self.reverse:
+            keep = mismatch >= self.maxMismatch
+        else:
+            keep = mismatch <= self.maxMismatch
+        keepIndexes = np.flatnonzero(keep)
+
+        r1Out, r2Out = self.formatReads(r1Records, r2Records, keepIndexes)
+        discard = 2 * (len(r1Records) - len(keepIndexes))
+        return r1Out, r2Out, discard
+
+
+class Demultiplexer:
+    """
+    Assigns each read pair to the sample whose barcode it matches best, and trims it using that sample's barcode
+
+    Read pairs which do not match any sample (or match several samples equally well) are output without modification,
+    as "undetermined" reads
+    """
+
+    def __init__(self, samples, noTrim=False, trimOtherEnd=False, cacheSize=0, interleaved=False):
+        """
+        :param samples: A list of tuples, each containing a sample name, barcode sequence, barcode position, and the
+                        maximum number of mismatches
+        :param noTrim: A boolean. If True, do not remove the barcode from the read pair
+        :param trimOtherEnd: A boolean. If True, also trim barcodes found at the other end of each read
+        :param cacheSize: An int specifying the number of distinct barcodes whose mismatch count is cached (0 = No cache)
+        :param interleaved: A boolean. If True, output read 1 and read 2 of each pair consecutively, as a single stream
+        """
+
+        self.interleaved = interleaved
+        self.sampleNames = list(x[0] for x in samples)
+        self.trimmers = list(BarcodeTrimmer(barcodeSequence, barcodePosition, maxMismatch, noTrim=noTrim,
+                                            trimOtherEnd=trimOtherEnd, interleaved=interleaved, cacheSize=cacheSize)
+                             for sampleName, barcodeSequence, barcodePosition, maxMismatch in samples)
+        self.maxMismatches = np.array(list(x[3] for x in samples)).reshape(-1, 1)
+        # Cache statistics from worker processes
+        self.workerCacheHits = 0
+        self.workerCacheLookups = 0
+
+    def cacheStats(self):
+        """
+        Obtains the number of barcodes whose mismatch count was found in the cache
+
+        :return: A tuple containing the number of cache hits and the number of lookups
+        """
+        hits = self.workerCacheHits
+        lookups = self.workerCacheLookups
+        for trimmer in self.trimmers:
+            trimmerHits, trimmerLookups = trimmer.cacheStats()
+            hits += trimmerHits
+            lookups += trimmerLookups
+        return hits, lookups
+
+    def trim(self, r1Records, r2Records):
+        """
+        Assigns each read pair in this batch to a sample, and trims the read pairs assigned to each sample
+
+        :param r1Records: A list of read 1 FastqIO.FastqRecords
+        :param r2Records: A list of the corresponding read 2 FastqIO.FastqRecords
+        :return: A tuple containing a list of read 1 outputs (as bytes) and a list of read 2 outputs, and the number of
+                undetermined reads. The outputs are listed in the same order as the samples, followed by the undetermined reads
+                If the output is interleaved, all reads are stored in the read 1 outputs, and the read 2 outputs are empty
+        """
+
+        r1Seqs = list(x.seq for x in r1Records)
+        r2Seqs = list(x.seq for x in r2Records)
+        # Count the mismatches between each read pair and each sample's barcode (one row per sample)
+        mismatch = np.stack(list(trimmer.mismatches(r1Seqs, r2Seqs) for trimmer in self.trimmers))
+
+        # Only consider the samples whose mismatch threshold this read pair falls within
+        mismatch = np.where(mismatch <= self.maxMismatches, mismatch, np.iinfo(mismatch.dtype).max)
+        bestSample = np.argmin(mismatch, axis=0)
+        bestMismatch = mismatch[bestSample, np.arange(len(r1Records))]
+        # If a read pair matches several samples equally well, we can't tell which sample it originated from
+        matched = bestMismatch != np.iinfo(mismatch.dtype).max
+        ambiguous = np.count_nonzero(mismatch == bestMismatch, axis=0) > 1
+        bestSample[~matched | ambiguous] = len(self.trimmers)
+
+        r1Outs = []
+        r2Outs = []
+        for i, trimmer in enumerate(self.trimmers):
+            r1Out, r2Out = trimmer.formatReads(r1Records, r2Records, np.flatnonzero(bestSample == i))
+            r1Outs.append(r1Out)
+            r2Outs.append(r2Out)
+
+        # Write out the undetermined reads as-is
+        undetermined = np.flatnonzero(bestSample == len(self.trimmers))
+        r1Out = []
+        r2Out = r1Out if self.interleaved else []
+        for i in undetermined:
+            r1Out.extend(r1Records[i])
+            r2Out.extend(r2Records[i])
+        if r1Out:
+            r1Out.append(b"")
+        if r2Out and not self.interleaved:
+            r2Out.append(b"")
+        r1Outs.append(b"\n".join(r1Out))
+        r2Outs.append(b"\n".join(r2Out) if not self.interleaved else b"")
+
+        return r1Outs, r2Outs, 2 * len(undetermined)
+
+
+def parseDemultiplexTable(tablePath, maxMismatch=None):
+    """
+    Parses a tab-delimited table listing the barcode of each sample in a multiplexed set of FASTQ files
+
+    The table must have a header line, and the following columns:
+        sample, barcode_sequence, barcode_position, max_mismatch (optional)
+
+    :param tablePath: A string containing a filepath to the table
+    :param maxMismatch: An int specifying the maximum mismatch of samples for which one was not provided in the table
+    :return: A list of tuples, each containing a sample name, barcode sequence, barcode position, and maximum mismatch
+    :raises pe.InvalidInputException: If the table is malformed
+    """
+
+    samples = []
+    with open(tablePath) as f:
+        header = None
+        for line in f:
+            line = line.rstrip("\r\n")
+            # Ignore blank lines and comments
+            if not line or line.startswith("#"):
+                continue
+            cols = line.split("\t")
+            if header is None:
+                header = cols
+                for column in ("sample", "barcode_sequence", "barcode_position"):
+                    if column not in header:
+                        raise pe.InvalidInputException("Unable to locate the column \'%s\' in the demultiplexing table \'%s\'" % (column, tablePath))
+                continue
+            if len(cols) != len(header):
+                raise pe.InvalidInputException("Line \'%s\' of \'%s\' does not have the same number of columns as the header" % (line, tablePath))
+            row = dict(zip(header, cols))
+
+            sampleName = row["sample"]
+            barcodeSequence = row["barcode_sequence"].upper()
+            barcodePosition = row["barcode_position"]
+            if "max_mismatch" in row and row["max_mismatch"] != "":
+                try:
+                    sampleMismatch = int(row["max_mismatch"])
+                except ValueError as e:
+                    raise pe.InvalidInputException("Invalid max_mismatch for sample \'%s\': %s" % (sampleName, row["max_mismatch"])) from e
+            elif maxMismatch is not None:
+                sampleMismatch = maxMismatch
+            else:
+                raise pe.InvalidInputException("No max_mismatch was specified for sample \'%s\', and \'-mm/--max_mismatch\' was not provided" % sampleName)
+
+            # Sanity check the barcode
+            if len(barcodeSequence) != len(barcodePosition):
+                raise pe.InvalidInputException("The barcode sequence and barcode mask of sample \'%s\' must be the same length" % sampleName)
+            for base in barcodeSequence:
+                if base not in Barcodes.IUPAC_BITS:
+                    raise pe.InvalidInputException("Unrecognized IUPAC base in the barcode of sample \'%s\': %s" % (sampleName, base))
+            if sampleName in list(x[0] for x in samples) or sampleName == "undetermined":
+                raise pe.InvalidInputException("Sample name \'%s\' is used more than once (or is reserved) in \'%s\'" % (sampleName, tablePath))
+            samples.append((sampleName, barcodeSequence, barcodePosition, sampleMismatch))
+
+    if not samples:
+        raise pe.InvalidInputException("No samples were listed in the demultiplexing table \'%s\'" % tablePath)
+    return samples
+
+
+def demultiplexOutputs(outputPath, sampleNames):
+    """
+    Generates the output file name of each demultiplexed sample
+
+    Each output is placed in the same directory as the specified output file, and is named <sample>.<output file name>
+
+    :param outputPath: A string containing the output file path specified by the user
+    :param sampleNames: A list of sample names
+    :return: A list containing the output file path of each sample, followed by the output for undetermined reads
+    """
+    outDir, outName = os.path.split(outputPath)
+    return list(os.path.join(outDir, x + "." + outName) for x in sampleNames + ["undetermined"])
+
+
+def _initWorker(trimmer):
+    """
+    Stores the BarcodeTrimmer used by this worker process, so it does not need to be sent with every batch
+
+    :param trimmer: A BarcodeTrimmer object
+    """
+    global workerTrimmer
+    workerTrimmer = trimmer
+
+
+def _trimBatchWorker(batch):
+    """
+    Trims a batch of read pairs using this worker's BarcodeTrimmer
+
+    :param batch: A tuple containing the read 1 and read 2 records of this batch
+    :return: A tuple containing the read 1 output, the read 2 output, the number of reads, the number of discarded reads,
+            and the number of cache hits and lookups for this batch
+    """
+    r1Records, r2Records = batch
+    previousHits, previousLookups = workerTrimmer.cacheStats()
+    r1Out, r2Out, discard = workerTrimmer.trim(r1Records, r2Records)
+    hits, lookups = workerTrimmer.cacheStats()
+    return r1Out, r2Out, 2 * len(r1Records), discard, hits - previousHits, lookups - previousLookups
+
+
+def trimBatches(reader, trimmer, batchSize, threads=1):
+    """
+    Trims all read pairs from the specified FASTQ files, and returns the output of each batch in input order
+
+    If more than one thread is specified, batches are trimmed by a pool of worker processes. Only a limited number of
+    batches are sent to the workers at once, so the input files are not read faster than they can be processed
+
+    :param reader: A FastqIO.PairedFastqReader object
+    :param trimmer: A BarcodeTrimmer object
+    :param batchSize: An int specifying the number of read pairs in each batch
+    :param threads: An int specifying the number of worker processes to use
+    :return: Yields a tuple containing the read 1 output, the read 2 output, the number of reads, and the number of discarded reads
+    """
+
+    if threads <= 1:
+        while True:
+            r1Records, r2Records = reader.readBatch(batchSize)
+            if len(r1Records) == 0:
+                break
+            r1Out, r2Out, discard = trimmer.trim(r1Records, r2Records)
+            yield r1Out, r2Out, 2 * len(r1Records), discard
+        return
+
+    processPool = multiprocessing.Pool(processes=threads, initializer=_initWorker, initargs=(trimmer,))
+    try:
+        # Since the results of each batch are retrieved in the order they were submitted, R1 and R2 will stay in sync
+        pendingBatches = collections.deque()
+        inputRemaining = True
+        while inputRemaining or pendingBatches:
+            # Keep each worker busy, with an extra batch queued up
+            while inputRemaining and len(pendingBatches) < threads * 2:
+                r1Records, r2Records = reader.readBatch(batchSize)
+                if len(r1Records) == 0:
+                    inputRemaining = False
+                    break
+                pendingBatches.append(processPool.apply_async(_trimBatchWorker, ((r1Records, r2Records),)))
+            if pendingBatches:
+                r1Out, r2Out, count, discard, hits, lookups = pendingBatches.popleft().get()
+                # Since each worker has its own copy of the trimmer, keep track of the cache statistics here
+                trimmer.workerCacheHits += hits
+                trimmer.workerCacheLookups += lookups
+                yield r1Out, r2Out, count, discard
+        processPool.close()
+    except BaseException as e:
+        sys.stderr.write("ERROR: An error occured while trimming reads. Terminating workers..." + os.linesep)
+        processPool.terminate()
+        raise e
+    finally:
+        processPool.join()
+
+
+def main(args=None, sysStdin=None, printPrefix="DELLINGR-TRIM\t", batchSize=10000, outputStream=None):
+    """
+    Trims the barcodes from the specified FASTQ files
+
+    :param args: A dictionary containing {argument: parameter}. If not specified, the arguments are parsed from sysStdin
+    :param sysStdin: A list of command line arguments
+    :param printPrefix: A string which is prepended to status messages
+    :param batchSize: An int specifying the number of read pairs which are processed at once
+    :param outputStream: A writeable binary file-like object (ex. the stdin of bwa mem). If specified, the trimmed read
+                        pairs are written to this stream in interleaved format, instead of to the output FASTQ files
+    """
 
     if args is None:
         if sysStdin is None:
@@ -157,66 +568,75 @@ def main(args=None, sysStdin=None, printPrefix="DELLINGR-TRIM\t"):
     args = validateArgs(args)
 
     # Sanity check to ensure that the input FASTQ files are not the same
-    if os.path.realpath(args["input"][0]) == os.path.realpath(args["input"][1]):
+    if len(args["input"]) == 2 and os.path.realpath(args["input"][0]) == os.path.realpath(args["input"][1]):
         parser.error("The input files specified are the same file!")
+    if len(args["input"]) == 2 and "-" in args["input"]:
+        parser.error("Only a single interleaved FASTQ file can be read from stdin")
+    if len(args["output"]) == 2 and "-" in args["output"]:
+        parser.error("Only a single interleaved FASTQ file can be written to stdout")
+
+    # If a single output file is specified, both reads of each pair are written to it
+    # Writing to stdout is handled the same way as writing to the output stream provided by the pipeline
+    if outputStream is None and args["output"] == ["-"]:
+        outputStream = sys.stdout.buffer
+    interleaved = outputStream is not None or len(args["output"]) == 1
+
+    if args["threads"] < 1:
+        parser.error("-t/--threads must be at least 1")
+    if args["cache_size"] < 0:
+        parser.error("--cache_size must be 0 or greater")
+
+    if args["demultiplex"] is not None:
+        if outputStream is not None:
+            parser.error("Demultiplexed reads can not be written to stdout")
+        samples = parseDemultiplexTable(args["demultiplex"], args["max_mismatch"])
+        trimmer = Demultiplexer(samples, args["no_trim"], args["trim_other_end"], cacheSize=args["cache_size"],
+                                interleaved=interleaved)
+    else:
+        # Check that the barcode sequence and mask are the same length
+        if len(args["barcode_sequence"]) != len(args["barcode_position"]):
+            parser.error("The barcode sequence and barcode mask must be the same length")
 
-    # Check that the barcode sequence and mask are the same length
-    if len(args["barcode_sequence"]) != len(args["barcode_position"]):
-        parser.error("The barcode sequence and barcode mask must be the same length")
-
-    # Just in case someone used lowercase
-    args["barcode_sequence"] = args["barcode_sequence"].upper()
-
-    # Make sure the user used IUPAC bases in the barcode sequence
-    for base in args["barcode_sequence"]:
-        if base not in IUPACCodeDict:
-            parser.error("Unrecognized IUPAC base: %s" % base)
+        # Just in case someone used lowercase
+        args["barcode_sequence"] = args["barcode_sequence"].upper()
 
-    barcodeLength = len(args["barcode_position"])
-    barcodeIndexes = tuple(i for i in range(0, barcodeLength) if args["barcode_position"][i] == "1")
-    barcodeBases = tuple(args["barcode_sequence"][i] for i in barcodeIndexes)
+        # Make sure the user used IUPAC bases in the barcode sequence
+        for base in args["barcode_sequence"]:
+            if base not in Barcodes.IUPAC_BITS:
+                parser.error("Unrecognized IUPAC base: %s" % base)
 
-    # Obtain the reverse compliment of the barcode, if the other end of the read is to be examined
-    if args["trim_other_end"]:
-        reverseIndexes = tuple(barcodeLength - i - 1 for i in barcodeIndexes)
-        reverseIndexes = reverseIndexes[::-1]
-        reverseBarcode = barcodeBases[::-1]
-        reverseBarcode = tuple(compliment[x] for x in reverseBarcode)
+        trimmer = BarcodeTrimmer(args["barcode_sequence"], args["barcode_position"], args["max_mismatch"],
+                                 args["reverse"], args["no_trim"], args["trim_other_end"],
+                                 interleaved=interleaved, cacheSize=args["cache_size"])
 
     # Open the input and output fastq files for reading/writing
-    # Determine if the input files are gzipped, and open appropriately
-    if args["input"][0].split(".")[-1] == "gz":
-        f1in = gzip.open(args["input"][0], "rt")
-    else:
-        f1in = open(args["input"][0])
-
-    if args["input"][1].split(".")[-1] == "gz":
-        f2in = gzip.open(args["input"][1], "rt")
-    else:
-        f2in = open(args["input"][1])
+    # The reader will determine if the input files are gzipped (or interleaved), and ensure the read pairs stay in sync
+    reader = FastqIO.openPairedInput(args["input"])
 
     # Open outputs
-    if args["output"][0].endswith(".gz"):
-        f1out = gzip.open(args["output"][0], "wt")
-    else:
-        f1out = open(args["output"][0], "w")
-    if args["output"][1].endswith(".gz"):
-        f2out = gzip.open(args["output"][1], "wt")
+    # Gzipped outputs are written as independently compressed blocks, which can be compressed using multiple threads
+    if args["compression_threads"] is None:
+        args["compression_threads"] = args["threads"]
+    if args["demultiplex"] is not None:
+        # Each sample (and the undetermined reads) are written to a seperate pair of output files
+        r1Outputs = list(FastqIO.openOutput(x, args["compression_level"], args["compression_threads"])
+                         for x in demultiplexOutputs(args["output"][0], trimmer.sampleNames))
+        if interleaved:
+            r2Outputs = None
+        else:
+            r2Outputs = list(FastqIO.openOutput(x, args["compression_level"], args["compression_threads"])
+                             for x in demultiplexOutputs(args["output"][1], trimmer.sampleNames))
+        sampleCounts = [0] * len(r1Outputs)
+    elif outputStream is None:
+        f1out = FastqIO.openOutput(args["output"][0], args["compression_level"], args["compression_threads"])
+        if interleaved:
+            f2out = None
+        else:
+            f2out = FastqIO.openOutput(args["output"][1], args["compression_level"], args["compression_threads"])
     else:
-        f2out = open(args["output"][1], "w")
-
-    # Begin processing the FASTQ files
-    # Read 1
-    r1name = None
-    r1seq = None
-    r1strand = None
-    r1qual = None
-
-    # Read 2
-    r2name = None
-    r2seq = None
-    r2strand = None
-    r2qual = None
+        # Both reads of each pair are written to the stream. The caller is responsible for closing it
+        f1out = outputStream
+        f2out = None
 
     # Status messages
     sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Starting...\n"]))
@@ -224,128 +644,59 @@ def main(args=None, sysStdin=None, printPrefix="DELLINGR-TRIM\t"):
     discard = 0
     discardWarning = False
 
-    for line1, line2 in zip(f1in, f2in):
-
-        # Load the entire record before processing it
-        if r1name is None:  # i.e. we have not recieved a record name yet, lets add them here
-            r1name = line1
-            r2name = line2
-        elif r1seq is None:
-            r1seq = line1
-            r2seq = line2
-        elif r1strand is None:  # i.e. we have not recieved the record's strand info yet
-            r1strand = line1
-            r2strand = line2
-        else:  # These lines contain the quality scores. Once we recieve those, we can begin processing the read pair for real
-            r1qual = line1
-            r2qual = line2
-
-            # First, obtain the barcode sequences
-            barcode1 = r1seq[:barcodeLength]
-            barcode2 = r2seq[:barcodeLength]
-
-            # Append the family barcode to the read name
-            # We will specify to BWA that this is a tag later
-            familyBarcode = barcode1 + barcode2
-
-            # Remove the Illumina tag from the reads, since BWA's -C option will add that tag to the BAM file as well
-            # which will corrupt the output SAM
-            r1name = r1name.split(" ")[0].rstrip() + "\tOX:Z:" + familyBarcode + os.linesep
-            r2name = r2name.split(" ")[0].rstrip() + "\tOX:Z:" + familyBarcode + os.linesep
-
-            # Second, determine if the barcode sequences fall within the mismatch theshold
-            # Obtain the positions that will actually be compared
-            b1pos = tuple(barcode1[i] for i in barcodeIndexes)
-            b2pos = tuple(barcode2[i] for i in barcodeIndexes)
-
-            # Next,compare these positions to the barcode sequence
-            mismatch = 0
-            for b1, b2, bRef in zip(b1pos, b2pos, barcodeBases):
-                if b1 not in IUPACCodeDict[bRef]:
-                    mismatch += 1
-                if b2 not in IUPACCodeDict[bRef]:
-                    mismatch += 1
-
-            # If the mismatch is greater than the mismatch tolerated, "discard" this read by emptying the sequence
-            # Unless the option is specified to keep reads which fall outside the mismatch threshold. In which case,
-            # do the opposite
-            if (not args["reverse"] and mismatch > args["max_mismatch"]) or (args["reverse"] and mismatch < args["max_mismatch"]):
-                discard += 2
-            else:
-                # Otherwise, the barcode of this read pair is within thresholds
-                # Trim the sequence and quality scores, unless the user has specified otherwise
-                if not args["no_trim"]:
-                    r1seq = r1seq[barcodeLength:]
-                    r2seq = r2seq[barcodeLength:]
-                    r1qual = r1qual[barcodeLength:]
-                    r2qual = r2qual[barcodeLength:]
-
-
-                # If we are checking the other end of the read for the presence of a barcode, do so now
-                # Note that we do NOT discard reads here
-                if args["trim_other_end"] and not args["no_trim"]:
-                    # Obtain the candidate reverse barcode sequence
-                    barcode1 =r1seq.rstrip()[-barcodeLength:]  # Ignore the newline
-                    barcode2 = r1seq.rstrip()[-barcodeLength:]
-                    b1pos = tuple(barcode1[i] for i in reverseIndexes)
-                    b2pos = tuple(barcode2[i] for i in reverseIndexes)
-                    # Next,compare these positions to the barcode sequence
-                    mismatch = 0
-                    for b1, b2, bRef in zip(b1pos, b2pos, reverseBarcode):
-                        if b1 not in IUPACCodeDict[bRef]:
-                            mismatch += 1
-                        if b2 not in IUPACCodeDict[bRef]:
-                            mismatch += 1
-
-                    # If the trailing sequence is within the mismatch, assume that is is a barcode, and trim it
-                    if mismatch < args["max_mismatch"]:
-                        r1seq = r1seq.rstrip()[:-barcodeLength] + os.linesep
-                        r2seq = r2seq.rstrip()[:-barcodeLength] + os.linesep
-                        r1qual = r1qual.rstrip()[:-barcodeLength] + os.linesep
-                        r2qual = r2qual.rstrip()[:-barcodeLength] + os.linesep
-
-                # Finally, output these reads
-                f1out.write(r1name)
-                f1out.write(r1seq)
-                f1out.write(r1strand)
-                f1out.write(r1qual)
-                f2out.write(r2name)
-                f2out.write(r2seq)
-                f2out.write(r2strand)
-                f2out.write(r2qual)
-
-            # Finally, clear the previous read pair (the one that was just written out) from the buffer
-            r1name = None
-            r1strand = None
-            r1seq = None
-            r1qual = None
-            r2name = None
-            r2strand = None
-            r2seq = None
-            r2qual = None
-
-            count += 2
-            if count % 100000 == 0:
-
-                sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
-                                            "Discard Rate:" + str(float(discard) / float(count) * 100)[:4] + "%",
-                                            "Count:" + str(count) + "\n"]))
-                # Check to see if the discard rate is excessive (>70%). If so, the barcode is probably incorrect
-                if float(discard) / float(count) > 0.70 and not discardWarning:
-                    sys.stderr.write("WARNING: The read discard rate is excessively high. Are you sure the barcode sequence is correct?\n")
-                    sys.stderr.write("You can check the barcode using \'adapter_predict\'\n")
-                    discardWarning = True
-
-    f1in.close()
-    f2in.close()
-    f1out.close()
-    f2out.close()
+    # Process the read pairs in batches, to allow the barcodes of many reads to be compared at once
+    for r1Out, r2Out, batchCount, batchDiscard in trimBatches(reader, trimmer, batchSize, args["threads"]):
+        if args["demultiplex"] is not None:
+            for i in range(0, len(r1Outputs)):
+                r1Outputs[i].write(r1Out[i])
+                if r2Outputs is not None:
+                    r2Outputs[i].write(r2Out[i])
+                # Each read occupies 4 lines. Unless the output is interleaved, the read 1 output contains half the reads
+                sampleCounts[i] += r1Out[i].count(b"\n") // (4 if interleaved else 2)
+        else:
+            f1out.write(r1Out)
+            if f2out is not None:
+                f2out.write(r2Out)
+
+        # Status messages are printed every 100000 reads
+        previousCount = count
+        count += batchCount
+        discard += batchDiscard
+        if count // 100000 != previousCount // 100000:
+
+            sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                        "Discard Rate:" + str(float(discard) / float(count) * 100)[:4] + "%",
+                                        "Count:" + str(count) + "\n"]))
+            # Check to see if the discard rate is excessive (>70%). If so, the barcode is probably incorrect
+            if float(discard) / float(count) > 0.70 and not discardWarning:
+                sys.stderr.write("WARNING: The read discard rate is excessively high. Are you sure the barcode sequence is correct?\n")
+                sys.stderr.write("You can check the barcode using \'adapter_predict\'\n")
+                discardWarning = True
+
+    reader.close()
+    if args["demultiplex"] is not None:
+        for outFile in r1Outputs + (r2Outputs or []):
+            outFile.close()
+    elif outputStream is None:
+        f1out.close()
+        if f2out is not None:
+            f2out.close()
+    else:
+        outputStream.flush()
 
     # Final messages
     if count % 100000 != 0:
         sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
                                     "Discard Rate:" + str(float(discard) / float(count) * 100)[:4] + "%",
                                     "Count:" + str(count) + "\n"]))
+    if args["demultiplex"] is not None:
+        for sampleName, sampleCount in zip(trimmer.sampleNames + ["undetermined"], sampleCounts):
+            sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Sample:" + sampleName, "Count:" + str(sampleCount) + "\n"]))
+    cacheHits, cacheLookups = trimmer.cacheStats()
+    if cacheLookups > 0:
+        sys.stderr.write("\t".join([printPrefix, time.strftime('%X'),
+                                    "Barcode Cache Hit Rate:" + str(float(cacheHits) / float(cacheLookups) * 100)[:4] + "%",
+                                    "Lookups:" + str(cacheLookups) + "\n"]))
     sys.stderr.write("\t".join([printPrefix, time.strftime('%X'), "Trimming Complete\n"]))
 
 
@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+
+"""
+Allows several Dellingr workers (possibly running on different hosts) to process the same analysis directory, using
+only a shared filesystem
+
+Before a worker runs a task, it creates a lease file beside the task's marker file (ex. "config/BWA_Complete.lease").
+Since the lease is created atomically, only one worker can run each task. While the task is running, the worker
+periodically updates the modification time of the lease (a heartbeat). If a worker dies, its leases are no longer
+updated. Once a lease is older than the lease timeout, it is considered abandoned, and another worker can take it over
+
+Thus, the state of each task is visible in the "config" directory of each sample:
+    <task>_Complete         The task has completed
+    <task>_Complete.lease   The task is being run by the worker listed in this file
+    <task>_Complete.failed  The task failed the last time it was run
+"""
+
+import json
+import os
+import socket
+import sys
+import time
+import uuid
+
+try:  # If not installed, this works
+    import Scheduler
+except ImportError:
+    from Dellingr import Scheduler
+
+# How long (in seconds) a lease can go without a heartbeat before it is considered abandoned
+LEASE_TIMEOUT = 300
+# How often (in seconds) the state of tasks being run by other workers is checked
+POLL_INTERVAL = 5
+
+
+class WorkQueue:
+    """
+    Coordinates which worker runs each task, using lease files
+    """
+
+    def __init__(self, leaseTimeout=LEASE_TIMEOUT, pollInterval=POLL_INTERVAL, printPrefix="DELLINGR-WORKER\t"):
+        """
+        :param leaseTimeout: A number of seconds. Leases which have not been updated in this long are considered
+                        abandoned. Should be the same for all workers
+        :param pollInterval: A number of seconds specifying how often the leases of other workers are checked
+        :param printPrefix: A string which is prepended to status messages
+        """
+        self.leaseTimeout = leaseTimeout
+        self.pollInterval = min(pollInterval, leaseTimeout / 10)
+        # Heartbeats are sent often enough that a few can be delayed (ex. by a slow filesystem) without losing the lease
+        self.heartbeatInterval = leaseTimeout / 10
+        self.printPrefix = printPrefix
+        self.workerName = "%s:%s" % (socket.gethostname(), os.getpid())
+        self._leases = {}  # The leases held by this worker, as {lease path: lease contents}
+        self._watched = {}  # The contents of each task's marker and failure files when this worker started
+        self._lastHeartbeat = 0
+
+    @staticmethod
+    def leasePath(task):
+        return task.marker + ".lease"
+
+    @staticmethod
+    def failurePath(task):
+        return task.marker + ".failed"
+
+    @staticmethod
+    def _read(path):
+        """
+        :return: A string containing the contents of the specified file, or None if it does not exist
+        """
+        try:
+            with open(path) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def watch(self, task):
+        """
+        Records the current state of the specified task, so it can be determined if another worker completed (or
+        failed to complete) it later on
+
+        :param task: A Scheduler.Task object with a marker file
+        """
+        self._watched[task.marker] = (self._read(task.marker), self._read(self.failurePath(task)))
+
+    def completedElsewhere(self, task, hashInputs=False):
+        """
+        Was the specified task completed by another worker since watch() was called?
+
+        :param task: A Scheduler.Task object
+        :param hashInputs: A boolean. If True, use checksums to determine if the input files of the task have changed
+        :return: A boolean
+        """
+        markerContents = self._watched.get(task.marker, (None, None))[0]
+        return self._read(task.marker) != markerContents and task.isUpToDate(hashInputs)
+
+    def failedElsewhere(self, task):
+        """
+        Did the specified task fail on another worker since watch() was called?
+
+        :param task: A Scheduler.Task object
+        :return: A boolean
+        """
+        failureContents = self._watched.get(task.marker, (None, None))[1]
+        currentFailure = self._read(self.failurePath(task))
+        return currentFailure is not None and currentFailure != failureContents
+
+    def _isAbandoned(self, leasePath):
+        """
+        Has the worker holding this lease stopped sending heartbeats?
+
+        :param leasePath: A string containing a filepath to a lease file
+        :return: A boolean
+        """
+        try:
+            return time.time() - os.path.getmtime(leasePath) > self.leaseTimeout
+        except OSError:  # i.e. The lease was released in the meantime
+            return False
+
+    def _recover(self, leasePath, contents):
+        """
+        Removes an abandoned lease
+
+        The lease is first renamed, so if several workers try to recover the same lease, only one of them succeeds
+
+        :param leasePath: A string containing a filepath to a lease file
+        :param contents: A string containing the contents of the lease when it was determined to be abandoned
+        :return: A boolean indicating if the lease was removed by this worker
+        """
+        setAside = "%s.%s.abandoned" % (leasePath, uuid.uuid4().hex)
+        try:
+            os.rename(leasePath, setAside)
+        except OSError:  # i.e. Another worker recovered this lease first
+            return False
+        if self._read(setAside) != contents:
+            # Another worker recovered this lease, and created a new one, before this worker renamed it. Put it back
+            try:
+                os.link(setAside, leasePath)
+            except OSError:
+                pass
+            os.remove(setAside)
+            return False
+        os.remove(setAside)
+        sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                    "Recovered the abandoned lease \'%s\'\n" % leasePath]))
+        return True
+
+    def claim(self, task):
+        """
+        Attempts to obtain the lease of the specified task, so this worker can run it
+
+        The contents of the lease (either this worker's, or the lease of the worker running the task) are stored in
+        task.leaseContents
+
+        :param task: A Scheduler.Task object with a marker file
+        :return: A boolean indicating if the lease was obtained
+        """
+        leasePath = self.leasePath(task)
+        leaseContents = json.dumps({"worker": self.workerName, "claimed": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                    "id": uuid.uuid4().hex}) + "\n"
+        # If the lease was abandoned, try again once it has been removed
+        for attempt in range(2):
+            try:
+                leaseFile = os.open(leasePath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                heldBy = self._read(leasePath)
+                if heldBy is None:  # i.e. The lease was released in the meantime
+                    continue
+                if self._isAbandoned(leasePath) and self._recover(leasePath, heldBy):
+                    continue
+                task.leaseContents = heldBy
+                return False
+            with os.fdopen(leaseFile, "w") as o:
+                o.write(leaseContents)
+            self._leases[leasePath] = leaseContents
+            task.leaseContents = leaseContents
+            return True
+
+        task.leaseContents = self._read(leasePath)
+        return False
+
+    def release(self, task, succeeded=None):
+        """
+        Releases the lease of a task run by this worker
+
+        :param task: A Scheduler.Task object
+        :param succeeded: A boolean indicating if the task completed. If False, the failure is recorded (so other
+                        workers do not re-run it). None = The task was interrupted, and can be run by another worker
+        """
+        leasePath = self.leasePath(task)
+        leaseContents = self._leases.pop(leasePath, None)
+        if leaseContents is None:
+            return
+        failurePath = self.failurePath(task)
+        if succeeded and os.path.exists(failurePath):
+            os.remove(failurePath)
+        elif succeeded is False:
+            with open(failurePath, "w") as o:
+                json.dump({"lease": leaseContents, "worker": self.workerName, "exit_code": task.exitCode,
+                           "failed": time.strftime("%Y-%m-%dT%H:%M:%S")}, o, indent=1, sort_keys=True)
+                o.write("\n")
+        # Only remove the lease if it still belongs to this worker
+        if self._read(leasePath) == leaseContents:
+            os.remove(leasePath)
+
+    def heartbeat(self):
+        """
+        Updates the modification time of every lease held by this worker, so they are not considered abandoned
+
+        Only updates the leases if the heartbeat interval has elapsed since the last update, so this can be called often
+        """
+        if time.time() - self._lastHeartbeat < self.heartbeatInterval:
+            return
+        self._lastHeartbeat = time.time()
+        for leasePath, leaseContents in self._leases.items():
+            if self._read(leasePath) != leaseContents:
+                sys.stderr.write("\t".join([self.printPrefix, time.strftime('%X'),
+                                            "WARNING: The lease \'%s\' was taken over by another worker\n" % leasePath]))
+                continue
+            try:
+                os.utime(leasePath)
+            except OSError:
+                pass
+
+    def status(self, task):
+        """
+        Checks on a task which is being run by another worker
+
+        :param task: A Scheduler.Task object, whose lease is held by another worker
+        :return: Scheduler.RUNNING if the task is still being run, Scheduler.FAILED if it failed, or Scheduler.PENDING if
+                the lease was released (or abandoned). The marker file should then be checked to determine if the task
+                was completed
+        """
+        leaseContents = self._read(self.leasePath(task))
+        if leaseContents is not None and leaseContents == task.leaseContents:
+            if self._isAbandoned(self.leasePath(task)):
+                return Scheduler.PENDING
+            return Scheduler.RUNNING
+        # The lease was released. Did the task fail?
+        failure = self._read(self.failurePath(task))
+        if failure is not None:
+            try:
+                if json.loads(failure)["lease"] == task.leaseContents:
+                    return Scheduler.FAILED
+            except (ValueError, KeyError, TypeError):
+                pass
+        if leaseContents is not None:  # i.e. Another worker recovered the lease, and is now running this task
+            task.leaseContents = leaseContents
+            return Scheduler.RUNNING
+        return Scheduler.PENDING
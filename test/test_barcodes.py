@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+Tests for the barcode matching routines in Barcodes.py
+"""
+
+import random
+import unittest
+
+import numpy as np
+
+from Dellingr import Barcodes
+
+BARCODE_SEQUENCE = "NNNWSMRWSYWKMWWT"
+BARCODE_POSITION = "0001111111111110"
+
+
+def matchingBarcode(barcodeSequence, rng):
+    """
+    Generates a sequence which matches the specified degenerate barcode at every position
+
+    :param barcodeSequence: A string containing IUPAC bases
+    :param rng: A random.Random object
+    :return: A string
+    """
+    return "".join(rng.choice(list(x for x in "ACGT" if Barcodes.IUPAC_BITS[x] & Barcodes.IUPAC_BITS[base]))
+                   for base in barcodeSequence)
+
+
+def addMismatches(sequence, barcodeSequence, positions):
+    """
+    Replaces the bases at the specified positions with a base which does not match the degenerate barcode
+
+    :param sequence: A string containing a sequence which matches barcodeSequence
+    :param barcodeSequence: A string containing IUPAC bases
+    :param positions: A list of ints, listing the positions to alter
+    :return: A string
+    """
+    sequence = list(sequence)
+    for i in positions:
+        sequence[i] = next(x for x in "ACGT" if not Barcodes.IUPAC_BITS[x] & Barcodes.IUPAC_BITS[barcodeSequence[i]])
+    return "".join(sequence)
+
+
+class TestBarcodeMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.compared = list(i for i, x in enumerate(BARCODE_POSITION) if x == "1")
+
+    def testMismatchThresholds(self):
+        """
+        The number of mismatches is the number of compared positions which do not match the degenerate barcode
+        """
+        matcher = Barcodes.BarcodeMatcher(BARCODE_SEQUENCE, BARCODE_POSITION)
+        for mismatchNum in range(0, 5):
+            sequences = []
+            for i in range(0, 50):
+                barcode = matchingBarcode(BARCODE_SEQUENCE, self.rng)
+                barcode = addMismatches(barcode, BARCODE_SEQUENCE, self.rng.sample(self.compared, mismatchNum))
+                sequences.append(barcode + "ACGTACGTAC")
+            mismatches = matcher.mismatches(sequences)
+            self.assertTrue(np.all(mismatches == mismatchNum))
+            # i.e. Trim's "--max_mismatch" threshold
+            for threshold in range(0, 5):
+                self.assertEqual(bool(np.all(mismatches <= threshold)), mismatchNum <= threshold)
+
+    def testIgnoredPositions(self):
+        """
+        Positions which are masked out never count as mismatches
+        """
+        matcher = Barcodes.BarcodeMatcher(BARCODE_SEQUENCE, BARCODE_POSITION)
+        barcode = matchingBarcode(BARCODE_SEQUENCE, self.rng)
+        ignored = list(i for i, x in enumerate(BARCODE_POSITION) if x == "0")
+        barcode = addMismatches(barcode, "A" * len(barcode), ignored)  # Change the ignored positions
+        self.assertEqual(list(matcher.mismatches([barcode])), [0])
+        self.assertEqual(list(matcher.mismatches([barcode.encode()])), [0])
+
+    def testInvalidBases(self):
+        """
+        An "N" (or any other non-nucleotide) in the read, and positions past the end of the read, are mismatches
+        """
+        matcher = Barcodes.BarcodeMatcher(BARCODE_SEQUENCE, BARCODE_POSITION)
+        barcode = matchingBarcode(BARCODE_SEQUENCE, self.rng)
+        withN = barcode[:3] + "N" + barcode[4:]
+        lowercase = barcode[:3] + barcode[3].lower() + barcode[4:]
+        self.assertEqual(list(matcher.mismatches([withN, lowercase, barcode[:10]])), [1, 1, 5])
+
+    def testFromEnd(self):
+        """
+        If fromEnd is specified, the reverse compliment of the barcode is expected at the end of the read
+        """
+        matcher = Barcodes.BarcodeMatcher(BARCODE_SEQUENCE, BARCODE_POSITION, fromEnd=True)
+        barcode = matchingBarcode(BARCODE_SEQUENCE, self.rng)
+        mismatched = addMismatches(barcode, BARCODE_SEQUENCE, self.compared[:2])
+        sequences = ["ACGTACGTAC" + Barcodes.reverseCompliment(x) for x in (barcode, mismatched)]
+        self.assertEqual(list(matcher.mismatches(sequences)), [0, 2])
+
+    def testGapsFromEnd(self):
+        """
+        Gaps are allowed in the barcode sequence (at positions which are not compared) when the barcode is at the end
+        of the read
+        """
+        self.assertEqual(Barcodes.reverseCompliment(".NA-C"), "G-TN.")
+        matcher = Barcodes.BarcodeMatcher(".NNACGT", "0001111", fromEnd=True)
+        self.assertEqual(list(matcher.mismatches(["GGGACGTGGG", "GGGACGTCGT", "GGGTCGTCCT"])), [0, 0, 1])
+
+    def testCachedMismatches(self):
+        """
+        The cache returns the same number of mismatches as comparing every barcode
+        """
+        matcher = Barcodes.BarcodeMatcher(BARCODE_SEQUENCE, BARCODE_POSITION)
+        cachedMatcher = Barcodes.BarcodeMatcher(BARCODE_SEQUENCE, BARCODE_POSITION, cacheSize=20)
+        barcodes = list(addMismatches(matchingBarcode(BARCODE_SEQUENCE, self.rng), BARCODE_SEQUENCE,
+                                      self.rng.sample(self.compared, self.rng.randint(0, 4))) for i in range(0, 40))
+        for batch in range(0, 10):
+            sequences = list(self.rng.choice(barcodes) for i in range(0, 200))
+            self.assertEqual(list(cachedMatcher.mismatches(sequences)), list(matcher.mismatches(sequences)))
+        self.assertLessEqual(len(cachedMatcher.cache.keys), 20)
+
+
+class TestBarcodeCache(unittest.TestCase):
+
+    def testHits(self):
+        matcher = Barcodes.BarcodeMatcher("ACGT", "1111", cacheSize=10)
+        matcher.mismatches(["ACGT", "ACGT", "ACGA"])
+        self.assertEqual(matcher.cacheStats(), (0, 3))
+        matcher.mismatches(["ACGT", "ACGA", "TTTT"])
+        self.assertEqual(matcher.cacheStats(), (2, 6))
+        # Without a cache, nothing is ever found
+        self.assertEqual(Barcodes.BarcodeMatcher("ACGT", "1111").cacheStats(), (0, 0))
+
+    def testEviction(self):
+        """
+        Once the cache is full, the least frequently used barcodes are evicted
+        """
+        cache = Barcodes.BarcodeCache(3)
+        cache.add(np.array([5, 1, 3], dtype=np.uint64), np.array([0, 1, 2]), np.array([10, 1, 5]))
+        cache.add(np.array([4, 2], dtype=np.uint64), np.array([3, 4]), np.array([7, 2]))
+        self.assertEqual(list(cache.keys), [3, 4, 5])  # The keys are kept sorted
+        self.assertEqual(list(cache.values), [2, 3, 0])
+        indexes, found = cache.lookup(np.array([1, 3, 5, 9], dtype=np.uint64))
+        self.assertEqual(list(found), [False, True, True, False])
+        self.assertEqual(list(cache.values[indexes[found]]), [2, 0])
+
+    def testMatcherEviction(self):
+        """
+        Frequently observed barcodes stay in the cache, even as many rare barcodes are added
+        """
+        matcher = Barcodes.BarcodeMatcher("ACGTACGT", "11111111", cacheSize=4)
+        matcher.mismatches(["ACGTACGT"] * 50 + ["TTTTTTTT"] * 20)
+        for rare in ("AAAAAAAA", "CCCCCCCC", "GGGGGGGG", "ACGTACGA", "ACGTACGC"):
+            matcher.mismatches([rare])
+        hits, lookups = matcher.cacheStats()
+        matcher.mismatches(["ACGTACGT", "TTTTTTTT"])
+        self.assertEqual(matcher.cacheStats(), (hits + 2, lookups + 2))
+
+
+def bruteForceNearest(barcodes, removed, barcode, indices, maxMismatches, wildcard):
+    """
+    Finds the closest barcode by comparing against every barcode, as Collapse did before BarcodeIndex was used
+
+    :param barcodes: A list of (name, barcode sequence, size) tuples, in the order they were added
+    :param removed: A set of names which have been removed
+    :param barcode: A string containing the barcode sequence to search for
+    :param indices: A list of the positions to compare
+    :param maxMismatches: An int specifying the maximum number of mismatches
+    :param wildcard: A boolean. If True, an "N" is never counted as a mismatch
+    :return: A tuple containing the name of the closest barcode and its distance, or (None, None)
+    """
+    minName = None
+    minDistance = None
+    minSize = None
+    for name, otherBarcode, size in barcodes:
+        if name in removed:
+            continue
+        distance = 0
+        for i in indices:
+            if barcode[i] != otherBarcode[i] and not (wildcard and "N" in (barcode[i], otherBarcode[i])):
+                distance += 1
+        if distance > maxMismatches:
+            continue
+        # In the case of a tie, the largest barcode is taken, and then the first barcode added
+        if minName is None or distance < minDistance or (distance == minDistance and size > minSize):
+            minName = name
+            minDistance = distance
+            minSize = size
+    if maxMismatches < 0 or minName is None:
+        return None, None
+    return minName, minDistance
+
+
+class TestBarcodeIndex(unittest.TestCase):
+
+    def testPackBarcode(self):
+        for barcode in ("", "A", "ACGTN", "NNTTGGCCAA", "ACGTNACGTNACGTNACGTN"):
+            self.assertEqual(Barcodes.unpackBarcode(Barcodes.packBarcode(barcode)), barcode)
+        # Other characters would be packed into the same barcode as an "N", so they are rejected instead
+        for barcode in ("ACGTa", "ACG.T", "ACRTN", "ACGU"):
+            self.assertRaises(ValueError, Barcodes.packBarcode, barcode)
+
+    def testTies(self):
+        index = Barcodes.BarcodeIndex(range(0, 4), 1)
+        for name, barcode, size in (("a", "ACGT", 1), ("b", "ACGA", 2), ("c", "ACGC", 2), ("d", "TTTT", 5)):
+            index.add(name, Barcodes.packBarcode(barcode), size)
+        # "b" and "c" are equally close and equally large, but "b" was added first
+        self.assertEqual(index.nearest(Barcodes.packBarcode("ACGG")), ("b", 1))
+        # An exact match is always preferred over a larger family
+        self.assertEqual(index.nearest(Barcodes.packBarcode("ACGT")), ("a", 0))
+        index.remove("b")
+        self.assertEqual(index.nearest(Barcodes.packBarcode("ACGG")), ("c", 1))
+        self.assertEqual(index.nearest(Barcodes.packBarcode("GGGG")), (None, None))
+        self.assertEqual(len(index), 3)
+
+    def testWildcards(self):
+        index = Barcodes.BarcodeIndex(range(0, 6), 1, wildcard=True)
+        index.add("n", Barcodes.packBarcode("NNNNNN"))
+        index.add("a", Barcodes.packBarcode("ACGTAC"), 2)
+        # An "N" matches anything, so the barcode made entirely of "N"s is an exact match for everything
+        self.assertEqual(index.nearest(Barcodes.packBarcode("ACGTAA")), ("n", 0))
+        self.assertEqual(index.nearest(Barcodes.packBarcode("ANGTAA")), ("n", 0))
+        index.remove("n")
+        self.assertEqual(index.nearest(Barcodes.packBarcode("ANGTAA")), ("a", 1))
+        # Without wildcards, an "N" is a mismatch like any other base
+        index = Barcodes.BarcodeIndex(range(0, 6), 1)
+        index.add("a", Barcodes.packBarcode("ACGTAC"))
+        self.assertEqual(index.nearest(Barcodes.packBarcode("ANGTAC")), ("a", 1))
+        self.assertEqual(index.nearest(Barcodes.packBarcode("ANGTAN")), (None, None))
+
+    def testBruteForce(self):
+        """
+        The index finds the same barcode as comparing against every barcode, including wildcards, ties, removed
+        barcodes, and ignored positions
+        """
+        rng = random.Random(0)
+        for trial in range(0, 300):
+            length = rng.randint(1, 12)
+            indices = sorted(rng.sample(range(0, length), rng.randint(1, length)))
+            maxMismatches = rng.randint(-1, 5)
+            wildcard = rng.random() < 0.5
+            index = Barcodes.BarcodeIndex(indices, maxMismatches, wildcard)
+            # Use a small alphabet, so there are plenty of close barcodes
+            alphabet = rng.choice(["AC", "ACN", "ACGTN", "ACGT"])
+            barcodes = []
+            removed = set()
+            for i in range(0, rng.randint(1, 40)):
+                barcode = "".join(rng.choice(alphabet) for j in range(0, length))
+                name = "barcode%s" % i
+                size = rng.randint(1, 3)  # Many ties
+                barcodes.append((name, barcode, size))
+                index.add(name, Barcodes.packBarcode(barcode), size)
+                if rng.random() < 0.2:
+                    removedName = rng.choice(barcodes)[0]
+                    if removedName not in removed:
+                        removed.add(removedName)
+                        index.remove(removedName)
+                query = "".join(rng.choice(alphabet) for j in range(0, length))
+                self.assertEqual(index.nearest(Barcodes.packBarcode(query)),
+                                 bruteForceNearest(barcodes, removed, query, indices, maxMismatches, wildcard),
+                                 (query, barcodes, removed, indices, maxMismatches, wildcard))
+            self.assertEqual(len(index), len(barcodes) - len(removed))
+
+
+if __name__ == "__main__":
+    unittest.main()
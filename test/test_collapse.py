@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""
+Tests that collapsing in parallel (i.e. "--threads") generates the same families as collapsing the input in a single pass
+
+The input is a simulated BAM file, containing families of read pairs sampled from a random reference genome. Some read
+pairs have large inserts, so their mates fall into different shards, or map to different contigs
+"""
+
+import array
+import collections
+import contextlib
+import copy
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+try:
+    from Dellingr import Collapse
+except ImportError:  # i.e. The optional dependencies of Collapse (ex. scikit-bio) are not installed
+    Collapse = None
+
+CONTIGS = (("chr1", 20000), ("chr2", 15000), ("chr3", 8000))
+TARGETS = (("chr1", 1000, 3000), ("chr1", 3500, 4000), ("chr1", 12000, 15000), ("chr2", 2000, 9000),
+           ("chr3", 100, 7000))
+READ_LENGTH = 100
+BARCODE_LENGTH = 14
+# Cigar operators, as stored in Collapse.Family
+MATCH = 0
+INSERTION = 1
+DELETION = 2
+SOFT_CLIP = 4
+
+
+def reverseComplement(sequence):
+    return sequence[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+
+def simulateReads(outDir, rng, molecules=150):
+    """
+    Writes a random reference genome, a sorted and indexed BAM file of read pairs sampled from that genome, and a BED
+    file of targets
+
+    :param outDir: A string containing a filepath to the directory where the files are written
+    :param rng: A random.Random object
+    :param molecules: An int specifying the number of molecules sampled from each contig
+    :return: A tuple containing filepaths to the reference, the BAM file and the BED file
+    """
+    reference = os.path.join(outDir, "ref.fa")
+    genome = {}
+    with open(reference, "w") as o:
+        for contig, length in CONTIGS:
+            genome[contig] = "".join(rng.choice("ACGT") for i in range(0, length))
+            o.write(">%s\n%s\n" % (contig, genome[contig]))
+    pysam.faidx(reference)
+
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": list({"SN": contig, "LN": length} for contig, length in CONTIGS)}
+    unsortedBAM = os.path.join(outDir, "unsorted.bam")
+    readCount = 0
+    with pysam.AlignmentFile(unsortedBAM, "wb", header=header) as o:
+        for tid, (contig, length) in enumerate(CONTIGS):
+            for i in range(0, molecules):
+                # Most inserts are short, but a few are long enough to span the gap between targets
+                insert = rng.randint(250, 450) if rng.random() < 0.8 else rng.randint(1000, 5000)
+                start = rng.randint(0, length - insert - 1)
+                # A few read pairs have a mate which maps to another contig
+                mateTid = tid if rng.random() < 0.95 else (tid + 1) % len(CONTIGS)
+                barcode = "".join(rng.choice("ACGT") for j in range(0, BARCODE_LENGTH))
+                fragment = genome[contig][start:start + insert]
+                # Sample reads from both strands of some molecules (i.e. duplexes)
+                for strand in (0, 1):
+                    if strand == 1 and rng.random() < 0.5:
+                        continue
+                    for j in range(0, rng.randint(1, 4)):
+                        readCount += 1
+                        reads = (list(fragment[:READ_LENGTH]), list(reverseComplement(fragment[-READ_LENGTH:])))
+                        # Add a sequencing error to some reads
+                        for sequence in reads:
+                            if rng.random() < 0.3:
+                                sequence[rng.randrange(READ_LENGTH)] = rng.choice("ACGT")
+                        R1 = pysam.AlignedSegment()
+                        R2 = pysam.AlignedSegment()
+                        positions = ((tid, start), (mateTid, start + insert - READ_LENGTH))
+                        for read, sequence, (readTid, position), isReverse in ((R1, reads[0], positions[0], False),
+                                                                               (R2, reads[1], positions[1], True)):
+                            read.query_name = "read%s" % readCount
+                            read.query_sequence = "".join(sequence)
+                            read.flag = 0x1 | 0x2 | (0x10 if isReverse else 0x20)
+                            # The first mate of the (-) strand molecule is on the reverse strand
+                            read.flag |= 0x40 if (strand == 0) != isReverse else 0x80
+                            read.reference_id = readTid
+                            read.reference_start = position
+                            read.mapping_quality = 60
+                            read.cigartuples = [(0, READ_LENGTH)]
+                            read.query_qualities = pysam.qualitystring_to_array("".join(rng.choice("5?I") for k in range(0, READ_LENGTH)))
+                            # The barcode of a (-) strand molecule is swapped
+                            read.set_tag("OX", barcode if strand == 0 else barcode[BARCODE_LENGTH // 2:] + barcode[:BARCODE_LENGTH // 2])
+                        R1.next_reference_id, R1.next_reference_start = positions[1]
+                        R2.next_reference_id, R2.next_reference_start = positions[0]
+                        o.write(R1)
+                        o.write(R2)
+
+    inputBAM = os.path.join(outDir, "input.bam")
+    pysam.sort("-o", inputBAM, unsortedBAM)
+    pysam.index(inputBAM)
+
+    targets = os.path.join(outDir, "targets.bed")
+    with open(targets, "w") as o:
+        for contig, start, end in TARGETS:
+            o.write("%s\t%s\t%s\n" % (contig, start, end))
+    return reference, inputBAM, targets
+
+
+def simulateFamily(rng, size):
+    """
+    Generates the reads of a family, as stored by Collapse.Family (i.e. a list of bases, qualities and cigar operators
+    for each read)
+
+    :param rng: A random.Random object
+    :param size: An int specifying the number of reads in the family
+    :return: A tuple containing a list of sequences, a list of quality arrays, and a list of cigars
+    """
+    template = "".join(rng.choice("ACGT") for i in range(0, 80))
+    # Some families have no insertions or deletions at all
+    indelRate = rng.choice((0, 0.005, 0.05))
+    sequences = []
+    qualities = []
+    cigars = []
+    for i in range(0, size):
+        cigar = [SOFT_CLIP] * (rng.randint(1, 4) if rng.random() < 0.3 else 0)
+        length = rng.randint(40, 60)
+        while len(cigar) < length:
+            operator = MATCH if rng.random() >= indelRate else rng.choice((INSERTION, DELETION))
+            # Insertions and deletions can't be at the start or end of the alignment
+            if operator != MATCH and (not cigar or cigar[-1] == SOFT_CLIP or len(cigar) >= length - 3):
+                operator = MATCH
+            cigar.extend([operator] * (1 if operator == MATCH else rng.randint(1, 2)))
+        cigar.extend([SOFT_CLIP] * (rng.randint(1, 4) if rng.random() < 0.3 else 0))
+        # Most bases match the template, with the occasional error (or uncalled base)
+        readLength = sum(1 for x in cigar if x != DELETION)
+        sequence = "".join(rng.choice("ACGTN") if rng.random() < 0.05 else template[j % len(template)]
+                           for j in range(0, readLength))
+        sequences.append(sequence)
+        qualities.append(array.array("B", (rng.choice((2, 12, 25, 37, 41)) for j in range(0, readLength))))
+        cigars.append(cigar)
+    return sequences, qualities, cigars
+
+
+def loadFamilies(bamFile):
+    """
+    :param bamFile: A string containing a filepath to a BAM file generated by Collapse
+    :return: A collections.Counter() of each read in the BAM file. Since each shard numbers its families differently,
+            the family counter is removed from the read name
+    """
+    reads = collections.Counter()
+    with pysam.AlignmentFile(bamFile, "rb", check_sq=False) as f:
+        for read in f.fetch(until_eof=True):
+            name = ":".join(read.query_name.split(":")[:3])
+            reads[(name, read.flag, read.reference_name, read.reference_start, read.cigarstring,
+                   read.next_reference_name, read.next_reference_start, read.query_sequence,
+                   tuple(read.query_qualities))] += 1
+    return reads
+
+
+@unittest.skipIf(Collapse is None, "The dependencies of Collapse are not installed")
+class TestParallelCollapse(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        cls.reference, cls.inputBAM, cls.targets = simulateReads(cls.tmpDir, random.Random(1))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    @contextlib.contextmanager
+    def quiet(self):
+        """
+        Redirects the status messages of Collapse into a log file
+        """
+        with open(os.path.join(self.tmpDir, "stderr.txt"), "a") as log, contextlib.redirect_stderr(log):
+            yield
+
+    def collapse(self, name, arguments):
+        outBAM = os.path.join(self.tmpDir, name)
+        with self.quiet():
+            Collapse.main(sysStdin=["-i", self.inputBAM, "-o", outBAM, "-r", self.reference, "-fm", "1111111",
+                                    "-dm", "1111111", "-fmm", "1", "-dmm", "1"] + arguments)
+        return loadFamilies(outBAM)
+
+    def testThreads(self):
+        for arguments in ([], ["-t", self.targets]):
+            expected = self.collapse("single.bam", arguments)
+            self.assertTrue(expected)
+            for threads in ("2", "3"):
+                self.assertEqual(self.collapse("threads%s.bam" % threads, arguments + ["--threads", threads]), expected,
+                                 (arguments, threads))
+
+    def testUnindexedInput(self):
+        """
+        The input file is indexed into a temporary directory, instead of beside the input file
+        """
+        inputDir = os.path.join(self.tmpDir, "unindexed")
+        os.mkdir(inputDir)
+        inputBAM = os.path.join(inputDir, "input.bam")
+        shutil.copy(self.inputBAM, inputBAM)
+        outBAM = os.path.join(self.tmpDir, "unindexed.bam")
+        with self.quiet():
+            Collapse.main(sysStdin=["-i", inputBAM, "-o", outBAM, "-r", self.reference, "-fm", "1111111",
+                                    "-dm", "1111111", "-fmm", "1", "-dmm", "1", "--threads", "2"])
+        self.assertEqual(os.listdir(inputDir), ["input.bam"])
+        # The temporary directory was removed
+        self.assertFalse(any(".shards." in x for x in os.listdir(self.tmpDir)))
+        self.assertEqual(loadFamilies(outBAM), self.collapse("single.bam", []))
+
+    def testShards(self):
+        """
+        Collapse every shard, including shards which are split right beside a target (so many read pairs span
+        several shards), and compare the result to collapsing the entire input file
+        """
+        familyIndices = list(range(0, 7))
+        with pysam.AlignmentFile(self.inputBAM) as inBAM, self.quiet():
+            readProcessor = Collapse.FamilyCoordinator(inBAM, self.reference, familyIndices, 1, familyIndices, 1,
+                                                       BARCODE_LENGTH, targets=self.targets)
+            expected = collections.Counter(read.query_sequence for read in readProcessor)
+            readCounter = readProcessor.readCounter
+            pairCounter = readProcessor.pairCounter
+            shards = readProcessor.shardRegions(20, margin=0)
+        # Every read on a contig is in exactly one shard
+        self.assertGreater(len(shards), len(CONTIGS))
+        for contig, length in CONTIGS:
+            contigShards = list(shard for shard in shards if shard[0] == contig)
+            self.assertEqual(contigShards[0][1], 0)
+            self.assertEqual(contigShards[-1][2], length)
+            for previousShard, shard in zip(contigShards, contigShards[1:]):
+                self.assertEqual(previousShard[2], shard[1])
+
+        collapsed = collections.Counter()
+        shardReads = 0
+        shardPairs = 0
+        for shard in shards:
+            with pysam.AlignmentFile(self.inputBAM) as inBAM, self.quiet():
+                readProcessor = Collapse.FamilyCoordinator(inBAM, self.reference, familyIndices, 1, familyIndices, 1,
+                                                           BARCODE_LENGTH, targets=self.targets, shard=shard)
+                collapsed.update(read.query_sequence for read in readProcessor)
+                shardReads += readProcessor.readCounter
+                shardPairs += readProcessor.pairCounter
+        self.assertEqual(collapsed, expected)
+        self.assertEqual(shardPairs, pairCounter)
+        self.assertLessEqual(shardReads, readCounter)
+
+
+@unittest.skipIf(Collapse is None, "The dependencies of Collapse are not installed")
+class TestConsensus(unittest.TestCase):
+
+    def setUp(self):
+        self.minMatrixReads = Collapse.MIN_MATRIX_READS
+
+    def tearDown(self):
+        Collapse.MIN_MATRIX_READS = self.minMatrixReads
+
+    def consensus(self, family, minMatrixReads):
+        """
+        Generates the consensus of a family, using the matrix only for families of at least the specified size
+
+        :param family: A tuple generated by simulateFamily()
+        :param minMatrixReads: An int, which MIN_MATRIX_READS is set to
+        :return: A tuple containing the consensus sequence, quality scores, cigar, and change in soft-clipping
+        """
+        Collapse.MIN_MATRIX_READS = minMatrixReads
+        # The cigars of the family are modified in place (ex. if an insertion needs to be soft-clipped), so use a copy
+        sequences, qualities, cigars = copy.deepcopy(family)
+        # _consensusByRead() only depends upon the reads it is given, not the read pair the family was created from
+        readPair = Collapse.Family.__new__(Collapse.Family)
+        results = []
+        for reverseClip in (False, True):
+            sequence, quality, cigar, softClip = readPair._consensusByRead(copy.deepcopy(sequences), copy.deepcopy(qualities),
+                                                                           copy.deepcopy(cigars), reverseClip)
+            results.append(("".join(sequence), list(quality), list(cigar), softClip))
+        return results
+
+    def testMatrix(self):
+        """
+        Processing columns using the matrix generates exactly the same consensus as processing one base at a time
+        """
+        rng = random.Random(0)
+        for trial in range(0, 300):
+            size = rng.choice((2, 3, self.minMatrixReads - 1, self.minMatrixReads, self.minMatrixReads + 1, 20, 50))
+            family = simulateFamily(rng, size)
+            expected = self.consensus(family, 10 ** 9)  # i.e. One base at a time
+            self.assertEqual(self.consensus(family, self.minMatrixReads), expected, family)
+            self.assertEqual(self.consensus(family, 1), expected, family)  # i.e. Always use the matrix
+
+
+if __name__ == "__main__":
+    unittest.main()
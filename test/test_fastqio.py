@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+Tests for the FASTQ readers and writers in FastqIO.py
+"""
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from Dellingr import FastqIO
+from Dellingr import DellingrExceptions as pe
+
+
+def fastqRecords(names, suffix=""):
+    """
+    Generates the text of a FASTQ file containing one record for each name
+
+    :param names: A list of read names
+    :param suffix: A string appended to each read name (ex. "/1")
+    :return: A string
+    """
+    return "".join("@%s%s comment\nACGTN\n+\nIIII#\n" % (name, suffix) for name in names)
+
+
+class TestFastqReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, name, text):
+        path = os.path.join(self.tmpDir, name)
+        if name.endswith(".gz"):
+            with gzip.open(path, "wt") as o:
+                o.write(text)
+        else:
+            with open(path, "w") as o:
+                o.write(text)
+        return path
+
+    def testReadBatches(self):
+        """
+        Records are split into batches, regardless of the block size, line endings or compression
+        """
+        names = list("read%s" % i for i in range(0, 25))
+        for fileName, text in (("plain.fastq", fastqRecords(names)), ("windows.fastq", fastqRecords(names).replace("\n", "\r\n")),
+                               ("gzipped.fastq.gz", fastqRecords(names)), ("noNewline.fastq", fastqRecords(names).rstrip("\n"))):
+            reader = FastqIO.FastqReader(self.writeFile(fileName, text), blockSize=7)
+            batches = []
+            while True:
+                batch = reader.readBatch(10)
+                if not batch:
+                    break
+                batches.append(batch)
+            reader.close()
+            self.assertEqual(list(len(x) for x in batches), [10, 10, 5], fileName)
+            records = list(record for batch in batches for record in batch)
+            self.assertEqual(list(FastqIO.readID(x.name) for x in records), list(("@" + x).encode() for x in names))
+            self.assertEqual(records[-1], FastqIO.FastqRecord(b"@read24 comment", b"ACGTN", b"+", b"IIII#"))
+
+    def testTruncatedRecord(self):
+        """
+        A file which ends part-way through a record is an error
+        """
+        text = fastqRecords(["read1", "read2"])
+        path = self.writeFile("truncated.fastq", text[:text.rindex("+")])
+        reader = FastqIO.FastqReader(path)
+        with self.assertRaises(pe.InvalidInputException):
+            reader.readBatch(10)
+        reader.close()
+
+    def testMalformedRecord(self):
+        """
+        A record with a missing line shifts every subsequent record, which is detected
+        """
+        text = fastqRecords(["read1", "read2", "read3", "read4"]).replace("ACGTN\n", "", 1)
+        path = self.writeFile("malformed.fastq", text + "ACGTN\n")
+        reader = FastqIO.FastqReader(path)
+        with self.assertRaises(pe.InvalidInputException):
+            reader.readBatch(10)
+        reader.close()
+
+    def testPairedNameMismatch(self):
+        """
+        The reader fails if the read names of read 1 and read 2 are out of sync
+        """
+        names = list("read%s" % i for i in range(0, 10))
+        r1 = self.writeFile("sync_R1.fastq", fastqRecords(names, "/1"))
+        r2 = self.writeFile("sync_R2.fastq", fastqRecords(names, "/2"))
+        reader = FastqIO.PairedFastqReader(r1, r2)
+        self.assertEqual(len(list(reader)), 10)
+        reader.close()
+
+        # Read 2 is missing a record, so every subsequent read is out of sync
+        r2 = self.writeFile("desync_R2.fastq", fastqRecords(names[:3] + names[4:] + ["read10"], "/2"))
+        reader = FastqIO.PairedFastqReader(r1, r2)
+        with self.assertRaises(pe.InvalidInputException):
+            reader.readBatch(100)
+        reader.close()
+        # Unless the names are not checked
+        reader = FastqIO.PairedFastqReader(r1, r2, checkNames=False)
+        self.assertEqual(len(reader.readBatch(100)[0]), 10)
+        reader.close()
+
+    def testPairedTruncated(self):
+        """
+        The reader fails if one file contains fewer records than the other
+        """
+        names = list("read%s" % i for i in range(0, 10))
+        r1 = self.writeFile("full_R1.fastq", fastqRecords(names))
+        r2 = self.writeFile("short_R2.fastq", fastqRecords(names[:8]))
+        reader = FastqIO.PairedFastqReader(r1, r2)
+        with self.assertRaises(pe.InvalidInputException):
+            reader.readBatch(100)
+        reader.close()
+
+    def testInterleaved(self):
+        names = list("read%s" % i for i in range(0, 5))
+        text = "".join(fastqRecords([x], "/1") + fastqRecords([x], "/2") for x in names)
+        reader = FastqIO.InterleavedFastqReader(self.writeFile("interleaved.fastq", text))
+        r1Records, r2Records = reader.readBatch(100)
+        reader.close()
+        self.assertEqual(list(x.name for x in r1Records), list(("@%s/1 comment" % x).encode() for x in names))
+        self.assertEqual(list(x.name for x in r2Records), list(("@%s/2 comment" % x).encode() for x in names))
+
+        # The last read is missing its mate
+        reader = FastqIO.InterleavedFastqReader(self.writeFile("unpaired.fastq", text + fastqRecords(["read5"], "/1")))
+        with self.assertRaises(pe.InvalidInputException):
+            reader.readBatch(100)
+        reader.close()
+
+
+class TestBlockGzipWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testBlocks(self):
+        """
+        The output is a valid gzip file, regardless of how many blocks (and threads) are used
+        """
+        text = fastqRecords(list("read%s" % i for i in range(0, 100)))
+        for threads in (1, 3):
+            path = os.path.join(self.tmpDir, "out%s.fastq.gz" % threads)
+            with FastqIO.BlockGzipWriter(path, threads=threads, blockSize=100) as o:
+                for line in text.splitlines(True):
+                    o.write(line)
+            with gzip.open(path, "rt") as f:
+                self.assertEqual(f.read(), text)
+
+    def testEmptyOutput(self):
+        """
+        If nothing is written, the output is still a valid (empty) gzip file
+        """
+        for threads in (1, 3):
+            path = os.path.join(self.tmpDir, "empty%s.fastq.gz" % threads)
+            FastqIO.openOutput(path, threads=threads).close()
+            self.assertGreater(os.path.getsize(path), 0)
+            with gzip.open(path, "rb") as f:
+                self.assertEqual(f.read(), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
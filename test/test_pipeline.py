@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Tests for estimating the memory usage of each pipeline stage from previous runs
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from Dellingr import DellingrPipeline
+except ImportError:  # i.e. The optional dependencies of the pipeline (ex. scikit-bio) are not installed
+    DellingrPipeline = None
+
+GIGABYTE = 1024 ** 3
+
+
+@unittest.skipIf(DellingrPipeline is None, "The dependencies of the pipeline are not installed")
+class TestEstimateMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.inputFile = os.path.join(self.workDir, "input.bam")
+        with open(self.inputFile, "wb") as o:
+            o.write(b"\0" * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def writeReport(self, rows):
+        """
+        :param rows: A list of (stage, status, cpus, peak memory usage, input size) tuples
+        :return: A string containing a filepath to the report
+        """
+        reportPath = os.path.join(self.workDir, "report.tsv")
+        with open(reportPath, "w") as o:
+            o.write("\t".join(["run_start", "sample", "stage", "status", "cpus", "max_rss_bytes", "input_bytes"]) + "\n")
+            for stage, status, cpus, peakMemory, inputBytes in rows:
+                o.write("\t".join(["2020-01-01T00:00:00", "sample", stage, status, str(cpus), str(peakMemory),
+                                   str(inputBytes)]) + "\n")
+        return reportPath
+
+    def testHistory(self):
+        history = DellingrPipeline.loadProfileHistory(self.writeReport([
+            ("collapse", "Complete", 2, 8 * GIGABYTE, 1000),
+            ("collapse-normal", "Complete", "NA", 2 * GIGABYTE, 500),
+            ("collapse", "Failed", 2, 100 * GIGABYTE, 1000)]))
+        self.assertEqual(history, {"collapse": [(8 * GIGABYTE, 1000, 2), (2 * GIGABYTE, 500, None)]})
+
+        heuristic = DellingrPipeline.estimateMemory("collapse", [self.inputFile], 16)
+        # The previous runs are scaled by the number of CPUs, and the size of the input
+        self.assertEqual(DellingrPipeline.estimateMemory("collapse", [self.inputFile], 16, history=history),
+                         max(heuristic, 64 * GIGABYTE))
+        heuristic = DellingrPipeline.estimateMemory("collapse-normal", [self.inputFile], 1)
+        self.assertEqual(DellingrPipeline.estimateMemory("collapse-normal", [self.inputFile], 1, history=history),
+                         max(heuristic, 4 * GIGABYTE))
+
+    def testHeuristicFloor(self):
+        """
+        A previous run which used very little memory never lowers the estimate
+        """
+        history = DellingrPipeline.loadProfileHistory(self.writeReport([("collapse", "Complete", 4, 1024, 1000)]))
+        for threads in (1, 4, 16):
+            self.assertEqual(DellingrPipeline.estimateMemory("collapse", [self.inputFile], threads, history=history),
+                             DellingrPipeline.estimateMemory("collapse", [self.inputFile], threads))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Tests for supervising a chain of external programs using ProcessChain.py
+
+Each program is a small shell script, which stands in for programs such as bwa or samtools
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from Dellingr import ProcessChain
+
+
+def isRunning(pid):
+    """
+    :param pid: An int specifying a process ID
+    :return: A boolean. True if the process exists, and has not exited (i.e. it is not a zombie)
+    """
+    try:
+        with open("/proc/%s/stat" % pid) as f:
+            # The state follows the (parenthesized) program name
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (IOError, IndexError):
+        return False
+
+
+class TestProcessChain(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def waitForFile(self, path):
+        """
+        Waits for a program to write the specified file
+
+        :return: A string containing the contents of the file
+        """
+        for i in range(0, 100):
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                break
+            time.sleep(0.1)
+        with open(path) as f:
+            return f.read().strip()
+
+    def testPipe(self):
+        outputFile = os.path.join(self.tmpDir, "output.txt")
+        chain = ProcessChain.ProcessChain()
+        chain.add("upstream", ["sh", "-c", "printf 'a\\nb\\nc\\n'"], pipeStdout=True)
+        chain.add("downstream", ["sh", "-c", "wc -l > %s" % outputFile])
+        chain.wait(30)
+        with open(outputFile) as f:
+            self.assertEqual(f.read().strip(), "3")
+
+    def testPipeStdin(self):
+        outputFile = os.path.join(self.tmpDir, "output.txt")
+        chain = ProcessChain.ProcessChain()
+        chain.add("upstream", ["sh", "-c", "cat"], pipeStdin=True, pipeStdout=True)
+        chain.add("downstream", ["sh", "-c", "cat > %s" % outputFile])
+        chain.processes[0].stdin.write(b"ACGT\n" * 1000)
+        # The input of the first program is closed once we start waiting
+        chain.wait(30)
+        with open(outputFile, "rb") as f:
+            self.assertEqual(f.read(), b"ACGT\n" * 1000)
+
+    def testDownstreamFailure(self):
+        """
+        If a downstream program fails, the upstream programs are killed, including any processes they started
+        """
+        pidFile = os.path.join(self.tmpDir, "background.pid")
+        chain = ProcessChain.ProcessChain()
+        # This program starts a background process (ex. a helper started by an aligner), and never writes any output
+        chain.add("upstream", ["sh", "-c", "sleep 60 & echo $! > %s; wait" % pidFile], pipeStdout=True)
+        chain.add("downstream", ["sh", "-c", "echo 'Invalid header' >&2; exit 3"])
+        backgroundPid = int(self.waitForFile(pidFile))
+        self.assertTrue(isRunning(backgroundPid))
+
+        startTime = time.time()
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            chain.wait(60)
+        self.assertLess(time.time() - startTime, 30)
+        self.assertEqual(e.exception.returncode, 3)
+        self.assertIn("exit 3", e.exception.cmd)
+        self.assertNotEqual(chain.processes[0].returncode, 0)
+        self.assertIn("Invalid header", chain.errorReport())
+        # The entire process group of the upstream program was killed
+        for i in range(0, 50):
+            if not isRunning(backgroundPid):
+                break
+            time.sleep(0.1)
+        self.assertFalse(isRunning(backgroundPid))
+
+    def testCulprit(self):
+        """
+        The program which crashed is reported, not the upstream program which was killed by SIGPIPE as a result
+        """
+        chain = ProcessChain.ProcessChain()
+        chain.add("upstream", ["sh", "-c", "exec yes ACGT"], pipeStdout=True)
+        chain.add("middle", ["sh", "-c", "head -c 100000 >/dev/null; exit 2"], pipeStdout=True)
+        chain.add("downstream", ["sh", "-c", "cat >/dev/null"])
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            chain.wait(30)
+        self.assertEqual(e.exception.returncode, 2)
+        self.assertIn("exit 2", e.exception.cmd)
+        self.assertLess(chain.processes[0].returncode, 0)
+
+    def testChattyStderr(self):
+        """
+        A program which writes much more to standard error than fits in a pipe buffer does not stall the chain
+        """
+        lines = []
+        chain = ProcessChain.ProcessChain(bufferLines=10)
+        chain.add("chatty", ["sh", "-c", "i=0; while [ $i -lt 20000 ]; do echo \"Processed $i reads\" >&2; i=$((i+1)); done"],
+                  stderrCallback=lines.append)
+        chain.wait(60)
+        self.assertEqual(len(lines), 20000)
+        self.assertEqual(list(chain.stderrBuffers[0]), list("Processed %s reads\n" % i for i in range(19990, 20000)))
+        self.assertTrue(chain.errorReport().endswith("Processed 19999 reads\n"))
+
+    def testTimeout(self):
+        chain = ProcessChain.ProcessChain()
+        chain.add("upstream", ["sh", "-c", "sleep 60"], pipeStdout=True)
+        chain.add("downstream", ["sh", "-c", "cat"])
+        startTime = time.time()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            chain.wait(0.5)
+        self.assertLess(time.time() - startTime, 30)
+        # Every program was killed
+        self.assertTrue(all(x.returncode is not None for x in chain.processes))
+
+    def testContextManager(self):
+        """
+        If an exception occurs while the programs are running, they are killed
+        """
+        with self.assertRaises(KeyError):
+            with ProcessChain.ProcessChain() as chain:
+                chain.add("upstream", ["sh", "-c", "sleep 60"])
+                raise KeyError("reference")
+        self.assertLess(chain.processes[0].returncode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
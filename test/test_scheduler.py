@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+"""
+Tests for running tasks using the Scheduler
+
+The pipeline stages are replaced by small tasks which record each time they are run
+"""
+
+import contextlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from Dellingr import Scheduler
+
+MEGABYTE = 1024 ** 2
+
+
+def allocateInChildren(children, megabytes, duration):
+    """
+    Starts several child processes at once, each of which allocates the specified amount of memory
+
+    :param children: An int specifying the number of child processes
+    :param megabytes: An int specifying the amount of memory used by each child process
+    :param duration: A number of seconds each child process runs for
+    """
+    code = "import time; x = bytearray(%s * 1024 ** 2); time.sleep(%s)" % (megabytes, duration)
+    processes = list(subprocess.Popen([sys.executable, "-c", code]) for i in range(0, children))
+    for process in processes:
+        if process.wait() != 0:
+            sys.exit(1)
+
+
+def recordRun(runLog, name, duration=0, fail=False):
+    """
+    A stand-in for a pipeline stage. Records when it was started and finished
+
+    :param runLog: A string containing a filepath. A line is appended to this file when this stage starts and finishes
+    :param name: A string containing the name of this stage
+    :param duration: A number of seconds to run for
+    :param fail: A boolean. If True, this stage fails
+    """
+    with open(runLog, "a") as o:
+        o.write("%s\tstart\t%s\n" % (name, time.time()))
+    time.sleep(duration)
+    with open(runLog, "a") as o:
+        o.write("%s\tend\t%s\n" % (name, time.time()))
+    if fail:
+        sys.exit(1)
+
+
+def writeOutput(runLog, name, outputFile, contents):
+    """
+    A stand-in for a pipeline stage which generates an output file
+
+    :param runLog: A string containing a filepath. The name of this stage is recorded in this file (see recordRun())
+    :param name: A string containing the name of this stage
+    :param outputFile: A string containing the filepath to the output file
+    :param contents: A string which is written to the output file
+    """
+    recordRun(runLog, name)
+    with open(outputFile, "w") as o:
+        o.write(contents)
+
+
+def failFirstAttempt(runLog, name):
+    """
+    A stand-in for a pipeline stage which fails the first time it is run (ex. a network filesystem was unavailable)
+
+    :param runLog: A string containing a filepath. Each time this stage is run is recorded in this file (see recordRun())
+    :param name: A string containing the name of this stage
+    """
+    recordRun(runLog, name)
+    if len(loadRuns(runLog)[name]) == 1:
+        sys.exit(1)
+
+
+def loadRuns(runLog):
+    """
+    :param runLog: A string containing a filepath to a file written by recordRun()
+    :return: A dictionary listing {stage: [(start time, end time), ...]}. The end time is None if the stage did not finish
+    """
+    runs = {}
+    if not os.path.exists(runLog):
+        return runs
+    with open(runLog) as f:
+        for line in f:
+            name, event, eventTime = line.rstrip("\n").split("\t")
+            if event == "start":
+                runs.setdefault(name, []).append((float(eventTime), None))
+            else:
+                runs[name][-1] = (runs[name][-1][0], float(eventTime))
+    return runs
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.runLog = os.path.join(self.workDir, "runs.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def task(self, name, duration=0, fail=False, **kwargs):
+        """
+        :return: A Scheduler.Task which records when it was run (see recordRun())
+        """
+        return Scheduler.Task(name, recordRun, (self.runLog, name, duration, fail), **kwargs)
+
+    def runTasks(self, tasks, **kwargs):
+        """
+        Runs the specified tasks, and hides the status messages of the scheduler
+
+        :param tasks: A list of Scheduler.Task objects
+        :param kwargs: Passed to the Scheduler
+        :return: A dictionary listing {task name: task state}
+        """
+        scheduler = Scheduler.Scheduler(**kwargs)
+        for task in tasks:
+            scheduler.addTask(task)
+        with open(os.path.join(self.workDir, "scheduler.err"), "a") as log, contextlib.redirect_stderr(log):
+            return scheduler.run()
+
+
+@unittest.skipUnless(os.path.exists("/proc/self/status"), "The memory usage of each process is listed in /proc")
+class TestResourceUsage(SchedulerTestCase):
+
+    def testConcurrentChildren(self):
+        """
+        The peak memory usage includes every child process which was running at the same time
+        """
+        task = Scheduler.Task("allocate", allocateInChildren, (3, 100, 2))
+        self.assertEqual(self.runTasks([task]), {"allocate": Scheduler.COMPLETE})
+        self.assertGreaterEqual(task.profile["max_rss"], 3 * 100 * MEGABYTE)
+
+    def testProcessTreeMemory(self):
+        """
+        The memory usage of a process includes its child processes
+        """
+        process = subprocess.Popen([sys.executable, "-c", "import time; x = bytearray(50 * 1024 ** 2); time.sleep(10)"])
+        try:
+            # Wait for the child process to allocate its memory
+            for i in range(0, 100):
+                if (Scheduler.processTreeMemory(process.pid) or 0) >= 50 * MEGABYTE:
+                    break
+                time.sleep(0.1)
+            self.assertGreaterEqual(Scheduler.processTreeMemory(process.pid), 50 * MEGABYTE)
+            self.assertGreater(Scheduler.processTreeMemory(os.getpid()), Scheduler.processTreeMemory(process.pid))
+        finally:
+            process.kill()
+            process.wait()
+
+
+class TestMaxTasks(SchedulerTestCase):
+
+    def testBackgroundTasks(self):
+        """
+        Tasks which do not use any CPUs (i.e. copying the results) do not count towards the maximum number of tasks
+        """
+        tasks = [self.task("sort"),
+                 self.task("promote", 1, dependencies=["sort"], cpus=0),
+                 self.task("call", dependencies=["sort"])]
+        self.assertEqual(set(self.runTasks(tasks, cpus=1, maxTasks=1).values()), {Scheduler.COMPLETE})
+        runs = loadRuns(self.runLog)
+        # Call was started while the results were being copied
+        self.assertLess(runs["call"][0][0], runs["promote"][0][1])
+
+    def testMaxTasks(self):
+        tasks = list(self.task("task%s" % i, 0.2) for i in range(0, 3))
+        self.assertEqual(set(self.runTasks(tasks, cpus=4, maxTasks=1).values()), {Scheduler.COMPLETE})
+        runs = sorted(x[0] for x in loadRuns(self.runLog).values())
+        for previousRun, run in zip(runs, runs[1:]):
+            self.assertLessEqual(previousRun[1], run[0])
+
+
+class TestFingerprints(SchedulerTestCase):
+    """
+    Tasks completed by a previous run are only re-run if their inputs or parameters have changed
+    """
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.inputFile = os.path.join(self.workDir, "input.txt")
+        with open(self.inputFile, "w") as o:
+            o.write("ACGT")
+        self.outputFile = os.path.join(self.workDir, "output.txt")
+
+    def marker(self, name):
+        return os.path.join(self.workDir, name + "_Complete")
+
+    def chain(self, parameters=None, hashInputs=False):
+        """
+        Runs a chain of three tasks (trim -> align -> call). "align" generates an output file, which is read by "call"
+
+        :param parameters: A dictionary listing {task name: parameters}
+        :param hashInputs: A boolean, passed to the Scheduler
+        :return: A sorted list of the tasks which were run
+        """
+        parameters = parameters if parameters is not None else {}
+        if os.path.exists(self.runLog):
+            os.remove(self.runLog)
+        tasks = [self.task("trim", inputs=[self.inputFile], marker=self.marker("trim"), parameters=parameters.get("trim")),
+                 Scheduler.Task("align", writeOutput, (self.runLog, "align", self.outputFile, "alignments"),
+                                dependencies=["trim"], marker=self.marker("align"), parameters=parameters.get("align")),
+                 self.task("call", dependencies=["align"], inputs=[self.outputFile], marker=self.marker("call"),
+                           parameters=parameters.get("call"))]
+        states = self.runTasks(tasks, hashInputs=hashInputs)
+        self.assertEqual(set(states.values()), {Scheduler.COMPLETE})
+        return sorted(loadRuns(self.runLog).keys())
+
+    def testUnchanged(self):
+        self.assertEqual(self.chain({"align": {"threads": 1}}), ["align", "call", "trim"])
+        self.assertEqual(self.chain({"align": {"threads": 1}}), [])
+
+    def testParameterChange(self):
+        """
+        Only the task whose parameters changed, and the tasks which depend upon it, are re-run
+        """
+        self.chain({"align": {"version": "0.7.17"}})
+        self.assertEqual(self.chain({"align": {"version": "0.7.18"}}), ["align", "call"])
+        self.assertEqual(self.chain({"align": {"version": "0.7.18"}}), [])
+        self.assertEqual(self.chain({"align": {"version": "0.7.18"}, "call": {"min_depth": 5}}), ["call"])
+
+    def testModifiedInput(self):
+        """
+        Without checksums, touching an input file (without modifying it) is enough to re-run its task
+        """
+        self.chain()
+        os.utime(self.inputFile, ns=(0, 0))
+        self.assertEqual(self.chain(), ["align", "call", "trim"])
+        # If the size of an input file changes, its task is re-run
+        with open(self.inputFile, "a") as o:
+            o.write("N")
+        self.assertEqual(self.chain(), ["align", "call", "trim"])
+
+    def testHashInputs(self):
+        """
+        With checksums, an input file which was touched (but not modified) is unchanged
+        """
+        self.chain(hashInputs=True)
+        os.utime(self.inputFile, ns=(0, 0))
+        self.assertEqual(self.chain(hashInputs=True), [])
+        # Modifying the input file without changing its size is detected
+        with open(self.inputFile, "w") as o:
+            o.write("TGCA")
+        os.utime(self.inputFile, ns=(0, 0))
+        self.assertEqual(self.chain(hashInputs=True), ["align", "call", "trim"])
+
+    def testLegacyMarkers(self):
+        """
+        Empty marker files (generated by older versions of Dellingr) are trusted
+        """
+        for name in ("trim", "align", "call"):
+            open(self.marker(name), "w").close()
+        with open(self.outputFile, "w") as o:
+            o.write("alignments")
+        self.assertEqual(self.chain({"align": {"version": "0.7.18"}}), [])
+        # An unreadable marker is not
+        with open(self.marker("call"), "w") as o:
+            o.write("{")
+        self.assertEqual(self.chain(), ["call"])
+
+    def testMissingInput(self):
+        """
+        If a task needs to be re-run, but its input files were removed, the task which generated them is also re-run
+        """
+        self.chain()
+        os.remove(self.outputFile)
+        # Since "call" is complete, the output of "align" is no longer needed
+        self.assertEqual(self.chain(), [])
+        self.assertEqual(self.chain({"call": {"min_depth": 5}}), ["align", "call"])
+        self.assertTrue(os.path.exists(self.outputFile))
+
+
+class TestRetries(SchedulerTestCase):
+
+    def testTransientFailure(self):
+        """
+        A task which fails once is re-run, and the tasks which depend upon it are run once it succeeds
+        """
+        tasks = [Scheduler.Task("align", failFirstAttempt, (self.runLog, "align")),
+                 self.task("call", dependencies=["align"])]
+        # Since the task succeeds on its second attempt, it is not a failure
+        states = self.runTasks(tasks, retries=2, retryDelay=0.1, failFast=True)
+        self.assertEqual(states, {"align": Scheduler.COMPLETE, "call": Scheduler.COMPLETE})
+        self.assertEqual(tasks[0].attempts, 2)
+        runs = loadRuns(self.runLog)
+        self.assertEqual(len(runs["align"]), 2)
+        # The task was not re-run until the retry delay had passed
+        self.assertGreaterEqual(runs["align"][1][0] - runs["align"][0][1], 0.1)
+        self.assertGreater(runs["call"][0][0], runs["align"][1][1])
+
+    def testRetriesExhausted(self):
+        tasks = [self.task("align", fail=True),
+                 self.task("call", dependencies=["align"])]
+        states = self.runTasks(tasks, retries=1, retryDelay=0.1)
+        self.assertEqual(states, {"align": Scheduler.FAILED, "call": Scheduler.SKIPPED})
+        self.assertEqual(tasks[0].attempts, 2)
+        runs = loadRuns(self.runLog)
+        self.assertEqual(len(runs["align"]), 2)
+        self.assertNotIn("call", runs)
+
+    def testFailFast(self):
+        """
+        Once a task fails, the running and pending tasks of every other sample are cancelled
+        """
+        tasks = [self.task("sampleA:align", 0.5, fail=True, sample="sampleA"),
+                 self.task("sampleA:call", dependencies=["sampleA:align"], sample="sampleA"),
+                 self.task("sampleB:align", 30, sample="sampleB"),
+                 self.task("sampleB:call", dependencies=["sampleB:align"], sample="sampleB")]
+        startTime = time.time()
+        states = self.runTasks(tasks, cpus=2, retries=1, retryDelay=0.1, failFast=True)
+        self.assertLess(time.time() - startTime, 30)
+        self.assertEqual(states, {"sampleA:align": Scheduler.FAILED, "sampleA:call": Scheduler.SKIPPED,
+                                  "sampleB:align": Scheduler.CANCELLED, "sampleB:call": Scheduler.CANCELLED})
+        runs = loadRuns(self.runLog)
+        # The failed task was still retried before everything else was cancelled
+        self.assertEqual(len(runs["sampleA:align"]), 2)
+        # The long-running task was stopped before it finished
+        self.assertEqual(runs["sampleB:align"], [(runs["sampleB:align"][0][0], None)])
+        self.assertNotIn("sampleB:call", runs)
+
+    def testWithoutFailFast(self):
+        """
+        By default, a failed task does not affect the other samples
+        """
+        tasks = [self.task("sampleA:align", fail=True, sample="sampleA"),
+                 self.task("sampleA:call", dependencies=["sampleA:align"], sample="sampleA"),
+                 self.task("sampleB:align", 0.5, sample="sampleB"),
+                 self.task("sampleB:call", dependencies=["sampleB:align"], sample="sampleB")]
+        states = self.runTasks(tasks, cpus=2)
+        self.assertEqual(states, {"sampleA:align": Scheduler.FAILED, "sampleA:call": Scheduler.SKIPPED,
+                                  "sampleB:align": Scheduler.COMPLETE, "sampleB:call": Scheduler.COMPLETE})
+
+
+if __name__ == "__main__":
+    unittest.main()
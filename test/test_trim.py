@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+"""
+Tests for trimming (and demultiplexing) the barcodes of read pairs using Trim.py
+"""
+
+import contextlib
+import gzip
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from Dellingr import FastqIO, Trim
+from Dellingr import DellingrExceptions as pe
+
+BARCODE_SEQUENCE = "NNNWSMRWSYWKMWWT"
+BARCODE_POSITION = "0001111111111110"
+# Both of these barcodes are 4 mismatches apart
+SAMPLES = [("sampleA", "NNNACGTACGT", "00011111111", 4),
+           ("sampleB", "NNNACGTTGCA", "00011111111", 4)]
+
+
+def randomBarcode(barcodeSequence, rng, mismatchRate=0.0):
+    """
+    Generates a sequence which matches the specified degenerate barcode, aside from random mismatches
+
+    :param barcodeSequence: A string containing IUPAC bases
+    :param rng: A random.Random object
+    :param mismatchRate: A float specifying the probability that each base is replaced with a random base
+    :return: A string
+    """
+    sequence = []
+    for base in barcodeSequence:
+        if rng.random() < mismatchRate:
+            sequence.append(rng.choice("ACGT"))
+        else:
+            sequence.append(rng.choice(list(x for x in "ACGT" if Trim.Barcodes.IUPAC_BITS[x] & Trim.Barcodes.IUPAC_BITS[base])))
+    return "".join(sequence)
+
+
+def writePairs(r1Path, r2Path, barcodes, rng):
+    """
+    Writes a pair of FASTQ files. Each read starts with the specified barcode, followed by a random sequence
+
+    :param r1Path: A string containing a filepath to the read 1 output
+    :param r2Path: A string containing a filepath to the read 2 output
+    :param barcodes: A list of (read 1 barcode, read 2 barcode) tuples, one for each read pair
+    :param rng: A random.Random object
+    """
+    with open(r1Path, "w") as r1, open(r2Path, "w") as r2:
+        for i, pairBarcodes in enumerate(barcodes):
+            for o, barcode, readNumber in zip((r1, r2), pairBarcodes, (1, 2)):
+                seq = barcode + "".join(rng.choice("ACGT") for j in range(0, 50))
+                qual = "".join(rng.choice("#-7<FI") for j in range(0, len(seq)))
+                o.write("@read%s %s:N:0:1\n%s\n+\n%s\n" % (i, readNumber, seq, qual))
+
+
+def readOutput(path):
+    """
+    :param path: A string containing a filepath to a (possibly gzipped) FASTQ file
+    :return: The contents of the file, as bytes
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path) as f:
+            return f.read()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class TrimTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rng = random.Random(7)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def runTrim(self, arguments, batchSize=37):
+        """
+        Runs Trim.main() with the specified arguments
+
+        :param arguments: A list of command line arguments
+        :param batchSize: An int specifying the number of read pairs in each batch. Small batches are used, so the
+                        reads are split across many batches
+        :return: A list of the status messages printed (without the prefix or timestamp)
+        """
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            Trim.main(sysStdin=arguments, printPrefix="DELLINGR-TRIM", batchSize=batchSize)
+        return list(line.split("\t", 2)[-1] for line in stderr.getvalue().splitlines() if line.startswith("DELLINGR-TRIM"))
+
+
+class TestThreads(TrimTestCase):
+
+    def setUp(self):
+        TrimTestCase.setUp(self)
+        self.inputs = list(os.path.join(self.tmpDir, "input.R%s.fastq" % i) for i in (1, 2))
+        # Some read pairs have too many mismatches in their barcode, and are discarded
+        barcodes = list((randomBarcode(BARCODE_SEQUENCE, self.rng, 0.05), randomBarcode(BARCODE_SEQUENCE, self.rng, 0.05))
+                        for i in range(0, 2000))
+        writePairs(self.inputs[0], self.inputs[1], barcodes, self.rng)
+
+    def trim(self, threads, outputNames, extraArguments=()):
+        """
+        :param threads: An int specifying the number of processes used to trim reads
+        :param outputNames: A list of output file names
+        :return: A tuple containing a list of the contents of each output file, and the discard rate and count
+        """
+        outputs = list(os.path.join(self.tmpDir, "threads%s.%s" % (threads, x)) for x in outputNames)
+        messages = self.runTrim(["-i"] + self.inputs + ["-o"] + outputs +
+                                ["-b", BARCODE_SEQUENCE, "-p", BARCODE_POSITION, "-mm", "2", "-t", str(threads)] +
+                                list(extraArguments))
+        discardCounts = list(x for x in messages if x.startswith("Discard Rate:"))
+        return list(readOutput(x) for x in outputs), discardCounts
+
+    def testOutputOrder(self):
+        """
+        Trimming reads using several processes generates exactly the same output as using a single process
+        """
+        for outputNames, extraArguments in ((["R1.fastq", "R2.fastq"], []),
+                                            (["R1.fastq.gz", "R2.fastq.gz"], []),
+                                            (["interleaved.fastq"], []),
+                                            (["R1.fastq", "R2.fastq"], ["--reverse"]),
+                                            (["R1.fastq", "R2.fastq"], ["--trim_other_end", "--cache_size", "100"])):
+            singleOutputs, singleDiscards = self.trim(1, outputNames, extraArguments)
+            threadedOutputs, threadedDiscards = self.trim(3, outputNames, extraArguments)
+            self.assertEqual(singleOutputs, threadedOutputs, outputNames + extraArguments)
+            self.assertEqual(singleDiscards, threadedDiscards, outputNames + extraArguments)
+            self.assertEqual(len(singleDiscards), 1)
+            self.assertTrue(singleDiscards[0].endswith("Count:4000"))
+            # Some (but not all) of the read pairs were output
+            keptReads = singleOutputs[0].count(b"\n") // (4 if len(outputNames) == 1 else 2)
+            self.assertTrue(0 < keptReads < 4000)
+            self.assertEqual(singleOutputs[0].count(b"\n"), singleOutputs[-1].count(b"\n"))
+
+    def testReadPairsInSync(self):
+        """
+        Read 1 and read 2 of each pair are output in the same order as the input
+        """
+        (r1Output, r2Output), discards = self.trim(3, ["R1.fastq", "R2.fastq"])
+        r1Names = r1Output.split(b"\n")[0::4]
+        r2Names = r2Output.split(b"\n")[0::4]
+        self.assertEqual(list(x.split(b"\t")[0] for x in r1Names), list(x.split(b"\t")[0] for x in r2Names))
+        readNumbers = list(int(x.split(b"\t")[0][len(b"@read"):]) for x in r1Names if x)
+        self.assertEqual(readNumbers, sorted(readNumbers))
+
+
+def readPair(name, r1Barcode, r2Barcode):
+    """
+    :return: A tuple containing the read 1 and read 2 FastqIO.FastqRecords of a read pair with the specified barcodes
+    """
+    return tuple(FastqIO.FastqRecord(b"@%s %s:N:0:1" % (name.encode(), readNumber), (barcode + "ACGTACGTAC").encode(),
+                                     b"+", b"I" * (len(barcode) + 10))
+                 for barcode, readNumber in ((r1Barcode, b"1"), (r2Barcode, b"2")))
+
+
+class TestDemultiplexer(TrimTestCase):
+
+    def demultiplex(self, pairs, samples=SAMPLES):
+        """
+        :param pairs: A dictionary listing {read name: (read 1 barcode, read 2 barcode)}
+        :param samples: A list of samples, as generated by Trim.parseDemultiplexTable()
+        :return: A dictionary listing {sample name: [the read names assigned to that sample]}, and the number of
+                undetermined reads
+        """
+        demultiplexer = Trim.Demultiplexer(samples)
+        records = list(readPair(name, r1Barcode, r2Barcode) for name, (r1Barcode, r2Barcode) in pairs.items())
+        r1Outs, r2Outs, undetermined = demultiplexer.trim(list(x[0] for x in records), list(x[1] for x in records))
+        assigned = {}
+        for sampleName, r1Out, r2Out in zip(demultiplexer.sampleNames + ["undetermined"], r1Outs, r2Outs):
+            r1Names = list(x.split(b" ")[0].split(b"\t")[0][1:].decode() for x in r1Out.split(b"\n")[0::4] if x)
+            r2Names = list(x.split(b" ")[0].split(b"\t")[0][1:].decode() for x in r2Out.split(b"\n")[0::4] if x)
+            self.assertEqual(r1Names, r2Names)
+            assigned[sampleName] = r1Names
+        return assigned, undetermined
+
+    def testAssignment(self):
+        """
+        Each read pair is assigned to the sample whose barcode it matches best
+        """
+        assigned, undetermined = self.demultiplex({"exactA": ("GGGACGTACGT", "TTTACGTACGT"),
+                                                   "exactB": ("GGGACGTTGCA", "TTTACGTTGCA"),
+                                                   # 1 mismatch from sampleA, 7 from sampleB
+                                                   "nearA": ("GGGACGTACGA", "TTTACGTACGT"),
+                                                   # 2 mismatches from sampleA (its maximum is 4), 10 from sampleB
+                                                   "mismatchesA": ("GGGTCGTACGT", "TTTACGAACGT")})
+        self.assertEqual(assigned, {"sampleA": ["exactA", "nearA", "mismatchesA"], "sampleB": ["exactB"],
+                                    "undetermined": []})
+        self.assertEqual(undetermined, 0)
+
+    def testTrimmed(self):
+        """
+        The barcode of each sample is removed from the reads assigned to it. Undetermined reads are not modified
+        """
+        r1Record, r2Record = readPair("exactB", "GGGACGTTGCA", "TTTACGTTGCA")
+        undeterminedR1, undeterminedR2 = readPair("undetermined", "GGGGGGGGGGG", "TTTTTTTTTTT")
+        demultiplexer = Trim.Demultiplexer(SAMPLES)
+        r1Outs, r2Outs, undetermined = demultiplexer.trim([r1Record, undeterminedR1], [r2Record, undeterminedR2])
+        self.assertEqual(r1Outs[0], b"")
+        self.assertEqual(r1Outs[1], b"@exactB\tOX:Z:GGGACGTTGCATTTACGTTGCA\nACGTACGTAC\n+\nIIIIIIIIII\n")
+        self.assertEqual(r2Outs[1], b"@exactB\tOX:Z:GGGACGTTGCATTTACGTTGCA\nACGTACGTAC\n+\nIIIIIIIIII\n")
+        self.assertEqual(r1Outs[2], b"\n".join(undeterminedR1) + b"\n")
+        self.assertEqual(r2Outs[2], b"\n".join(undeterminedR2) + b"\n")
+        self.assertEqual(undetermined, 2)
+
+    def testTied(self):
+        """
+        A read pair which matches several samples equally well is undetermined
+        """
+        # Read 1 matches sampleA, while read 2 matches sampleB, so the pair is 4 mismatches from both
+        assigned, undetermined = self.demultiplex({"exactA": ("GGGACGTACGT", "TTTACGTACGT"),
+                                                   "tied": ("GGGACGTACGT", "TTTACGTTGCA")})
+        self.assertEqual(assigned, {"sampleA": ["exactA"], "sampleB": [], "undetermined": ["tied"]})
+        self.assertEqual(undetermined, 2)
+        # Unless the pair falls outside the mismatch threshold of one of the samples
+        samples = [SAMPLES[0], SAMPLES[1][:3] + (3,)]
+        assigned, undetermined = self.demultiplex({"tied": ("GGGACGTACGT", "TTTACGTTGCA")}, samples)
+        self.assertEqual(assigned, {"sampleA": ["tied"], "sampleB": [], "undetermined": []})
+
+    def testUnmatched(self):
+        """
+        A read pair which falls outside the mismatch threshold of every sample is undetermined
+        """
+        assigned, undetermined = self.demultiplex({"exactB": ("GGGACGTTGCA", "TTTACGTTGCA"),
+                                                   "unmatched": ("GGGTTTTTTTT", "TTTTTTTTTTT"),
+                                                   # 5 mismatches from sampleA, 11 from sampleB
+                                                   "tooManyMismatches": ("GGGTGCAACGT", "TTTACGTACCT")})
+        self.assertEqual(assigned, {"sampleA": [], "sampleB": ["exactB"], "undetermined": ["unmatched", "tooManyMismatches"]})
+        self.assertEqual(undetermined, 4)
+
+    def testMain(self):
+        """
+        Each sample is written to a separate pair of output files, named after that sample
+        """
+        inputs = list(os.path.join(self.tmpDir, "input.R%s.fastq" % i) for i in (1, 2))
+        writePairs(inputs[0], inputs[1], [("GGGACGTACGT", "TTTACGTACGT"), ("GGGACGTTGCA", "TTTACGTTGCA"),
+                                          ("GGGACGTACGT", "TTTACGTTGCA"), ("GGGACGTACGT", "TTTACGTACGA")], self.rng)
+        table = os.path.join(self.tmpDir, "samples.tsv")
+        with open(table, "w") as o:
+            o.write("sample\tbarcode_sequence\tbarcode_position\n")
+            for sampleName, barcodeSequence, barcodePosition, maxMismatch in SAMPLES:
+                o.write("\t".join([sampleName, barcodeSequence, barcodePosition]) + "\n")
+        outputs = list(os.path.join(self.tmpDir, "trimmed.R%s.fastq" % i) for i in (1, 2))
+        for threads in ("1", "2"):
+            messages = self.runTrim(["-i"] + inputs + ["-o"] + outputs + ["--demultiplex", table, "-mm", "4", "-t", threads],
+                                    batchSize=1)
+            self.assertIn("Sample:sampleA\tCount:4", messages)
+            self.assertIn("Sample:sampleB\tCount:2", messages)
+            self.assertIn("Sample:undetermined\tCount:2", messages)
+            for sampleName, readNames in (("sampleA", [b"@read0", b"@read3"]), ("sampleB", [b"@read1"]),
+                                          ("undetermined", [b"@read2"])):
+                for output in outputs:
+                    lines = readOutput(os.path.join(self.tmpDir, sampleName + "." + os.path.basename(output))).split(b"\n")
+                    self.assertEqual(list(x.split(b"\t")[0].split(b" ")[0] for x in lines[0::4] if x), readNames)
+
+
+class TestDemultiplexTable(TrimTestCase):
+
+    def parseTable(self, text, maxMismatch=None):
+        tablePath = os.path.join(self.tmpDir, "samples.tsv")
+        with open(tablePath, "w") as o:
+            o.write(text)
+        return Trim.parseDemultiplexTable(tablePath, maxMismatch)
+
+    def testParse(self):
+        samples = self.parseTable("# Comments and blank lines are ignored\n"
+                                  "sample\tbarcode_position\tbarcode_sequence\tmax_mismatch\n"
+                                  "\n"
+                                  "sampleA\t0001111\tnnnacgt\t2\r\n"
+                                  "sampleB\t0001111\tNNNTGCA\t\n", maxMismatch=3)
+        self.assertEqual(samples, [("sampleA", "NNNACGT", "0001111", 2), ("sampleB", "NNNTGCA", "0001111", 3)])
+
+    def testMalformed(self):
+        header = "sample\tbarcode_sequence\tbarcode_position\tmax_mismatch\n"
+        for text, maxMismatch in (("sample\tbarcode_sequence\n" "sampleA\tNNNACGT\n", 2),  # Missing column
+                                  (header + "sampleA\tNNNACGT\t0001111\n", 2),  # Wrong number of columns
+                                  (header + "sampleA\tNNNACGT\t0001111\tmany\n", 2),  # Invalid max_mismatch
+                                  (header + "sampleA\tNNNACGT\t0001111\t\n", None),  # No max_mismatch
+                                  (header + "sampleA\tNNNACGT\t00011111\t2\n", 2),  # Barcode mask is too long
+                                  (header + "sampleA\tNNNACGZ\t0001111\t2\n", 2),  # Invalid IUPAC base
+                                  (header + "sampleA\tNNNACGT\t0001111\t2\n" "sampleA\tNNNTGCA\t0001111\t2\n", 2),
+                                  (header + "undetermined\tNNNACGT\t0001111\t2\n", 2),  # Reserved name
+                                  (header, 2)):  # No samples
+            with self.assertRaises(pe.InvalidInputException, msg=text):
+                self.parseTable(text, maxMismatch)
+
+
+if __name__ == "__main__":
+    unittest.main()
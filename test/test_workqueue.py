@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Tests several workers processing the same directory at once, using the work queue (i.e. "dellingr worker")
+
+Each worker is a separate local process, which runs its own Scheduler and WorkQueue against a shared directory of
+marker files, exactly as "dellingr worker" does for an analysis directory. The pipeline stages are replaced by tasks
+which record each time they are run
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from Dellingr import Scheduler, WorkQueue
+
+WORKERS = 3
+SAMPLES = ("sampleA", "sampleB")
+STAGES = ("trim", "bwa", "collapse", "sort", "call")
+
+
+def runStage(runLog, name, duration, fail=False):
+    """
+    A stand-in for a pipeline stage. Records that it was run
+
+    :param runLog: A string containing a filepath. The name of this stage is appended to this file
+    :param name: A string containing the name of this stage
+    :param duration: A number of seconds to run for
+    :param fail: A boolean. If True, this stage fails
+    """
+    # Each line is written with a single append, so lines from different workers are not interleaved
+    with open(runLog, "a") as o:
+        o.write("%s\t%s\n" % (name, os.getpid()))
+    time.sleep(duration)
+    if fail:
+        sys.exit(1)
+
+
+def pipelineTasks(workDir, failing=()):
+    """
+    Generates a linear chain of stages for each sample, similar to DellingrPipeline.pipelineTasks()
+
+    :param workDir: A string containing a filepath to the shared directory
+    :param failing: A list of the task names which fail
+    :return: A list of Scheduler.Task objects
+    """
+    tasks = []
+    for sample in SAMPLES:
+        configDir = os.path.join(workDir, sample, "config")
+        previous = []
+        for stage in STAGES:
+            name = sample + ":" + stage
+            tasks.append(Scheduler.Task(name, runStage, (os.path.join(workDir, "runs.log"), name, 0.3, name in failing),
+                                        dependencies=previous, marker=os.path.join(configDir, stage + "_Complete"),
+                                        sample=sample))
+            previous = [name]
+    return tasks
+
+
+def runWorker(workDir, barrier, leaseTimeout, failing=()):
+    """
+    Runs all stages using the work queue, alongside any other workers, and saves the final state of each task
+
+    :param workDir: A string containing a filepath to the shared directory
+    :param barrier: A multiprocessing.Barrier, so every worker starts at the same time
+    :param leaseTimeout: A number of seconds after which an abandoned lease is recovered
+    :param failing: A list of the task names which fail
+    """
+    sys.stderr = open(os.path.join(workDir, "worker%s.err" % os.getpid()), "w")
+    scheduler = Scheduler.Scheduler(cpus=2, workQueue=WorkQueue.WorkQueue(leaseTimeout=leaseTimeout, pollInterval=0.1))
+    for task in pipelineTasks(workDir, failing):
+        scheduler.addTask(task)
+    barrier.wait()
+    states = scheduler.run()
+    with open(os.path.join(workDir, "worker%s.json" % os.getpid()), "w") as o:
+        json.dump(states, o)
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        for sample in SAMPLES:
+            os.makedirs(os.path.join(self.workDir, sample, "config"))
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def runWorkers(self, leaseTimeout=30, failing=()):
+        """
+        Runs several workers at once, and waits for all of them to finish
+
+        :return: A list containing the final task states of each worker, and a dictionary listing the number of times
+                each task was run
+        """
+        barrier = multiprocessing.Barrier(WORKERS)
+        workers = list(multiprocessing.Process(target=runWorker, args=(self.workDir, barrier, leaseTimeout, failing))
+                       for i in range(0, WORKERS))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(120)
+            self.assertEqual(worker.exitcode, 0)
+
+        states = []
+        for worker in workers:
+            with open(os.path.join(self.workDir, "worker%s.json" % worker.pid)) as f:
+                states.append(json.load(f))
+        runs = dict((x.name, 0) for x in pipelineTasks(self.workDir))
+        runLog = os.path.join(self.workDir, "runs.log")
+        if os.path.exists(runLog):
+            with open(runLog) as f:
+                for line in f:
+                    runs[line.split("\t")[0]] += 1
+        return states, runs
+
+    def leftoverLeases(self):
+        return list(x for sample in SAMPLES for x in os.listdir(os.path.join(self.workDir, sample, "config"))
+                    if ".lease" in x)
+
+    def testEachStageRunOnce(self):
+        """
+        Every stage is completed, and each stage is only run by one worker
+        """
+        states, runs = self.runWorkers()
+        self.assertEqual(set(runs.values()), {1})
+        for workerStates in states:
+            self.assertEqual(set(workerStates.values()), {Scheduler.COMPLETE})
+        self.assertEqual(self.leftoverLeases(), [])
+
+    def testAbandonedLease(self):
+        """
+        A lease left behind by a worker which died is recovered by another worker once it expires
+        """
+        marker = os.path.join(self.workDir, "sampleA", "config", "bwa_Complete")
+        with open(marker + ".lease", "w") as o:
+            o.write(json.dumps({"worker": "deadhost:1", "claimed": "2020-01-01T00:00:00", "id": "abandoned"}) + "\n")
+        # This lease has not been updated in a while
+        os.utime(marker + ".lease", (time.time() - 5, time.time() - 5))
+
+        states, runs = self.runWorkers(leaseTimeout=2)
+        self.assertEqual(set(runs.values()), {1})
+        for workerStates in states:
+            self.assertEqual(set(workerStates.values()), {Scheduler.COMPLETE})
+        self.assertTrue(os.path.exists(marker))
+        self.assertEqual(self.leftoverLeases(), [])
+
+    def testFailedStage(self):
+        """
+        Once a stage fails, its failure is recorded, and no worker runs the stages which depend upon it
+        """
+        states, runs = self.runWorkers(failing=["sampleA:collapse"])
+        failure = os.path.join(self.workDir, "sampleA", "config", "collapse_Complete.failed")
+        self.assertTrue(os.path.exists(failure))
+        self.assertEqual(runs["sampleA:collapse"], 1)
+        for stage in ("sort", "call"):
+            self.assertEqual(runs["sampleA:" + stage], 0)
+            self.assertFalse(os.path.exists(os.path.join(self.workDir, "sampleA", "config", stage + "_Complete")))
+        for workerStates in states:
+            self.assertEqual(workerStates["sampleA:collapse"], Scheduler.FAILED)
+            self.assertEqual(workerStates["sampleA:sort"], Scheduler.SKIPPED)
+            self.assertEqual(workerStates["sampleA:call"], Scheduler.SKIPPED)
+        # The other sample is unaffected
+        self.assertEqual(set(runs["sampleB:" + x] for x in STAGES), {1})
+        self.assertEqual(self.leftoverLeases(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()